@@ -9,6 +9,7 @@ from rest_framework.decorators import api_view, permission_classes
 
 from .serializers import UserRegistrationSerializer, ChangePasswordSerializer, LoginSerializer
 from users.serializers import UserSerializer
+from chat_app.presence import set_offline
 from .jwt_cookies import set_refresh_cookie, clear_refresh_cookie, REFRESH_COOKIE_NAME
 
 
@@ -92,10 +93,8 @@ class LogoutView(APIView):
     def post(self, request):
         refresh_token = request.COOKIES.get(REFRESH_COOKIE_NAME)
         
-        # Set user as offline
-        user = request.user
-        user.is_online = False
-        user.save(update_fields=['is_online'])
+        # Set user as offline in the presence store (flushed to the DB in batches)
+        set_offline(request.user.id)
 
         response = Response(status=status.HTTP_205_RESET_CONTENT)
 
@@ -0,0 +1,260 @@
+"""
+Archive tier for chat history.
+
+Messages older than CHAT_ARCHIVE['after_days'] are moved out of the hot
+Message table in chunked batches (archive_batch, driven by the
+archive_messages command) into MessageArchiveBlock rows: per-conversation
+blocks of up to CHAT_ARCHIVE['block_size'] messages, compressed together.
+The hot table, and every index on it, then only grows with recent traffic.
+
+Archiving goes oldest id first and never moves the last message of a
+conversation (the inbox preview), so per conversation the archive always
+holds a prefix of the history and blocks never overlap. Readers page
+through the hot table first and continue into the archive once it runs
+out; see services.message_page, services.conversation_history and
+services.messages_since.
+"""
+import heapq
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+import orjson
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Max, Q, Sum
+
+from .models import Conversation, Message, MessageArchiveBlock
+
+COMPRESSION_LEVEL = 6
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _order(message):
+	return (message.timestamp, message.id)
+
+
+def _to_micros(timestamp):
+	return (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_micros(micros):
+	return _EPOCH + timedelta(microseconds=micros)
+
+
+def encode_messages(messages):
+	"""Compress messages into a block payload (rows of id, sender, recipient, time, content)."""
+	rows = [
+		[message.id, message.sender_id, message.recipient_id, _to_micros(message.timestamp), message.content]
+		for message in messages
+	]
+	return zlib.compress(orjson.dumps(rows), COMPRESSION_LEVEL)
+
+
+def decode_block(block):
+	"""Unsaved Message instances of `block`, oldest first."""
+	rows = orjson.loads(zlib.decompress(bytes(block.payload)))
+	return [
+		Message(id=row[0], sender_id=row[1], recipient_id=row[2], timestamp=_from_micros(row[3]), content=row[4])
+		for row in rows
+	]
+
+
+def _fill(block, messages):
+	messages = sorted(messages, key=_order)
+	block.first_id = min(message.id for message in messages)
+	block.last_id = max(message.id for message in messages)
+	block.first_timestamp = messages[0].timestamp
+	block.last_timestamp = messages[-1].timestamp
+	block.message_count = len(messages)
+	block.payload = encode_messages(messages)
+	return block
+
+
+def archive_batch(*, before, batch_size, block_size):
+	"""
+	Move up to `batch_size` of the oldest messages sent before `before`
+	into archive blocks, in one transaction. The newest block of a
+	conversation is topped up before new blocks are started, so blocks stay
+	full however small the batches. Returns the number of messages moved.
+	"""
+	with transaction.atomic():
+		# The last message of each conversation stays hot for the inbox
+		last_messages = Conversation.objects.filter(last_message__isnull=False).values('last_message_id')
+		messages = list(
+			Message.objects.filter(timestamp__lt=before)
+			.exclude(id__in=last_messages)
+			.order_by('id')[:batch_size]
+		)
+		if not messages:
+			return 0
+
+		by_pair = defaultdict(list)
+		for message in messages:
+			by_pair[Conversation.pair_for(message.sender_id, message.recipient_id)].append(message)
+
+		new_blocks = []
+		for (user_low_id, user_high_id), pending in by_pair.items():
+			pending.sort(key=_order)
+			newest = (
+				MessageArchiveBlock.objects.filter(user_low_id=user_low_id, user_high_id=user_high_id)
+				.order_by('-last_id')
+				.first()
+			)
+			if newest is not None and newest.message_count < block_size:
+				room = block_size - newest.message_count
+				_fill(newest, decode_block(newest) + pending[:room]).save()
+				pending = pending[room:]
+			for start in range(0, len(pending), block_size):
+				block = MessageArchiveBlock(user_low_id=user_low_id, user_high_id=user_high_id)
+				new_blocks.append(_fill(block, pending[start:start + block_size]))
+
+		MessageArchiveBlock.objects.bulk_create(new_blocks)
+		Message.objects.filter(id__in=[message.id for message in messages]).delete()
+	return len(messages)
+
+
+def _pair_blocks(user, other):
+	key = Conversation.pair_for(user.id, other.id)
+	return MessageArchiveBlock.objects.filter(user_low_id=key[0], user_high_id=key[1])
+
+
+def _attach_pair(messages, user, other):
+	users = {user.id: user, other.id: other}
+	for message in messages:
+		message.sender = users[message.sender_id]
+		message.recipient = users[message.recipient_id]
+	return messages
+
+
+def archived_count(*, user, other):
+	return _pair_blocks(user, other).aggregate(total=Sum('message_count'))['total'] or 0
+
+
+def newest_archived_id(*, user, other):
+	"""Id of the newest archived message of the conversation, or 0."""
+	return _pair_blocks(user, other).aggregate(newest=Max('last_id'))['newest'] or 0
+
+
+def archived_timestamp(*, user, other, message_id):
+	"""Timestamp of archived message `message_id` of this conversation, or None."""
+	for block in _pair_blocks(user, other).filter(first_id__lte=message_id, last_id__gte=message_id):
+		for message in decode_block(block):
+			if message.id == message_id:
+				return message.timestamp
+	return None
+
+
+def _with_payloads(blocks):
+	"""
+	Fill in the payloads of blocks read with defer('payload'), in one
+	query: blocks are picked from their metadata first, so only the ones
+	a read needs are fetched, without a query per block.
+	"""
+	payloads = dict(
+		MessageArchiveBlock.objects.filter(pk__in=[block.pk for block in blocks]).values_list('pk', 'payload')
+	)
+	for block in blocks:
+		block.payload = payloads[block.pk]
+	return blocks
+
+
+def _enough_blocks(blocks, limit):
+	"""
+	Leading blocks (in read order) that hold at least `limit` messages
+	past a cursor. Blocks of one conversation never overlap, so only the
+	first one can be partly on the wrong side of it.
+	"""
+	chosen = []
+	total = 0
+	for block in blocks:
+		if chosen and total >= limit:
+			break
+		chosen.append(block)
+		if len(chosen) > 1:
+			total += block.message_count
+	return chosen
+
+
+def archived_page(*, user, other, limit, before=None, after=None):
+	"""
+	Up to `limit` archived messages of the conversation on either side of
+	a (timestamp, id) key: the newest ones older than `before` (newest
+	first), or the oldest ones newer than `after` (oldest first). Only the
+	blocks the page needs are decoded, fetched with one query.
+	"""
+	blocks = _pair_blocks(user, other).defer('payload')
+	if after is not None:
+		blocks = blocks.filter(last_timestamp__gte=after[0]).order_by('last_id')
+	else:
+		if before is not None:
+			blocks = blocks.filter(first_timestamp__lte=before[0])
+		blocks = blocks.order_by('-last_id')
+
+	page = []
+	for block in _with_payloads(_enough_blocks(blocks, limit)):
+		messages = decode_block(block)
+		if after is not None:
+			page.extend(message for message in messages if _order(message) > after)
+		else:
+			page.extend(message for message in reversed(messages) if before is None or _order(message) < before)
+	return _attach_pair(page[:limit], user, other)
+
+
+def archived_history(*, user, other, offset=0, limit=None):
+	"""Archived messages of the conversation oldest first, sliced like a list."""
+	chosen = []
+	skipped = 0
+	collected = 0
+	for block in _pair_blocks(user, other).defer('payload').order_by('last_id'):
+		if not chosen and skipped + block.message_count <= offset:
+			skipped += block.message_count
+			continue
+		chosen.append(block)
+		collected += block.message_count
+		if limit is not None and collected >= offset - skipped + limit:
+			break
+
+	messages = []
+	for block in _with_payloads(chosen):
+		messages.extend(decode_block(block))
+	end = None if limit is None else offset - skipped + limit
+	return _attach_pair(messages[offset - skipped:end], user, other)
+
+
+def archived_since(*, user, after_id, limit):
+	"""
+	Up to `limit` archived messages `user` sent or received with an id
+	above `after_id`, oldest first. Blocks of different conversations
+	overlap in id, so blocks are taken in first_id order until at least
+	`limit` messages lie wholly above `after_id` and no later block can
+	start below the last id taken; their payloads then come in one query.
+	"""
+	blocks = (
+		MessageArchiveBlock.objects.filter(Q(user_low_id=user.id) | Q(user_high_id=user.id), last_id__gt=after_id)
+		.defer('payload')
+		.order_by('first_id')
+	)
+	chosen = []
+	above = 0
+	last_id = after_id
+	for block in blocks:
+		if above >= limit and block.first_id > last_id:
+			break
+		chosen.append(block)
+		last_id = max(last_id, block.last_id)
+		if block.first_id > after_id:
+			above += block.message_count
+
+	candidates = []
+	for block in _with_payloads(chosen):
+		candidates.extend(message for message in decode_block(block) if message.id > after_id)
+	candidates = heapq.nsmallest(limit, candidates, key=lambda message: message.id)
+
+	users = get_user_model().objects.only('id', 'username').in_bulk(
+		{message.sender_id for message in candidates} | {message.recipient_id for message in candidates}
+	)
+	for message in candidates:
+		message.sender = users[message.sender_id]
+		message.recipient = users[message.recipient_id]
+	return candidates
@@ -0,0 +1,58 @@
+"""
+Wire encodings for the chat websocket.
+
+JSON text frames (encoded with orjson) stay the default. A client can
+offer the MSGPACK_SUBPROTOCOL websocket subprotocol to get msgpack binary
+frames instead, which are smaller and cheaper to encode for the
+high-frequency status and typing events.
+"""
+import msgpack
+import orjson
+
+MSGPACK_SUBPROTOCOL = "plantapp.msgpack.v1"
+
+
+class JsonCodec:
+    subprotocol = None
+    decode_error = "Invalid JSON"
+
+    def encode(self, payload):
+        """Return the `send()` kwargs for `payload`."""
+        return {"text_data": orjson.dumps(payload).decode()}
+
+    def decode(self, text_data=None, bytes_data=None):
+        """Return the frame as a dict; raises ValueError on anything else."""
+        data = orjson.loads(text_data if text_data is not None else bytes_data)
+        if not isinstance(data, dict):
+            raise ValueError("Frame is not an object")
+        return data
+
+
+class MsgpackCodec:
+    subprotocol = MSGPACK_SUBPROTOCOL
+    decode_error = "Invalid msgpack frame"
+
+    def encode(self, payload):
+        return {"bytes_data": msgpack.packb(payload, use_bin_type=True)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            raise ValueError("Expected a binary frame")
+        try:
+            data = msgpack.unpackb(bytes_data, raw=False)
+        except Exception as exc:
+            raise ValueError(str(exc)) from exc
+        if not isinstance(data, dict):
+            raise ValueError("Frame is not a map")
+        return data
+
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec()
+
+
+def negotiate(subprotocols):
+    """Pick the codec for the subprotocols offered by the client."""
+    if MSGPACK_SUBPROTOCOL in (subprotocols or ()):
+        return MSGPACK
+    return JSON
@@ -1,18 +1,54 @@
-import json
 import logging
-import os
-import redis.asyncio as redis
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 from django.conf import settings
-from .models import Message, UserProfile
+from .codecs import negotiate
+from .message_buffer import save_chat_message
+from .middleware import AUTH_SUBPROTOCOL
+from .presence import (
+    broadcast_presence,
+    connection_closed,
+    connection_heartbeat,
+    connection_opened,
+    presence_audience,
+)
+from .redis_pool import get_redis
+from .services import mark_conversation_read, messages_since
+from .typing_indicator import TypingCoalescer
+from .unread_counters import load_counts, unread_total_async
+from .user_cache import resolve_username
 
 User = get_user_model()
 MAX_MESSAGE_LENGTH = 10000
+# A sync frame replays at most SYNC_MAX_MESSAGES, in chunks of SYNC_CHUNK_SIZE;
+# the client asks for the rest with the cursor from sync_complete
+SYNC_CHUNK_SIZE = 100
+SYNC_MAX_MESSAGES = 1000
 logger = logging.getLogger(__name__)
 
 
+def message_event(message):
+    """
+    The wire representation of a message, shared by live delivery and sync.
+    `message.sender` and `message.recipient` only need id and username.
+    """
+    return {
+        "id": message.id,
+        "sender": {
+            "id": message.sender.id,
+            "username": message.sender.username
+        },
+        "recipient": {
+            "id": message.recipient.id,
+            "username": message.recipient.username
+        },
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+        "is_read": message.is_read
+    }
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
     """
     WebSocket consumer for handling real-time chat messages.
@@ -25,6 +61,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
         """
         try:
             self.user = self.scope["user"]
+            offered_subprotocols = self.scope.get("subprotocols") or []
+            self.codec = negotiate(offered_subprotocols)
             
             logger.info(f"WebSocket connect attempt: user={getattr(self.user, 'username', 'Anonymous')}, authenticated={self.user.is_authenticated}")
 
@@ -34,6 +72,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.close()
                 return
 
+            self.typing = TypingCoalescer(self.send_typing_indicator)
+
             # Create a personal room for this user
             self.room_name = f"user_{self.user.id}"
             self.room_group_name = f"chat_{self.room_name}"
@@ -46,22 +86,29 @@ class ChatConsumer(AsyncWebsocketConsumer):
             )
             logger.info(f"User {self.user.username} added to group successfully")
 
-            await self.accept()
-            logger.info(f"WebSocket accepted for {self.user.username}")
-            logger.info(f"WebSocket connected: user_id={self.user.id}, username={self.user.username}, room_group={self.room_group_name}")
-
-            # Increment connection count and set online status if first connection
+            # Register the connection in the presence store before accepting,
+            # so the user is already online once the handshake completes
+            is_first = False
             try:
-                connection_count = await self.increment_user_connections(self.user.id)
+                connection_count, is_first = await self.increment_user_connections(self.user.id)
                 logger.info(f"User {self.user.username} connection count: {connection_count}")
-                if connection_count == 1:
-                    # First connection - set user online
-                    logger.info(f"Setting user {self.user.username} online (first connection)")
-                    await self.set_user_online(True)
-                else:
-                    logger.info(f"User {self.user.username} already has active connections, not updating status")
             except Exception as e:
                 logger.error(f"Error handling connection for user {self.user.username}: {e}", exc_info=True)
+
+            # Echo a subprotocol whenever the client offered one, or browsers drop the socket
+            subprotocol = self.codec.subprotocol
+            if subprotocol is None and AUTH_SUBPROTOCOL in offered_subprotocols:
+                subprotocol = AUTH_SUBPROTOCOL
+            await self.accept(subprotocol=subprotocol)
+            logger.info(f"WebSocket accepted for {self.user.username}")
+            logger.info(f"WebSocket connected: user_id={self.user.id}, username={self.user.username}, room_group={self.room_group_name}")
+
+            if is_first:
+                # First connection - tell friends the user came online
+                logger.info(f"Setting user {self.user.username} online (first connection)")
+                await self.set_user_online(True)
+            else:
+                logger.info(f"User {self.user.username} already has active connections, not updating status")
         except Exception as e:
             logger.error(f"Fatal error in WebSocket connect: {e}", exc_info=True)
             await self.close()
@@ -70,6 +117,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         """
         Called when the WebSocket closes for any reason.
         """
+        if hasattr(self, 'typing'):
+            # Recipients still showing "typing" get a final stop
+            await self.typing.close()
+
         if hasattr(self, 'room_group_name'):
             # Leave room group
             await self.channel_layer.group_discard(
@@ -81,20 +132,28 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if hasattr(self, 'user') and self.user and self.user.is_authenticated:
             logger.info(f"WebSocket disconnected: user_id={self.user.id}, username={self.user.username}, close_code={close_code}")
             # Decrement connection count and set offline only if last connection
-            connection_count = await self.decrement_user_connections(self.user.id)
+            connection_count, is_last = await self.decrement_user_connections(self.user.id)
             logger.info(f"User {self.user.username} connection count after disconnect: {connection_count}")
-            if connection_count == 0:
+            if is_last:
                 # Last connection closed - set user offline
                 logger.info(f"Setting user {self.user.username} offline (last connection closed)")
                 await self.set_user_online(False)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
-        Called when we get a text frame from the client.
+        Called when we get a frame from the client (text for JSON, binary
+        for msgpack).
         Expected format: {"type": "chat_message", "message": "...", "recipient_username": "..."}
         """
         try:
-            data = json.loads(text_data)
+            data = self.codec.decode(text_data, bytes_data)
+        except ValueError:
+            await self.send_event({
+                "error": self.codec.decode_error
+            })
+            return
+
+        try:
             message_type = data.get("type")
 
             if message_type == "chat_message":
@@ -103,24 +162,24 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.handle_typing_indicator(data)
             elif message_type == "read_receipt":
                 await self.handle_read_receipt(data)
+            elif message_type == "ping":
+                await self.handle_ping()
+            elif message_type == "sync":
+                await self.handle_sync(data)
             else:
-                await self.send(text_data=json.dumps({
+                await self.send_event({
                     "error": "Unknown message type"
-                }))
+                })
 
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
-                "error": "Invalid JSON"
-            }))
         except Exception as exc:
             logger.exception(
                 "Unexpected error in websocket receive for user_id=%s",
                 getattr(self.user, "id", None),
             )
             error_message = str(exc) if settings.DEBUG else "Internal server error"
-            await self.send(text_data=json.dumps({
+            await self.send_event({
                 "error": error_message
-            }))
+            })
 
     async def handle_chat_message(self, data):
         """
@@ -130,28 +189,35 @@ class ChatConsumer(AsyncWebsocketConsumer):
         recipient_username = data.get("recipient_username")
 
         if not isinstance(message_content, str) or not message_content.strip() or not recipient_username:
-            await self.send(text_data=json.dumps({
+            await self.send_event({
                 "error": "Message and recipient_username are required"
-            }))
+            })
             return
 
         if len(message_content) > MAX_MESSAGE_LENGTH:
-            await self.send(text_data=json.dumps({
+            await self.send_event({
                 "error": f"Message is too long (max {MAX_MESSAGE_LENGTH} characters)"
-            }))
+            })
             return
 
-        # Save message to database and get recipient
+        recipient = await self.get_user_by_username(recipient_username)
+        if not recipient:
+            await self.send_event({
+                "error": "Recipient not found"
+            })
+            return
+
+        # Save message to database
         result = await self.save_message(
             sender=self.user,
-            recipient_username=recipient_username,
+            recipient=recipient,
             content=message_content
         )
 
         if result.get("error"):
-            await self.send(text_data=json.dumps({
+            await self.send_event({
                 "error": result["error"]
-            }))
+            })
             return
 
         message_data = result["message"]
@@ -168,14 +234,79 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
         # Send confirmation back to sender
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             "type": "message_sent",
             "message": message_data
-        }))
+        })
+
+    async def handle_ping(self):
+        """
+        Client heartbeat - keep this connection alive in the presence store.
+        Connections that stop pinging are closed by the presence sweeper.
+        """
+        connection_count, is_first = await connection_heartbeat(
+            self.get_redis_client(), self.user.id, self.channel_name
+        )
+        if is_first:
+            # The sweeper had already given this connection up
+            logger.info(f"User {self.user.username} back online after missed heartbeats")
+            await self.set_user_online(True)
+
+        await self.send_event({
+            "type": "pong"
+        })
+
+    async def handle_sync(self, data):
+        """
+        Replay messages missed while disconnected.
+        Expected format: {"type": "sync", "after_id": <last message id seen>}
+
+        Messages the user sent or received after `after_id` are sent oldest
+        first as "sync_batch" frames of at most SYNC_CHUNK_SIZE, followed by
+        "sync_complete" carrying the cursor to resume from. One sync frame
+        replays at most SYNC_MAX_MESSAGES; when "has_more" is set the client
+        sends another sync with the returned cursor, so a long backlog is
+        pulled at the client's pace instead of being pushed all at once.
+
+        Group events for this connection wait until the replay is done, so
+        live messages always follow it. A message committed during the
+        replay can arrive both ways; clients dedupe by id.
+        """
+        after_id = data.get("after_id", 0)
+        if isinstance(after_id, bool) or not isinstance(after_id, int) or after_id < 0:
+            await self.send_event({
+                "error": "after_id must be a non-negative integer"
+            })
+            return
+
+        cursor = after_id
+        sent = 0
+        has_more = True
+        while has_more and sent < SYNC_MAX_MESSAGES:
+            chunk, has_more = await self.get_messages_since(
+                cursor, min(SYNC_CHUNK_SIZE, SYNC_MAX_MESSAGES - sent)
+            )
+            if not chunk:
+                break
+            cursor = chunk[-1]["id"]
+            sent += len(chunk)
+            await self.send_event({
+                "type": "sync_batch",
+                "messages": chunk,
+                "cursor": cursor
+            })
+
+        await self.send_event({
+            "type": "sync_complete",
+            "cursor": cursor,
+            "has_more": has_more
+        })
 
     async def handle_typing_indicator(self, data):
         """
         Handle typing indicator - notify recipient that sender is typing.
+        Frames are coalesced per recipient so only started/stopped
+        transitions reach the channel layer (see chat_app.typing_indicator).
         """
         recipient_username = data.get("recipient_username")
         is_typing = data.get("is_typing", True)
@@ -187,7 +318,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if not recipient:
             return
 
-        recipient_room_group = f"chat_user_{recipient.id}"
+        self.typing.update(recipient.id, is_typing)
+
+    async def send_typing_indicator(self, recipient_id, is_typing):
+        """
+        Deliver one coalesced typing transition to the recipient's room.
+        """
+        recipient_room_group = f"chat_user_{recipient_id}"
         await self.channel_layer.group_send(
             recipient_room_group,
             {
@@ -206,303 +343,184 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if not sender_username:
             return
 
+        sender = await self.get_user_by_username(sender_username)
+        if not sender:
+            return
+
         await self.mark_messages_as_read(
-            sender_username=sender_username,
+            sender=sender,
             recipient=self.user
         )
 
         # Notify sender that messages were read
-        sender = await self.get_user_by_username(sender_username)
-        if sender:
-            sender_room_group = f"chat_user_{sender.id}"
-            await self.channel_layer.group_send(
-                sender_room_group,
-                {
-                    "type": "read_receipt_handler",
-                    "reader_username": self.user.username
-                }
-            )
+        sender_room_group = f"chat_user_{sender.id}"
+        await self.channel_layer.group_send(
+            sender_room_group,
+            {
+                "type": "read_receipt_handler",
+                "reader_username": self.user.username
+            }
+        )
+
+    async def send_event(self, payload):
+        """
+        Encode `payload` with the codec negotiated in connect() (JSON text
+        frames by default, msgpack binary frames for plantapp.msgpack.v1).
+        """
+        await self.send(**self.codec.encode(payload))
 
     # Handler methods for group_send events
     async def chat_message_handler(self, event):
         """
-        Called when a message is sent to this user's group.
+        Called when a message is sent to this user's group. Carries the
+        user's new unread total, read from the Redis counters.
         """
         message = event["message"]
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             "type": "new_message",
-            "message": message
-        }))
+            "message": message,
+            "unread_count": await self.get_unread_total()
+        })
 
     async def typing_indicator_handler(self, event):
         """
         Called when someone sends a typing indicator.
         """
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             "type": "typing",
             "username": event["username"],
             "is_typing": event["is_typing"]
-        }))
+        })
 
     async def read_receipt_handler(self, event):
         """
         Called when recipient reads messages.
         """
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             "type": "read_receipt",
             "reader_username": event["reader_username"]
-        }))
+        })
 
     async def status_update_handler(self, event):
         """
         Called when a friend's online status changes.
         """
         logger.info(f"Sending status update to client: user_id={event['user_id']}, is_online={event['is_online']}")
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             "type": "status_update",
             "user_id": event["user_id"],
             "is_online": event["is_online"]
-        }))
+        })
 
     # Database operations wrapped with database_sync_to_async
-    @database_sync_to_async
-    def save_message(self, sender, recipient_username, content):
+    async def save_message(self, sender, recipient, content):
         """
-        Save a new message to the database.
+        Save a new message through the worker's group-commit buffer (see
+        chat_app.message_buffer). Returns once the message is committed.
+        `recipient` is a resolved CachedUser (see chat_app.user_cache).
         """
         try:
-            recipient = User.objects.get(username=recipient_username)
-            message = Message.objects.create(
+            message = await save_chat_message(
                 sender=sender,
-                recipient=recipient,
+                recipient=User(id=recipient.id, username=recipient.username),
                 content=content
             )
 
             return {
-                "message": {
-                    "id": message.id,
-                    "sender": {
-                        "id": sender.id,
-                        "username": sender.username
-                    },
-                    "recipient": {
-                        "id": recipient.id,
-                        "username": recipient.username
-                    },
-                    "content": message.content,
-                    "timestamp": message.timestamp.isoformat(),
-                    "is_read": message.is_read
-                },
+                "message": message_event(message),
                 "recipient_id": recipient.id
             }
-        except User.DoesNotExist:
-            return {"error": "Recipient not found"}
         except Exception as exc:
             logger.exception(
-                "Failed to save chat message from sender_id=%s to recipient_username=%s",
+                "Failed to save chat message from sender_id=%s to recipient_id=%s",
                 getattr(sender, "id", None),
-                recipient_username,
+                recipient.id,
             )
             if settings.DEBUG:
                 return {"error": str(exc)}
             return {"error": "Could not send message"}
 
     @database_sync_to_async
-    def get_user_by_username(self, username):
+    def get_messages_since(self, after_id, limit):
         """
-        Get user by username.
+        Up to `limit` messages of the current user newer than `after_id`,
+        as wire dicts. Returns (messages, has_more).
         """
-        try:
-            return User.objects.get(username=username)
-        except User.DoesNotExist:
-            return None
+        messages, has_more = messages_since(user=self.user, after_id=after_id, limit=limit)
+        return [message_event(message) for message in messages], has_more
 
-    @database_sync_to_async
-    def mark_messages_as_read(self, sender_username, recipient):
+    async def get_unread_total(self):
         """
-        Mark all messages from sender to recipient as read.
+        Unread total of the current user: one HGET on the counters, with
+        a rebuild from the database only when they are not loaded.
         """
-        try:
-            sender = User.objects.get(username=sender_username)
-            Message.objects.filter(
-                sender=sender,
-                recipient=recipient,
-                is_read=False
-            ).update(is_read=True)
-        except User.DoesNotExist:
-            pass
+        return await unread_total_async(
+            self.get_redis_client(), self.user.id, database_sync_to_async(load_counts)
+        )
 
-    @database_sync_to_async
-    def update_user_status(self, is_online):
+    async def get_user_by_username(self, username):
         """
-        Update user's online status in User model.
+        Resolve a username to (id, username) through the shared cache,
+        usually without a database round trip. Returns None if unknown.
         """
-        try:
-            logger.info(f"Updating user {self.user.username} status to {'online' if is_online else 'offline'}")
-            self.user.is_online = is_online
-            self.user.save(update_fields=['is_online'])
-            logger.info(f"Successfully updated user {self.user.username} status")
-        except Exception as e:
-            logger.error(f"Failed to update user status for {self.user.username}: {e}", exc_info=True)
+        return await resolve_username(username)
 
     @database_sync_to_async
-    def get_user_online_status(self, user_id):
+    def mark_messages_as_read(self, sender, recipient):
         """
-        Get user's online status from database.
+        Mark all messages from sender to recipient as read.
         """
-        try:
-            user = User.objects.get(id=user_id)
-            return user.is_online
-        except User.DoesNotExist:
-            return False
+        mark_conversation_read(reader=recipient, other=sender)
 
     async def set_user_online(self, is_online):
         """
-        Set user online status and broadcast to all friends.
+        Broadcast a presence transition to all friends. The presence store
+        itself is updated atomically by increment/decrement_user_connections
+        and flushed to the database in batches (see chat_app.presence).
         """
-        # Update database
-        await self.update_user_status(is_online)
-        # Broadcast status change to all friends
         try:
             await self.broadcast_status_to_friends(is_online)
         except Exception as e:
             logger.error(f"Failed to broadcast status for {self.user.username}: {e}", exc_info=True)
 
-    @database_sync_to_async
-    def get_user_friends(self):
-        """
-        Get all friends of the current user (mutual connections).
-        """
-        try:
-            return list(self.user.get_friends().values_list('id', flat=True))
-        except Exception:
-            return []
-
     @database_sync_to_async
     def get_all_connected_users(self):
         """
-        Get all users connected to this user:
-        - Mutual friends
-        - Users who sent friend requests to this user
-        - Users this user sent friend requests to
+        Get all users connected to this user (friends + pending requests
+        in both directions) in a single query.
         """
         try:
-            user_ids = set()
-
-            # Mutual friends
-            mutual_friends = self.user.get_friends().values_list('id', flat=True)
-            user_ids.update(mutual_friends)
-
-            # Users who follow this user (sent requests)
-            followers = self.user.followers.all().values_list('id', flat=True)
-            user_ids.update(followers)
-
-            # Users this user follows (sent requests to)
-            following = self.user.following.all().values_list('id', flat=True)
-            user_ids.update(following)
-
-            return list(user_ids)
+            return presence_audience(self.user.id)
         except Exception:
-            return []
+            return set()
 
     async def broadcast_status_to_friends(self, is_online):
         """
         Broadcast status update to all connected users (friends + pending requests).
+        The group sends run concurrently with bounded parallelism.
         """
         user_ids = await self.get_all_connected_users()
-        
+
         logger.info(f"Broadcasting {self.user.username} status ({'online' if is_online else 'offline'}) to {len(user_ids)} connected users")
-        
-        for user_id in user_ids:
-            # Use same format as connect(): room_group_name = f"chat_user_{user_id}"
-            user_room_group = f"chat_user_{user_id}"
-            await self.channel_layer.group_send(
-                user_room_group,
-                {
-                    "type": "status_update_handler",
-                    "user_id": self.user.id,
-                    "is_online": is_online
-                }
-            )
-            logger.debug(f"Sent status update to user {user_id} in group {user_room_group}")
+
+        await broadcast_presence(self.channel_layer, self.user.id, is_online, user_ids)
 
     def get_redis_client(self):
         """
-        Get Redis client from channel layer configuration.
+        Get a Redis client backed by the worker's shared connection pool.
         """
-        try:
-            # Get Redis configuration from Django settings
-            channel_layers_config = settings.CHANNEL_LAYERS.get('default', {}).get('CONFIG', {})
-            hosts = channel_layers_config.get('hosts', [])
-            
-            if hosts and isinstance(hosts[0], (tuple, list)) and len(hosts[0]) == 2:
-                host, port = hosts[0]
-                return redis.Redis(host=host, port=int(port), decode_responses=True)
-            
-            # Fallback: try to get from environment or use defaults
-            host = os.getenv('REDIS_HOST', 'redis')
-            port = int(os.getenv('REDIS_PORT', '6379'))
-            return redis.Redis(host=host, port=port, decode_responses=True)
-        except Exception as e:
-            logger.error(f"Error creating Redis client: {e}", exc_info=True)
-            # Ultimate fallback
-            return redis.Redis(host='redis', port=6379, decode_responses=True)
+        return get_redis()
 
     async def increment_user_connections(self, user_id):
         """
-        Increment the connection count for a user.
-        Returns the new count.
+        Atomically register this connection (keyed by channel name) for a user.
+        Returns (count, is_first_connection).
         """
-        redis_client = self.get_redis_client()
-        try:
-            key = f"user_connections:{user_id}"
-            
-            # Check if key exists and validate its value
-            existing = await redis_client.get(key)
-            if existing is not None:
-                try:
-                    existing_count = int(existing)
-                    
-                    # Get user's actual database online status
-                    db_is_online = await self.get_user_online_status(user_id)
-                    
-                    # If user is offline in DB but has Redis connections, reset
-                    if not db_is_online and existing_count > 0:
-                        logger.warning(f"User {user_id} is offline in DB but has {existing_count} Redis connections, resetting")
-                        await redis_client.set(key, 0)
-                    # If count is suspiciously high, reset it
-                    elif existing_count > 10:
-                        logger.warning(f"Resetting suspicious connection count for user {user_id}: {existing_count}")
-                        await redis_client.set(key, 0)
-                except (ValueError, TypeError):
-                    logger.warning(f"Invalid connection count for user {user_id}, resetting")
-                    await redis_client.set(key, 0)
-            
-            count = await redis_client.incr(key)
-            # Set expiry to 1 hour (shorter TTL to auto-cleanup stale data)
-            await redis_client.expire(key, 3600)
-            return count
-        finally:
-            await redis_client.aclose()
+        return await connection_opened(self.get_redis_client(), user_id, self.channel_name)
 
     async def decrement_user_connections(self, user_id):
         """
-        Decrement the connection count for a user.
-        Returns the new count (minimum 0).
+        Atomically drop this connection for a user.
+        Returns (count, is_last_connection).
         """
-        redis_client = self.get_redis_client()
-        try:
-            key = f"user_connections:{user_id}"
-            count = await redis_client.decr(key)
-            if count < 0:
-                await redis_client.set(key, 0)
-                return 0
-            # Refresh expiry on decrement too
-            if count > 0:
-                await redis_client.expire(key, 3600)
-            else:
-                # Count reached 0, delete the key to free memory
-                await redis_client.delete(key)
-            return count
-        finally:
-            await redis_client.aclose()
+        return await connection_closed(self.get_redis_client(), user_id, self.channel_name)
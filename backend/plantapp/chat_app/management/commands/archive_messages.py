@@ -0,0 +1,38 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat_app.archive import archive_batch
+
+
+class Command(BaseCommand):
+    help = 'Move old chat messages into the compressed archive tier in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=settings.CHAT_ARCHIVE['after_days'])
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_ARCHIVE['batch_size'],
+                            help='Messages moved per transaction')
+        parser.add_argument('--block-size', type=int, default=settings.CHAT_ARCHIVE['block_size'],
+                            help='Messages per archive block')
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help='Seconds to sleep between batches so live writers get the database')
+        parser.add_argument('--max-batches', type=int, default=None)
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['older_than_days'])
+        self.stdout.write(self.style.WARNING(f'Archiving messages sent before {before.isoformat()}...'))
+
+        total = batches = 0
+        while options['max_batches'] is None or batches < options['max_batches']:
+            moved = archive_batch(before=before, batch_size=options['batch_size'], block_size=options['block_size'])
+            if not moved:
+                break
+            total += moved
+            batches += 1
+            self.stdout.write(f'Batch {batches}: archived {moved} messages')
+            time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS(f'✓ Archived {total} messages in {batches} batches'))
@@ -0,0 +1,102 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Window
+from django.db.models.functions import Greatest, Least, RowNumber
+
+from chat_app.archive import decode_block
+from chat_app.models import Conversation, Message, MessageArchiveBlock
+from chat_app.unread_counters import forget_all
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the Conversation summary table from existing message history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.WARNING('Rebuilding conversation summaries...'))
+
+        # Latest message of every ordered participant pair, in one query
+        low = Least('sender_id', 'recipient_id')
+        high = Greatest('sender_id', 'recipient_id')
+        latest = (
+            Message.objects.annotate(
+                user_low_id=low,
+                user_high_id=high,
+                row_number=Window(
+                    RowNumber(),
+                    partition_by=[low, high],
+                    order_by=[F('timestamp').desc(), F('id').desc()],
+                ),
+            )
+            .filter(row_number=1)
+            .values_list('id', 'user_low_id', 'user_high_id', 'timestamp')
+        )
+
+        # Read watermarks are the only copy of read state: keep them, keyed
+        # by (reader, other), and recount unread messages above them
+        watermarks, existing = {}, {}
+        for conversation_id, user_low_id, user_high_id, read_low, read_high in Conversation.objects.values_list(
+            'id', 'user_low_id', 'user_high_id', 'read_low', 'read_high'
+        ).iterator():
+            existing[(user_low_id, user_high_id)] = conversation_id
+            watermarks[(user_low_id, user_high_id)] = read_low
+            watermarks[(user_high_id, user_low_id)] = read_high
+
+        unread = Counter()
+        for sender_id, recipient_id, message_id in Message.objects.values_list(
+            'sender_id', 'recipient_id', 'id'
+        ).iterator():
+            if message_id > watermarks.get((recipient_id, sender_id), 0):
+                unread[(sender_id, recipient_id)] += 1
+        # Old messages may have been archived unread, and a conversation
+        # whose hot messages are all gone is known only from its blocks
+        archived = {}
+        for block in MessageArchiveBlock.objects.iterator():
+            pair = (block.user_low_id, block.user_high_id)
+            if pair not in archived or block.last_id > archived[pair][0]:
+                archived[pair] = (block.last_id, block.last_timestamp)
+            for message in decode_block(block):
+                if message.id > watermarks.get((message.recipient_id, message.sender_id), 0):
+                    unread[(message.sender_id, message.recipient_id)] += 1
+
+        latest = {
+            (user_low_id, user_high_id): (message_id, timestamp)
+            for message_id, user_low_id, user_high_id, timestamp in latest.iterator()
+        }
+        for pair, (_, timestamp) in archived.items():
+            # Archived messages are no longer rows a summary can point to
+            latest.setdefault(pair, (None, timestamp))
+
+        conversations = [
+            Conversation(
+                user_low_id=user_low_id,
+                user_high_id=user_high_id,
+                last_message_id=message_id,
+                last_timestamp=timestamp,
+                unread_low=unread[(user_high_id, user_low_id)],
+                unread_high=unread[(user_low_id, user_high_id)] if user_low_id != user_high_id else 0,
+            )
+            for (user_low_id, user_high_id), (message_id, timestamp) in latest.items()
+        ]
+
+        with transaction.atomic():
+            # Rows are upserted so their read watermarks stay as they are;
+            # only summaries of pairs with no history left are removed
+            stale = [conversation_id for pair, conversation_id in existing.items() if pair not in latest]
+            deleted, _ = Conversation.objects.filter(id__in=stale).delete()
+            Conversation.objects.bulk_create(
+                conversations,
+                batch_size=options['batch_size'],
+                update_conflicts=True,
+                unique_fields=['user_low', 'user_high'],
+                update_fields=['last_message', 'last_timestamp', 'unread_low', 'unread_high'],
+            )
+        # The Redis counters mirror the old rows; they reload on next read
+        forget_all()
+
+        self.stdout.write(self.style.SUCCESS(f'✓ Removed {deleted} summaries without messages'))
+        self.stdout.write(self.style.SUCCESS(f'✓ Upserted {len(conversations)} conversation summaries'))
@@ -0,0 +1,69 @@
+import statistics
+import time
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from chat_app.models import Message
+from chat_app.services import build_inbox
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the inbox query (query count and latency) on a seeded dataset'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--conversations', type=int, default=500)
+        parser.add_argument('--messages', type=int, default=20, help='Messages per conversation')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--limit', type=int, default=None, help='Page size (default: whole inbox)')
+
+    def handle(self, *args, **options):
+        # Everything runs inside one transaction that is rolled back at the end,
+        # so the benchmark never leaves seeded rows in the database.
+        with transaction.atomic():
+            owner = self.seed(options)
+            self.measure(owner, options)
+            transaction.set_rollback(True)
+
+    def seed(self, options):
+        self.stdout.write(self.style.WARNING(
+            f"Seeding {options['users']} users and {options['conversations']} conversations..."
+        ))
+        users = User.objects.bulk_create(
+            User(username=f'bench_inbox_{i}', email=f'bench_inbox_{i}@example.com', password='!')
+            for i in range(options['users'])
+        )
+        owner, others = users[0], users[1:options['conversations'] + 1]
+
+        batch = []
+        for other in others:
+            for i in range(options['messages']):
+                sender, recipient = (owner, other) if i % 2 else (other, owner)
+                batch.append(Message(sender=sender, recipient=recipient, content=f'message {i}'))
+        Message.objects.bulk_create(batch, batch_size=2000)
+        # bulk_create skips post_save, so build the summaries in one pass
+        call_command('backfill_conversations', stdout=StringIO())
+        return owner
+
+    def measure(self, owner, options):
+        timings = []
+        with CaptureQueriesContext(connection) as ctx:
+            entries, _ = build_inbox(user=owner, limit=options['limit'])
+        queries = len(ctx.captured_queries)
+
+        for _ in range(options['iterations']):
+            start = time.perf_counter()
+            build_inbox(user=owner, limit=options['limit'])
+            timings.append((time.perf_counter() - start) * 1000)
+
+        self.stdout.write('=' * 60)
+        self.stdout.write(f'Conversations returned: {len(entries)}')
+        self.stdout.write(f'Queries per inbox load: {queries}')
+        self.stdout.write(f'Median latency: {statistics.median(timings):.2f} ms')
+        self.stdout.write(f'Max latency:    {max(timings):.2f} ms')
+        self.stdout.write('=' * 60)
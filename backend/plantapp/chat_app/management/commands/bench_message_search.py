@@ -0,0 +1,88 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from chat_app.models import Message
+from chat_app.search import search_available, search_messages
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark message search latency for one user as the rest of the '
+        'database fills up with other users\' messages using the same words'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--own-messages', type=int, default=200)
+        parser.add_argument(
+            '--traffic', type=int, nargs='+', default=[0, 100000, 1000000],
+            help='Amounts of other users\' messages to measure at, ascending',
+        )
+        parser.add_argument('--pairs', type=int, default=1000, help='Other conversations the traffic is spread over')
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--limit', type=int, default=20)
+
+    def handle(self, *args, **options):
+        if not search_available():
+            raise CommandError('Message search needs the SQLite FTS5 index')
+        # Seeded rows are rolled back at the end, like the other benchmarks
+        with transaction.atomic():
+            owner, friend, others = self.seed_users(options)
+            Message.objects.bulk_create(
+                [
+                    Message(sender=owner if i % 2 else friend, recipient=friend if i % 2 else owner,
+                            content=f'watering the garden {i}')
+                    for i in range(options['own_messages'])
+                ],
+                batch_size=2000,
+            )
+            self.stdout.write('=' * 60)
+            seeded = 0
+            for traffic in sorted(options['traffic']):
+                self.seed_traffic(others, seeded, traffic, options)
+                seeded = max(seeded, traffic)
+                self.measure(owner, friend, seeded, options)
+            self.stdout.write('=' * 60)
+            transaction.set_rollback(True)
+
+    def seed_users(self, options):
+        users = User.objects.bulk_create(
+            User(username=f'bench_search_{i}', email=f'bench_search_{i}@example.com', password='!')
+            for i in range(options['pairs'] * 2 + 2)
+        )
+        return users[0], users[1], users[2:]
+
+    def seed_traffic(self, others, start, end, options):
+        if end <= start:
+            return
+        self.stdout.write(self.style.WARNING(f'Seeding other users\' messages up to {end}...'))
+        batch = []
+        for i in range(start, end):
+            pair = i % options['pairs']
+            batch.append(Message(
+                sender=others[pair * 2], recipient=others[pair * 2 + 1], content=f'watering the garden {i}'
+            ))
+            if len(batch) == 5000:
+                Message.objects.bulk_create(batch)
+                batch = []
+        Message.objects.bulk_create(batch)
+
+    def measure(self, owner, friend, traffic, options):
+        results = {}
+        for label, query, other in (
+            ('word', 'watering', None),
+            ('prefix', 'gard', None),
+            ('long prefix', 'waterin', None),
+            ('conversation', 'garden', friend),
+        ):
+            hits, _ = search_messages(user=owner, query=query, other=other, limit=options['limit'])
+            timings = []
+            for _ in range(options['iterations']):
+                start = time.perf_counter()
+                search_messages(user=owner, query=query, other=other, limit=options['limit'])
+                timings.append((time.perf_counter() - start) * 1000)
+            results[label] = f'{label} {statistics.median(timings):.2f} ms ({len(hits)} hits)'
+        self.stdout.write(f'{traffic:>9} other messages: ' + '  '.join(results.values()))
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat_app.message_buffer import MessageBuffer
+from chat_app.services import record_message
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = 'Benchmark chat message persistence: one commit per message vs group commit'
+
+    def add_arguments(self, parser):
+        config = settings.CHAT_MESSAGE_BUFFER
+        parser.add_argument('--senders', type=int, default=50, help='Concurrent senders')
+        parser.add_argument('--messages', type=int, default=20, help='Messages per sender')
+        parser.add_argument('--window-ms', type=float, default=config['flush_window_ms'])
+        parser.add_argument('--max-batch', type=int, default=config['max_batch'])
+
+    def handle(self, *args, **options):
+        # Writes go through worker threads like in the consumer, so the run
+        # cannot be wrapped in a rolled-back transaction; the bench users are
+        # deleted afterwards and their messages cascade.
+        User.objects.bulk_create(
+            User(username=f'bench_writes_{i}', email=f'bench_writes_{i}@example.com', password='!')
+            for i in range(options['senders'] + 1)
+        )
+        users = list(User.objects.filter(username__startswith='bench_writes_').order_by('id'))
+        try:
+            recipient, senders = users[0], users[1:]
+            total = len(senders) * options['messages']
+
+            direct = async_to_sync(self.run)(senders, recipient, options, self.save_direct)
+            buffer = MessageBuffer(options['window_ms'], options['max_batch'])
+            grouped = async_to_sync(self.run)(senders, recipient, options, self.buffered(buffer))
+        finally:
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        self.stdout.write('=' * 60)
+        self.stdout.write(f"Messages: {total} ({len(senders)} senders x {options['messages']})")
+        self.stdout.write(f'Per-message commit: {total / direct:10.0f} msgs/sec')
+        self.stdout.write(
+            f"Group commit:       {total / grouped:10.0f} msgs/sec "
+            f"(window {options['window_ms']} ms, max batch {options['max_batch']})"
+        )
+        self.stdout.write(f'Speedup: {direct / grouped:.1f}x')
+        self.stdout.write('=' * 60)
+
+    async def save_direct(self, sender, recipient, content):
+        return await database_sync_to_async(record_message)(sender=sender, recipient=recipient, content=content)
+
+    def buffered(self, buffer):
+        async def save(sender, recipient, content):
+            return await buffer.submit(sender=sender, recipient=recipient, content=content)
+        return save
+
+    async def run(self, senders, recipient, options, save):
+        async def sender_loop(sender):
+            for i in range(options['messages']):
+                await save(sender, recipient, f'bench message {i}')
+
+        start = time.perf_counter()
+        await asyncio.gather(*(sender_loop(sender) for sender in senders))
+        return time.perf_counter() - start
@@ -0,0 +1,53 @@
+import statistics
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from chat_app.presence import FANOUT_CONCURRENCY, broadcast_presence
+
+
+class Command(BaseCommand):
+    help = 'Benchmark presence fan-out latency (serial vs bounded-concurrent group_send) on the channel layer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, nargs='+', default=[10, 100, 1000])
+        parser.add_argument('--iterations', type=int, default=5)
+        parser.add_argument('--concurrency', type=int, default=FANOUT_CONCURRENCY)
+
+    def handle(self, *args, **options):
+        layer = get_channel_layer()
+        self.stdout.write(f'Channel layer: {layer.__class__.__name__}')
+        self.stdout.write('=' * 60)
+        self.stdout.write(f"{'recipients':>10} {'serial ms':>12} {'concurrent ms':>14} {'speedup':>8}")
+        for count in options['recipients']:
+            serial, concurrent = async_to_sync(self.measure)(layer, count, options)
+            self.stdout.write(f'{count:>10} {serial:>12.2f} {concurrent:>14.2f} {serial / concurrent:>7.1f}x')
+        self.stdout.write('=' * 60)
+
+    async def measure(self, layer, count, options):
+        # Fake recipient ids far above real ones, each with one subscribed channel
+        recipient_ids = [10_000_000 + i for i in range(count)]
+        channels = {}
+        for rid in recipient_ids:
+            channels[rid] = await layer.new_channel()
+            await layer.group_add(f'chat_user_{rid}', channels[rid])
+
+        event = {"type": "status_update_handler", "user_id": 0, "is_online": True}
+        serial, concurrent = [], []
+        try:
+            for _ in range(options['iterations']):
+                start = time.perf_counter()
+                for rid in recipient_ids:
+                    await layer.group_send(f'chat_user_{rid}', event)
+                serial.append((time.perf_counter() - start) * 1000)
+
+                start = time.perf_counter()
+                await broadcast_presence(layer, 0, True, recipient_ids, concurrency=options['concurrency'])
+                concurrent.append((time.perf_counter() - start) * 1000)
+        finally:
+            for rid, channel in channels.items():
+                await layer.group_discard(f'chat_user_{rid}', channel)
+
+        return statistics.median(serial), statistics.median(concurrent)
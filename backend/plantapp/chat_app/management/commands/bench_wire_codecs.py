@@ -0,0 +1,59 @@
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from chat_app.codecs import JSON, MSGPACK
+
+
+class StdlibJsonCodec:
+    """The encoding the consumer used before chat_app.codecs, for comparison."""
+
+    def encode(self, payload):
+        return {"text_data": json.dumps(payload)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        return json.loads(text_data)
+
+
+SAMPLE_MESSAGE = {
+    "id": 123456,
+    "sender": {"id": 42, "username": "plant_lover"},
+    "recipient": {"id": 43, "username": "fern_fan"},
+    "content": "Did you water the monstera today? It looked a bit droopy this morning.",
+    "timestamp": "2026-10-18T09:15:27.123456+00:00",
+    "is_read": False,
+}
+
+EVENTS = {
+    "new_message": {"type": "new_message", "message": SAMPLE_MESSAGE},
+    "message_sent": {"type": "message_sent", "message": SAMPLE_MESSAGE},
+    "status_update": {"type": "status_update", "user_id": 42, "is_online": True},
+    "typing": {"type": "typing", "username": "plant_lover", "is_typing": True},
+    "read_receipt": {"type": "read_receipt", "reader_username": "fern_fan"},
+    "pong": {"type": "pong"},
+}
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmark per-frame encode/decode cost and frame size of the websocket codecs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=20000, help='Frames per measurement')
+
+    def handle(self, *args, **options):
+        codecs = {"json (stdlib)": StdlibJsonCodec(), "json (orjson)": JSON, "msgpack": MSGPACK}
+        number = options['number']
+
+        self.stdout.write('=' * 76)
+        self.stdout.write(f"{'event':<14} {'codec':<14} {'bytes':>6} {'encode ns':>10} {'decode ns':>10}")
+        for event, payload in EVENTS.items():
+            for name, codec in codecs.items():
+                frame = codec.encode(payload)
+                data = frame.get("text_data")
+                size = len(data.encode()) if data is not None else len(frame["bytes_data"])
+
+                encode = timeit.timeit(lambda: codec.encode(payload), number=number) / number * 1e9
+                decode = timeit.timeit(lambda: codec.decode(**frame), number=number) / number * 1e9
+                self.stdout.write(f'{event:<14} {name:<14} {size:>6} {encode:>10.0f} {decode:>10.0f}')
+        self.stdout.write('=' * 76)
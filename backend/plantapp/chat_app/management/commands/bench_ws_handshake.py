@@ -0,0 +1,84 @@
+import time
+
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat_app import middleware
+from chat_app.middleware import AUTH_SUBPROTOCOL, JwtAuthMiddlewareStack
+from chat_app.routing import websocket_urlpatterns
+from users.models import User
+
+
+async def accept_immediately(scope, receive, send):
+    """Minimal websocket app: accept if authenticated, then wait for the close."""
+    await receive()
+    if scope["user"].is_authenticated:
+        await send({"type": "websocket.accept"})
+    else:
+        await send({"type": "websocket.close"})
+    await receive()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark websocket handshake throughput with a cold and a warm JWT user cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--handshakes', type=int, default=200)
+        parser.add_argument('--username', default='bench_handshake')
+
+    def handle(self, *args, **options):
+        user, created = User.objects.get_or_create(
+            username=options['username'],
+            defaults={'email': f"{options['username']}@example.com"},
+        )
+        token = str(AccessToken.for_user(user))
+        # "auth only" runs the middleware in front of an app that accepts
+        # immediately, isolating the cost the user cache removes; "full"
+        # also pays for the consumer's connect/disconnect (presence, groups).
+        applications = {
+            'auth only': JwtAuthMiddlewareStack(accept_immediately),
+            'full': JwtAuthMiddlewareStack(URLRouter(websocket_urlpatterns)),
+        }
+        try:
+            results = {}
+            for scope_label, application in applications.items():
+                for label, cold in (('cold cache', True), ('warm cache', False)):
+                    for transport in ('query string', 'subprotocol'):
+                        elapsed = async_to_sync(self.run)(application, token, transport, cold, options['handshakes'])
+                        results[(scope_label, label, transport)] = elapsed
+        finally:
+            if created:
+                user.delete()
+
+        self.stdout.write('=' * 60)
+        for (scope_label, label, transport), elapsed in results.items():
+            rate = options['handshakes'] / elapsed
+            self.stdout.write(f'{scope_label:<10} {label:<11} {transport:<13} {rate:8.0f} handshakes/sec')
+        self.stdout.write('=' * 60)
+
+    async def run(self, application, token, transport, cold, count):
+        if transport == 'subprotocol':
+            path, subprotocols = '/ws/chat/', [AUTH_SUBPROTOCOL, token]
+        else:
+            path, subprotocols = f'/ws/chat/?token={token}', None
+
+        # Warm the cache once so the warm runs never hit the database
+        middleware._user_cache.clear()
+        await self.handshake(application, path, subprotocols)
+
+        start = time.perf_counter()
+        for _ in range(count):
+            if cold:
+                middleware._user_cache.clear()
+            await self.handshake(application, path, subprotocols)
+        return time.perf_counter() - start
+
+    async def handshake(self, application, path, subprotocols):
+        communicator = WebsocketCommunicator(application, path, subprotocols=subprotocols)
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise RuntimeError('Handshake was rejected')
+        await communicator.disconnect()
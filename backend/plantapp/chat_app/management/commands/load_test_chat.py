@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import Counter
+
+import orjson
+import redis
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat_app.middleware import AUTH_SUBPROTOCOL
+from chat_app.models import Conversation, Message
+from chat_app.redis_pool import get_sync_redis
+from chat_app.unread_counters import unread_key
+from users.models import User
+
+ACTIONS = ('chat', 'typing', 'read')
+MARKER = 'loadtest'
+# Conversation columns the run changes, restored by the cleanup
+SUMMARY_FIELDS = ['last_message', 'last_timestamp', 'unread_low', 'unread_high', 'read_low', 'read_high']
+logger = logging.getLogger(__name__)
+
+
+def parse_mix(value):
+    """'chat=70,typing=20,read=10' -> {'chat': 70, 'typing': 20, 'read': 10}"""
+    mix = {}
+    for part in value.split(','):
+        action, _, weight = part.partition('=')
+        action = action.strip()
+        if action not in ACTIONS:
+            raise CommandError(f"Unknown action {action!r} in --mix (expected {', '.join(ACTIONS)})")
+        try:
+            mix[action] = float(weight)
+        except ValueError:
+            raise CommandError(f'Invalid weight {weight!r} for {action} in --mix')
+    if not any(weight > 0 for weight in mix.values()):
+        raise CommandError('--mix needs at least one positive weight')
+    return mix
+
+
+def summarize(samples):
+    """Latency summary in milliseconds (nearest-rank percentiles)."""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': round(ordered[-1] * 1000, 3),
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.connect = []
+        self.delivery = []
+        self.frames_sent = Counter()
+        self.frames_received = Counter()
+        self.sent_at = {}
+        self.errors = 0
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test the chat consumer in-process: N simulated clients connect to '
+        'mysite.asgi.application with real JWTs and run a chat/typing/read-receipt '
+        'mix. Clients and consumers share this process, so treat the numbers as a '
+        'lower bound for one worker and compare runs against each other.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50)
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds of traffic after all clients connected')
+        parser.add_argument('--rate', type=float, default=1.0, help='Frames per second per client (Poisson)')
+        parser.add_argument('--mix', default='chat=60,typing=30,read=10', type=parse_mix)
+        parser.add_argument('--layer', choices=('memory', 'redis'), default='memory',
+                            help='Channel layer: in-memory, or Redis at REDIS_HOST/REDIS_PORT')
+        parser.add_argument('--connect-concurrency', type=int, default=50)
+        parser.add_argument('--drain', type=float, default=2.0, help='Seconds to wait for in-flight deliveries')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--prefix', default='loadtest')
+        parser.add_argument('--json', dest='json_path', default=None,
+                            help="Write the report as JSON to this file ('-' for stdout only)")
+        parser.add_argument('--cleanup', action=argparse.BooleanOptionalAction, default=True,
+                            help='Afterwards delete the messages, conversations and users the run created')
+
+    def handle(self, *args, **options):
+        if options['clients'] < 2:
+            raise CommandError('--clients must be at least 2')
+
+        users, created_ids = self.ensure_users(options['prefix'], options['clients'])
+        snapshot = self.snapshot(users)
+        try:
+            with override_settings(CHANNEL_LAYERS=self.channel_layers(options['layer'])):
+                from mysite.asgi import application
+                report = async_to_sync(self.run)(application, users, options)
+        finally:
+            if options['cleanup']:
+                self.cleanup(users, created_ids, snapshot)
+
+        if options['json_path'] == '-':
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        if options['json_path']:
+            with open(options['json_path'], 'w') as handle:
+                json.dump(report, handle, indent=2)
+        self.print_report(report)
+
+    def channel_layers(self, layer):
+        if layer == 'memory':
+            return {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+        return {
+            'default': {
+                'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                'CONFIG': {'hosts': [(settings.REDIS_POOL['host'], settings.REDIS_POOL['port'])]},
+            }
+        }
+
+    def ensure_users(self, prefix, count):
+        usernames = [f'{prefix}_{i}' for i in range(count)]
+        existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        created = User.objects.bulk_create(
+            User(username=username, email=f'{username}@example.com')
+            for username in usernames if username not in existing
+        )
+        users = {user.username: user for user in User.objects.filter(username__in=usernames)}
+        return [users[username] for username in usernames], [user.id for user in created if user.id]
+
+    def snapshot(self, users):
+        """
+        What cleanup() needs to undo the run: the last message id before it
+        and the conversations among `users` that already existed.
+        """
+        ids = [user.id for user in users]
+        last_id = Message.objects.aggregate(last=Max('id'))['last'] or 0
+        return last_id, list(Conversation.objects.filter(user_low_id__in=ids, user_high_id__in=ids))
+
+    def cleanup(self, users, created_ids, snapshot):
+        """
+        Delete what the run wrote, also for users that existed before it:
+        its messages (newer than the snapshot, between the run's users),
+        the conversations it started and the users it created. Conversations
+        that existed get their summary and read watermarks back.
+        """
+        last_id, existing = snapshot
+        ids = [user.id for user in users]
+        with transaction.atomic():
+            Conversation.objects.filter(user_low_id__in=ids, user_high_id__in=ids).exclude(
+                id__in=[conversation.id for conversation in existing]
+            ).delete()
+            Message.objects.filter(id__gt=last_id, sender_id__in=ids, recipient_id__in=ids).delete()
+            Conversation.objects.bulk_update(existing, SUMMARY_FIELDS)
+            User.objects.filter(id__in=created_ids).delete()
+        # Rebuilt from the restored conversations on the next read
+        try:
+            get_sync_redis().unlink(*[unread_key(user_id) for user_id in ids])
+        except redis.RedisError:
+            logger.warning('Could not drop the unread counters of the load test users', exc_info=True)
+
+    async def run(self, application, users, options):
+        rng = random.Random(options['seed'])
+        stats = Stats()
+        semaphore = asyncio.Semaphore(options['connect_concurrency'])
+
+        async def connect(user):
+            async with semaphore:
+                communicator = WebsocketCommunicator(
+                    application, '/ws/chat/', subprotocols=[AUTH_SUBPROTOCOL, str(AccessToken.for_user(user))]
+                )
+                start = time.perf_counter()
+                connected, _ = await communicator.connect(timeout=30)
+                if not connected:
+                    raise CommandError(f'{user.username} was rejected by the consumer')
+                stats.connect.append(time.perf_counter() - start)
+                return communicator
+
+        communicators = await asyncio.gather(*(connect(user) for user in users))
+        readers = [asyncio.create_task(self.read(communicator, stats)) for communicator in communicators]
+
+        actions, weights = zip(*options['mix'].items())
+        start = time.perf_counter()
+        deadline = start + options['duration']
+        await asyncio.gather(*(
+            self.client(index, communicator, users, rng, actions, weights, options['rate'], deadline, stats)
+            for index, communicator in enumerate(communicators)
+        ))
+        elapsed = time.perf_counter() - start
+
+        # Give the last messages time to arrive before counting losses
+        drain_until = time.perf_counter() + options['drain']
+        while stats.sent_at and time.perf_counter() < drain_until:
+            await asyncio.sleep(0.05)
+
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators), return_exceptions=True)
+
+        chats = stats.frames_sent['chat']
+        return {
+            'config': {
+                key: options[key]
+                for key in ('clients', 'duration', 'rate', 'mix', 'layer', 'connect_concurrency', 'seed')
+            },
+            'elapsed_seconds': round(elapsed, 3),
+            'connect_ms': summarize(stats.connect),
+            'delivery_ms': summarize(stats.delivery),
+            'messages': {
+                'sent': chats,
+                'delivered': len(stats.delivery),
+                'lost': len(stats.sent_at),
+                'delivered_per_second': round(len(stats.delivery) / elapsed, 1),
+            },
+            'frames_sent': dict(stats.frames_sent),
+            'frames_sent_per_second': round(sum(stats.frames_sent.values()) / elapsed, 1),
+            'frames_received': dict(stats.frames_received),
+            'errors': stats.errors,
+        }
+
+    async def client(self, index, communicator, users, rng, actions, weights, rate, deadline, stats):
+        me = users[index]
+        sequence = 0
+        while True:
+            await asyncio.sleep(min(rng.expovariate(rate), max(0.0, deadline - time.perf_counter())))
+            if time.perf_counter() >= deadline:
+                return
+            peer = users[(index + rng.randrange(1, len(users))) % len(users)]
+            action = rng.choices(actions, weights)[0]
+            if action == 'chat':
+                sequence += 1
+                content = f'{MARKER}:{me.id}:{sequence}'
+                stats.sent_at[content] = time.perf_counter()
+                frame = {'type': 'chat_message', 'message': content, 'recipient_username': peer.username}
+            elif action == 'typing':
+                frame = {'type': 'typing', 'recipient_username': peer.username, 'is_typing': rng.random() < 0.8}
+            else:
+                frame = {'type': 'read_receipt', 'sender_username': peer.username}
+            await communicator.send_to(text_data=orjson.dumps(frame).decode())
+            stats.frames_sent[action] += 1
+
+    async def read(self, communicator, stats):
+        # Reads the output queue directly: a receive_from() timeout would
+        # cancel the consumer under test.
+        while True:
+            output = await communicator.output_queue.get()
+            if output['type'] != 'websocket.send':
+                continue
+            payload = orjson.loads(output.get('text') or b'{}')
+            if 'error' in payload:
+                stats.errors += 1
+                continue
+            stats.frames_received[payload.get('type')] += 1
+            if payload.get('type') == 'new_message':
+                sent_at = stats.sent_at.pop(payload['message']['content'], None)
+                if sent_at is not None:
+                    stats.delivery.append(time.perf_counter() - sent_at)
+
+    def print_report(self, report):
+        self.stdout.write('=' * 60)
+        config = report['config']
+        self.stdout.write(
+            f"{config['clients']} clients, {config['rate']}/s each, {config['layer']} layer, "
+            f"{report['elapsed_seconds']}s"
+        )
+        for label in ('connect_ms', 'delivery_ms'):
+            summary = report[label]
+            if summary['count']:
+                self.stdout.write(
+                    f"{label:<12} p50 {summary['p50']:>8.2f}  p90 {summary['p90']:>8.2f}  "
+                    f"p99 {summary['p99']:>8.2f}  max {summary['max']:>8.2f}"
+                )
+        messages = report['messages']
+        self.stdout.write(
+            f"messages     sent {messages['sent']}  delivered {messages['delivered']}  "
+            f"lost {messages['lost']}  {messages['delivered_per_second']} msgs/sec"
+        )
+        self.stdout.write(f"frames       {report['frames_sent_per_second']} frames/sec sent, errors {report['errors']}")
+        self.stdout.write('=' * 60)
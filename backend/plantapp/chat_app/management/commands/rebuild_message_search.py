@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat_app.search import optimize_index, rebuild_index, search_available
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the chat full-text search index from messages and the archive, then optimize it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--optimize-only', action='store_true', help='Only merge the index segments')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Archive blocks read per query')
+
+    def handle(self, *args, **options):
+        if not search_available():
+            raise CommandError('The full-text index needs SQLite FTS5')
+
+        if not options['optimize_only']:
+            self.stdout.write(self.style.WARNING('Rebuilding message search index...'))
+            indexed = rebuild_index(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'✓ Indexed {indexed} messages'))
+
+        optimize_index()
+        self.stdout.write(self.style.SUCCESS('✓ Optimized message search index'))
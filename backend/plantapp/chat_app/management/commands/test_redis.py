@@ -2,6 +2,8 @@ from django.core.management.base import BaseCommand
 from channels.layers import get_channel_layer
 import asyncio
 
+from chat_app.redis_pool import get_redis, pool_metrics
+
 class Command(BaseCommand):
     help = 'Test Redis connection and channel layer configuration'
     def handle(self, *args, **options):
@@ -10,5 +12,10 @@ class Command(BaseCommand):
             self.stdout.write(f"Using: {layer.__class__.__name__}")
             await layer.group_send('test', {'type': 'test'})
             self.stdout.write(self.style.SUCCESS('✓ Redis working!'))
+
+            await get_redis().ping()
+            self.stdout.write(self.style.SUCCESS('✓ Presence pool working!'))
+            for name, value in pool_metrics().items():
+                self.stdout.write(f"  {name}: {value}")
         
-        asyncio.run(test())
\ No newline at end of file
+        asyncio.run(test())
@@ -0,0 +1,104 @@
+"""
+Group commit for websocket chat messages.
+
+Each worker keeps one MessageBuffer per event loop (see redis_pool for why
+per loop). Consumers submit messages and await them; the buffer collects
+everything that arrives within the flush window (or until max_batch is
+reached) and writes it with services.record_messages(), i.e. one bulk
+INSERT in one transaction instead of one commit per message. The awaiting
+consumer gets the saved Message back, with id and timestamp set, and only
+then acks the sender and delivers to the recipient.
+"""
+import asyncio
+import logging
+import weakref
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .models import Message
+from .services import record_message, record_messages
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBuffer:
+
+    def __init__(self, flush_window_ms, max_batch):
+        self.flush_window = flush_window_ms / 1000
+        self.max_batch = max_batch
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+
+    async def submit(self, *, sender, recipient, content):
+        """Queue a message and wait until it is committed. Returns the saved Message."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((Message(sender=sender, recipient=recipient, content=content), future))
+
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_window, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch):
+        try:
+            await database_sync_to_async(record_messages)(messages=[message for message, _ in batch])
+        except Exception:
+            # One bad row (e.g. a recipient deleted meanwhile) must not fail
+            # the whole batch: retry each message on its own.
+            logger.warning("Group commit of %d messages failed, retrying one by one", len(batch), exc_info=True)
+            await self._flush_one_by_one(batch)
+            return
+
+        for message, future in batch:
+            if not future.done():
+                future.set_result(message)
+
+    async def _flush_one_by_one(self, batch):
+        for message, future in batch:
+            try:
+                saved = await database_sync_to_async(record_message)(
+                    sender=message.sender,
+                    recipient=message.recipient,
+                    content=message.content,
+                )
+            except Exception as exc:
+                if not future.done():
+                    future.set_exception(exc)
+            else:
+                if not future.done():
+                    future.set_result(saved)
+
+
+_buffers = weakref.WeakKeyDictionary()
+
+
+def get_message_buffer():
+    """Return the buffer of the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    buffer = _buffers.get(loop)
+    if buffer is None:
+        config = settings.CHAT_MESSAGE_BUFFER
+        buffer = MessageBuffer(config['flush_window_ms'], config['max_batch'])
+        _buffers[loop] = buffer
+    return buffer
+
+
+async def save_chat_message(*, sender, recipient, content):
+    """Persist a chat message through the group-commit buffer, or directly if it is disabled."""
+    if not settings.CHAT_MESSAGE_BUFFER['enabled']:
+        return await database_sync_to_async(record_message)(sender=sender, recipient=recipient, content=content)
+    return await get_message_buffer().submit(sender=sender, recipient=recipient, content=content)
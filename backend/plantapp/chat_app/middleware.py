@@ -1,19 +1,121 @@
+import copy
+import logging
+import time
 from urllib.parse import parse_qs
 
+import redis
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import TokenError
 
+from .redis_pool import get_redis, get_sync_redis
+from .user_cache import LocalLRU
+
+logger = logging.getLogger(__name__)
+
+# Browsers cannot set headers on a websocket handshake, so besides
+# ?token=... the access token may be offered as a subprotocol right after
+# this marker: new WebSocket(url, ["plantapp.auth", token]). The marker is
+# echoed back as the accepted subprotocol; the token never is.
+AUTH_SUBPROTOCOL = "plantapp.auth"
+
+# Resolved users keyed by (user_id, jti), kept until the token expires, so
+# reconnect bursts with the same token skip the database. Each entry holds
+# the user's version from Redis, which forget_user() bumps in every worker's
+# view; a hit is only used while the version is unchanged.
+_user_cache = LocalLRU(max_entries=10000)
+
+USER_VERSION_KEY = "usercache:user_version:{user_id}"
+# Any expiry is safe: a missing version never matches a cached one
+USER_VERSION_TTL_SECONDS = 86400
+# Version of a cache lookup made without Redis; never stored, never matched
+_UNKNOWN = object()
+
+
+def user_version_key(user_id):
+    return USER_VERSION_KEY.format(user_id=user_id)
+
 
 @database_sync_to_async
 def _get_user_by_id(user_id):
     User = get_user_model()
     try:
-        return User.objects.get(id=user_id)
+        user = User.objects.get(id=user_id)
     except User.DoesNotExist:
         return AnonymousUser()
+    # Deactivated accounts keep valid tokens until they expire
+    return user if user.is_active else AnonymousUser()
+
+
+async def _current_version(user_id):
+    """The user's version in Redis (None if never bumped), or _UNKNOWN when Redis is down."""
+    try:
+        return await get_redis().get(user_version_key(user_id))
+    except redis.RedisError:
+        logger.warning("User versions unavailable, reading the user from the database", exc_info=True)
+        return _UNKNOWN
+
+
+def _token_from_subprotocols(subprotocols):
+    """Return `(token, remaining_subprotocols)`."""
+    if AUTH_SUBPROTOCOL not in subprotocols:
+        return None, subprotocols
+    index = subprotocols.index(AUTH_SUBPROTOCOL)
+    token = subprotocols[index + 1] if index + 1 < len(subprotocols) else None
+    remaining = [AUTH_SUBPROTOCOL] + subprotocols[:index] + subprotocols[index + 2:]
+    return token, remaining
+
+
+def _token_from_query_string(query_string):
+    if b"token=" not in query_string:
+        return None
+    token_values = parse_qs(query_string.decode()).get("token", [])
+    return token_values[0] if token_values else None
+
+
+async def _resolve_user(access_token):
+    user_id = access_token.get("user_id")
+    if user_id is None:
+        return None
+
+    key = (str(user_id), access_token.get("jti"))
+    # Read before the database, so a change saved in between makes the
+    # stored copy stale rather than the other way round
+    version = await _current_version(user_id)
+    found, entry = _user_cache.get(key)
+    if found and version is not _UNKNOWN and entry[0] == version:
+        # Each connection gets its own instance
+        return copy.copy(entry[1])
+
+    user = await _get_user_by_id(user_id)
+    if user.is_authenticated and version is not _UNKNOWN:
+        ttl = access_token.get("exp", 0) - time.time()
+        if ttl > 0:
+            _user_cache.set(key, (version, user), ttl)
+    return copy.copy(user)
+
+
+def _bump_version(user_id):
+    try:
+        with get_sync_redis().pipeline(transaction=False) as pipe:
+            pipe.incr(user_version_key(user_id))
+            pipe.expire(user_version_key(user_id), USER_VERSION_TTL_SECONDS)
+            pipe.execute()
+    except redis.RedisError:
+        logger.warning("Could not bump the cached user version of %s", user_id, exc_info=True)
+
+
+def forget_user(user_id):
+    """
+    Drop cached handshake users for `user_id` (the user changed or was
+    deleted): here at once, in other workers on their next hit, once the
+    change is committed and their reload can see it.
+    """
+    _user_cache.pop_matching(lambda key: key[0] == str(user_id))
+    transaction.on_commit(lambda: _bump_version(user_id))
 
 
 class JwtAuthMiddleware:
@@ -23,17 +125,19 @@ class JwtAuthMiddleware:
     async def __call__(self, scope, receive, send):
         user = scope.get("user")
         if user is None or not getattr(user, "is_authenticated", False):
-            query_string = scope.get("query_string", b"").decode()
-            params = parse_qs(query_string)
-            token_values = params.get("token", [])
-            token = token_values[0] if token_values else None
+            token, subprotocols = _token_from_subprotocols(list(scope.get("subprotocols") or []))
+            if token:
+                # Hide the token from the consumer's subprotocol negotiation
+                scope = dict(scope, subprotocols=subprotocols)
+            else:
+                token = _token_from_query_string(scope.get("query_string", b""))
 
             if token:
                 try:
                     access_token = AccessToken(token)
-                    user_id = access_token.get("user_id")
-                    if user_id is not None:
-                        scope["user"] = await _get_user_by_id(user_id)
+                    user = await _resolve_user(access_token)
+                    if user is not None:
+                        scope["user"] = user
                 except TokenError:
                     scope["user"] = AnonymousUser()
 
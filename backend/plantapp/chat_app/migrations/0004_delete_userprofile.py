@@ -0,0 +1,27 @@
+# Generated by Django 6.0.1 on 2026-10-18 07:10
+
+from django.db import migrations
+
+
+def copy_last_seen(apps, schema_editor):
+    UserProfile = apps.get_model('chat_app', 'UserProfile')
+    User = apps.get_model('users', 'User')
+    users = []
+    for user_id, last_seen in UserProfile.objects.values_list('user_id', 'last_seen').iterator():
+        users.append(User(id=user_id, last_seen=last_seen))
+    User.objects.bulk_update(users, ['last_seen'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0003_message_indexes'),
+        ('users', '0009_user_last_seen'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_last_seen, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='UserProfile',
+        ),
+    ]
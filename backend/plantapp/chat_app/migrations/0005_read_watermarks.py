@@ -0,0 +1,102 @@
+# Generated by Django 6.0.1 on 2026-10-18 08:40
+
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def is_read_to_watermarks(apps, schema_editor):
+    """
+    Each side's watermark becomes the newest message it had read; unread
+    counters are recounted as the messages above the watermark. 0002 left
+    the summary table empty, so conversations without a row get one here,
+    before the is_read column they are computed from goes away.
+    """
+    Conversation = apps.get_model('chat_app', 'Conversation')
+    Message = apps.get_model('chat_app', 'Message')
+
+    newest_read = {
+        (row['sender_id'], row['recipient_id']): row['newest']
+        for row in Message.objects.filter(is_read=True)
+        .values('sender_id', 'recipient_id')
+        .annotate(newest=Max('id'))
+    }
+
+    # Latest message and unread count (above the reader's watermark) per pair
+    latest = {}
+    unread = Counter()
+    for sender_id, recipient_id, message_id, timestamp in Message.objects.values_list(
+        'sender_id', 'recipient_id', 'id', 'timestamp'
+    ).iterator():
+        pair = (min(sender_id, recipient_id), max(sender_id, recipient_id))
+        if pair not in latest or (timestamp, message_id) > latest[pair]:
+            latest[pair] = (timestamp, message_id)
+        if message_id > newest_read.get((sender_id, recipient_id), 0):
+            unread[(sender_id, recipient_id)] += 1
+
+    existing = {
+        (conversation.user_low_id, conversation.user_high_id): conversation
+        for conversation in Conversation.objects.iterator()
+    }
+    conversations, created = [], []
+    for low, high in existing.keys() | latest.keys():
+        conversation = existing.get((low, high))
+        if conversation is None:
+            timestamp, message_id = latest[(low, high)]
+            conversation = Conversation(
+                user_low_id=low, user_high_id=high, last_message_id=message_id, last_timestamp=timestamp,
+            )
+            created.append(conversation)
+        else:
+            conversations.append(conversation)
+        conversation.read_low = newest_read.get((high, low), 0)
+        conversation.read_high = newest_read.get((low, high), 0)
+        conversation.unread_low = unread[(high, low)]
+        conversation.unread_high = unread[(low, high)] if low != high else 0
+
+    Conversation.objects.bulk_create(created, batch_size=500)
+    Conversation.objects.bulk_update(
+        conversations,
+        ['read_low', 'read_high', 'unread_low', 'unread_high'],
+        batch_size=500,
+    )
+
+
+def watermarks_to_is_read(apps, schema_editor):
+    Conversation = apps.get_model('chat_app', 'Conversation')
+    Message = apps.get_model('chat_app', 'Message')
+
+    for conversation in Conversation.objects.iterator():
+        low, high = conversation.user_low_id, conversation.user_high_id
+        Message.objects.filter(sender_id=high, recipient_id=low, id__lte=conversation.read_low).update(is_read=True)
+        Message.objects.filter(sender_id=low, recipient_id=high, id__lte=conversation.read_high).update(is_read=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0004_delete_userprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='read_low',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='read_high',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(is_read_to_watermarks, watermarks_to_is_read),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_unread_idx',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,110 @@
+# Generated by Django 6.0.1 on 2026-10-18 10:15
+
+import json
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from django.db import migrations
+
+# Full-text index of chat messages (see chat_app.search). It stores its own
+# copy of the text plus the participants, so messages moved to the archive
+# tier stay searchable; triggers keep it in step with chat_app_message,
+# including bulk inserts that send no signals.
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE chat_app_message_fts USING fts5(
+        content,
+        sender_id UNINDEXED,
+        recipient_id UNINDEXED,
+        timestamp UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER chat_app_message_fts_insert AFTER INSERT ON chat_app_message BEGIN
+        INSERT INTO chat_app_message_fts (rowid, content, sender_id, recipient_id, timestamp)
+        VALUES (new.id, new.content, new.sender_id, new.recipient_id, new.timestamp);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_app_message_fts_update AFTER UPDATE OF content ON chat_app_message BEGIN
+        UPDATE chat_app_message_fts SET content = new.content WHERE rowid = new.id;
+    END
+    """,
+    # Rows moved into an archive block keep their index entry
+    """
+    CREATE TRIGGER chat_app_message_fts_delete AFTER DELETE ON chat_app_message
+    WHEN NOT EXISTS (
+        SELECT 1 FROM chat_app_messagearchiveblock
+        WHERE user_low_id = min(old.sender_id, old.recipient_id)
+          AND user_high_id = max(old.sender_id, old.recipient_id)
+          AND first_id <= old.id AND last_id >= old.id
+    )
+    BEGIN
+        DELETE FROM chat_app_message_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER chat_app_messagearchiveblock_fts_delete AFTER DELETE ON chat_app_messagearchiveblock BEGIN
+        DELETE FROM chat_app_message_fts
+        WHERE rowid BETWEEN old.first_id AND old.last_id
+          AND sender_id IN (old.user_low_id, old.user_high_id)
+          AND recipient_id IN (old.user_low_id, old.user_high_id);
+    END
+    """,
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS chat_app_messagearchiveblock_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_app_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_app_message_fts_update",
+    "DROP TRIGGER IF EXISTS chat_app_message_fts_insert",
+    "DROP TABLE IF EXISTS chat_app_message_fts",
+]
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    MessageArchiveBlock = apps.get_model('chat_app', 'MessageArchiveBlock')
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+    with schema_editor.connection.cursor() as cursor:
+        for statement in CREATE_SQL:
+            cursor.execute(statement)
+        cursor.execute(
+            "INSERT INTO chat_app_message_fts (rowid, content, sender_id, recipient_id, timestamp) "
+            "SELECT id, content, sender_id, recipient_id, timestamp FROM chat_app_message"
+        )
+        for block in MessageArchiveBlock.objects.iterator():
+            rows = json.loads(zlib.decompress(bytes(block.payload)))
+            cursor.executemany(
+                "INSERT INTO chat_app_message_fts (rowid, content, sender_id, recipient_id, timestamp) "
+                "VALUES (%s, %s, %s, %s, %s)",
+                [
+                    (
+                        message_id, content, sender_id, recipient_id,
+                        (epoch + timedelta(microseconds=micros)).strftime('%Y-%m-%d %H:%M:%S.%f'),
+                    )
+                    for message_id, sender_id, recipient_id, micros, content in rows
+                ],
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for statement in DROP_SQL:
+            cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0007_message_archive_block'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
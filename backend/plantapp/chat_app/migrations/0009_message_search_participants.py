@@ -0,0 +1,121 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:05
+
+import importlib
+import json
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from django.db import migrations
+
+previous = importlib.import_module('chat_app.migrations.0008_message_search')
+
+# Same index with a `participants` column of tokens ("u<sender> u<recipient>
+# p<low>x<high>", see chat_app.search.participants) so search is scoped to
+# the caller's conversations inside the MATCH instead of filtering every
+# match in the database on the UNINDEXED id columns, and prefix indexes so
+# a typed prefix is read like a single term instead of merging the doclists
+# of every word it starts.
+PARTICIPANTS_SQL = (
+    "'u' || {row}.sender_id || ' u' || {row}.recipient_id"
+    " || ' p' || min({row}.sender_id, {row}.recipient_id) || 'x' || max({row}.sender_id, {row}.recipient_id)"
+)
+
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE chat_app_message_fts USING fts5(
+        content,
+        sender_id UNINDEXED,
+        recipient_id UNINDEXED,
+        timestamp UNINDEXED,
+        participants,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '1 2 3 4'
+    )
+    """,
+    f"""
+    CREATE TRIGGER chat_app_message_fts_insert AFTER INSERT ON chat_app_message BEGIN
+        INSERT INTO chat_app_message_fts (rowid, content, sender_id, recipient_id, timestamp, participants)
+        VALUES (new.id, new.content, new.sender_id, new.recipient_id, new.timestamp, {PARTICIPANTS_SQL.format(row='new')});
+    END
+    """,
+    """
+    CREATE TRIGGER chat_app_message_fts_update AFTER UPDATE OF content ON chat_app_message BEGIN
+        UPDATE chat_app_message_fts SET content = new.content WHERE rowid = new.id;
+    END
+    """,
+    # Rows moved into an archive block keep their index entry
+    """
+    CREATE TRIGGER chat_app_message_fts_delete AFTER DELETE ON chat_app_message
+    WHEN NOT EXISTS (
+        SELECT 1 FROM chat_app_messagearchiveblock
+        WHERE user_low_id = min(old.sender_id, old.recipient_id)
+          AND user_high_id = max(old.sender_id, old.recipient_id)
+          AND first_id <= old.id AND last_id >= old.id
+    )
+    BEGIN
+        DELETE FROM chat_app_message_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER chat_app_messagearchiveblock_fts_delete AFTER DELETE ON chat_app_messagearchiveblock BEGIN
+        DELETE FROM chat_app_message_fts
+        WHERE rowid BETWEEN old.first_id AND old.last_id
+          AND sender_id IN (old.user_low_id, old.user_high_id)
+          AND recipient_id IN (old.user_low_id, old.user_high_id);
+    END
+    """,
+]
+
+
+def participants(sender_id, recipient_id):
+    low, high = sorted((sender_id, recipient_id))
+    return f'u{sender_id} u{recipient_id} p{low}x{high}'
+
+
+def create_scoped_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    previous.drop_search_index(apps, schema_editor)
+    MessageArchiveBlock = apps.get_model('chat_app', 'MessageArchiveBlock')
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+    with schema_editor.connection.cursor() as cursor:
+        for statement in CREATE_SQL:
+            cursor.execute(statement)
+        cursor.execute(
+            "INSERT INTO chat_app_message_fts (rowid, content, sender_id, recipient_id, timestamp, participants) "
+            f"SELECT id, content, sender_id, recipient_id, timestamp, {PARTICIPANTS_SQL.format(row='chat_app_message')} "
+            "FROM chat_app_message"
+        )
+        for block in MessageArchiveBlock.objects.iterator():
+            rows = json.loads(zlib.decompress(bytes(block.payload)))
+            cursor.executemany(
+                "INSERT INTO chat_app_message_fts (rowid, content, sender_id, recipient_id, timestamp, participants) "
+                "VALUES (%s, %s, %s, %s, %s, %s)",
+                [
+                    (
+                        message_id, content, sender_id, recipient_id,
+                        (epoch + timedelta(microseconds=micros)).strftime('%Y-%m-%d %H:%M:%S.%f'),
+                        participants(sender_id, recipient_id),
+                    )
+                    for message_id, sender_id, recipient_id, micros, content in rows
+                ],
+            )
+
+
+def restore_unscoped_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    previous.drop_search_index(apps, schema_editor)
+    previous.create_search_index(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0008_message_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_scoped_index, restore_unscoped_index),
+    ]
@@ -15,28 +15,146 @@ class Message(models.Model):
 	)
 	content = models.TextField()
 	timestamp = models.DateTimeField(auto_now_add=True)
-	is_read = models.BooleanField(default=False)
 
 	class Meta:
 		ordering = ['timestamp']
+		indexes = [
+			# Conversation history: each side of the sender/recipient OR is a range on this index
+			models.Index(fields=['sender', 'recipient', 'timestamp'], name='message_pair_time_idx'),
+			# Websocket sync: everything a user sent/received after a message id
+			models.Index(fields=['recipient', 'id'], name='message_recipient_id_idx'),
+			models.Index(fields=['sender', 'id'], name='message_sender_id_idx'),
+		]
 
 	def __str__(self):
 		return f"Message from {self.sender.username} to {self.recipient.username}"
 
+	def save(self, *args, **kwargs):
+		adding = self._state.adding
+		super().save(*args, **kwargs)
+		if adding:
+			# Newer than any read watermark
+			self.is_read = False
 
-class UserProfile(models.Model):
+	@property
+	def is_read(self):
+		"""
+		Whether the recipient has read this message, i.e. it is at or below
+		the recipient's watermark on the Conversation. Code that returns
+		messages sets it from the watermarks it already has
+		(services.apply_read_state / apply_read_states); a message that was
+		not passed through them looks its watermark up here, one query each.
+		"""
+		try:
+			return self._is_read
+		except AttributeError:
+			pass
+		low, high = Conversation.pair_for(self.sender_id, self.recipient_id)
+		conversation = Conversation.objects.filter(user_low_id=low, user_high_id=high).first()
+		self._is_read = self.pk is not None and conversation is not None and conversation.has_read(self)
+		return self._is_read
 
-	user = models.OneToOneField(
+	@is_read.setter
+	def is_read(self, value):
+		self._is_read = value
+
+
+class Conversation(models.Model):
+	"""
+	Materialized summary of the messages exchanged between two users.
+	The pair is stored ordered (user_low.id <= user_high.id) so each
+	conversation has exactly one row, kept in sync by chat_app.signals
+	and chat_app.services.
+	"""
+	user_low = models.ForeignKey(
+		settings.AUTH_USER_MODEL,
+		on_delete=models.CASCADE,
+		related_name='+'
+	)
+	user_high = models.ForeignKey(
 		settings.AUTH_USER_MODEL,
 		on_delete=models.CASCADE,
-		related_name='chat_profile'
+		related_name='+'
+	)
+	last_message = models.ForeignKey(
+		Message,
+		on_delete=models.SET_NULL,
+		null=True,
+		blank=True,
+		related_name='+'
 	)
-	is_online = models.BooleanField(default=False)
-	last_seen = models.DateTimeField(auto_now=True)
+	last_timestamp = models.DateTimeField(null=True, blank=True)
+	unread_low = models.PositiveIntegerField(default=0)
+	unread_high = models.PositiveIntegerField(default=0)
+	# Read watermarks: id of the newest message each side has read. A
+	# message is read iff its id is at or below its recipient's watermark.
+	read_low = models.PositiveBigIntegerField(default=0)
+	read_high = models.PositiveBigIntegerField(default=0)
 
 	class Meta:
-		verbose_name_plural = "User Profiles"
+		constraints = [
+			models.UniqueConstraint(fields=['user_low', 'user_high'], name='unique_conversation_pair'),
+			models.CheckConstraint(condition=models.Q(user_low__lte=models.F('user_high')), name='conversation_pair_ordered'),
+		]
+		indexes = [
+			models.Index(fields=['user_low', '-last_timestamp'], name='conversation_low_recent_idx'),
+			models.Index(fields=['user_high', '-last_timestamp'], name='conversation_high_recent_idx'),
+		]
 
 	def __str__(self):
-		return f"UserProfile of {self.user.username}"
+		return f"Conversation between {self.user_low_id} and {self.user_high_id}"
+
+	@staticmethod
+	def pair_for(user_a_id, user_b_id):
+		"""Return the (user_low_id, user_high_id) key for two user ids."""
+		return (user_a_id, user_b_id) if user_a_id <= user_b_id else (user_b_id, user_a_id)
+
+	def other_user(self, user):
+		return self.user_high if self.user_low_id == user.id else self.user_low
+
+	def unread_for(self, user):
+		return self.unread_low if self.user_low_id == user.id else self.unread_high
+
+	def read_watermark_for(self, user_id):
+		return self.read_low if self.user_low_id == user_id else self.read_high
+
+	def has_read(self, message):
+		return message.id <= self.read_watermark_for(message.recipient_id)
 
+
+class MessageArchiveBlock(models.Model):
+	"""
+	Archive tier: old messages of one conversation, moved out of the
+	Message table by chat_app.archive and stored as one compressed block.
+	Message ids are kept, so cursors and read watermarks stay valid.
+	`first_*` / `last_*` bound the block so reads only decode the blocks
+	they need.
+	"""
+	user_low = models.ForeignKey(
+		settings.AUTH_USER_MODEL,
+		on_delete=models.CASCADE,
+		related_name='+'
+	)
+	user_high = models.ForeignKey(
+		settings.AUTH_USER_MODEL,
+		on_delete=models.CASCADE,
+		related_name='+'
+	)
+	first_id = models.BigIntegerField()
+	last_id = models.BigIntegerField()
+	first_timestamp = models.DateTimeField()
+	last_timestamp = models.DateTimeField()
+	message_count = models.PositiveIntegerField()
+	# zlib-compressed JSON, see chat_app.archive.encode_messages
+	payload = models.BinaryField()
+
+	class Meta:
+		indexes = [
+			# Paging back through one conversation
+			models.Index(fields=['user_low', 'user_high', 'last_id'], name='archive_pair_idx'),
+			# Websocket sync of everything after a message id
+			models.Index(fields=['user_high', 'last_id'], name='archive_high_idx'),
+		]
+
+	def __str__(self):
+		return f"Archived messages {self.first_id}-{self.last_id} between {self.user_low_id} and {self.user_high_id}"
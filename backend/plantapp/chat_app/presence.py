@@ -0,0 +1,314 @@
+"""
+Redis-backed presence store.
+
+Redis is the source of truth for who is online and when they were last
+seen. Every websocket connection owns a heartbeat key with a short TTL
+that the client refreshes by pinging, and is listed in its user's
+connection set. Opening/closing a connection is a single EVALSHA: the
+script updates the set and, on the first/last connection, flips the user
+in the online set, stamps last_seen and marks the user dirty.
+
+Connections whose heartbeat expired (crashed worker, dropped network) are
+closed by sweep_dead_connections(), which walks the connection sets with
+SCAN so it never blocks Redis. set_offline() (logout) drops all of a
+user's connections at once. flush_to_database() later writes dirty
+users back to the User table in bulk, so websocket traffic never writes
+to the users table.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone as dt_timezone
+
+import redis
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
+
+from users.models import Friendship
+
+from .redis_pool import get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+CONNECTION_KEY = "presence:connections:{user_id}"
+HEARTBEAT_KEY = "presence:heartbeat:{user_id}:{connection_id}"
+# Clients ping every HEARTBEAT_INTERVAL_SECONDS; a connection is dead once
+# its heartbeat key has not been refreshed for HEARTBEAT_TTL_SECONDS.
+HEARTBEAT_INTERVAL_SECONDS = 20
+HEARTBEAT_TTL_SECONDS = 60
+ONLINE_KEY = "presence:online"
+LAST_SEEN_KEY = "presence:last_seen"
+DIRTY_KEY = "presence:dirty"
+# Max group_send calls in flight for one status broadcast
+FANOUT_CONCURRENCY = 64
+
+# KEYS = connection set, heartbeat key, online set, last_seen hash, dirty set
+# ARGV = heartbeat ttl, user id, now, connection id. Returns {count, is_first}.
+# Idempotent per connection id, so heartbeats reuse it to refresh the TTL
+# (and to bring back a connection the sweeper already closed).
+_OPEN_SCRIPT = """
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[1])
+local added = redis.call('SADD', KEYS[1], ARGV[4])
+local count = redis.call('SCARD', KEYS[1])
+if added == 1 and count == 1 then
+    redis.call('SADD', KEYS[3], ARGV[2])
+    redis.call('HSET', KEYS[4], ARGV[2], ARGV[3])
+    redis.call('SADD', KEYS[5], ARGV[2])
+    return {count, 1}
+end
+return {count, 0}
+"""
+
+# Same KEYS/ARGV as above. Returns {count, is_last}. Closing a connection
+# that is already gone (e.g. both the consumer and the sweeper closing it)
+# never reports a second transition.
+_CLOSE_SCRIPT = """
+redis.call('DEL', KEYS[2])
+local removed = redis.call('SREM', KEYS[1], ARGV[4])
+local count = redis.call('SCARD', KEYS[1])
+if removed == 1 and count == 0 then
+    redis.call('SREM', KEYS[3], ARGV[2])
+    redis.call('HSET', KEYS[4], ARGV[2], ARGV[3])
+    redis.call('SADD', KEYS[5], ARGV[2])
+    return {0, 1}
+end
+return {count, 0}
+"""
+
+# KEYS = connection set, online set, last_seen hash, dirty set
+# ARGV = user id, now, heartbeat key prefix. Drops every connection of the
+# user and their heartbeats; returns 1 if the user was online.
+_OFFLINE_SCRIPT = """
+for _, connection_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    redis.call('DEL', ARGV[3] .. connection_id)
+end
+redis.call('DEL', KEYS[1])
+local was_online = redis.call('SREM', KEYS[2], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+redis.call('SADD', KEYS[4], ARGV[1])
+return was_online
+"""
+
+# KEYS = dirty set, online set, last_seen hash; ARGV = batch size.
+# Pops up to ARGV[1] dirty users and returns {id, online, last_seen, ...}.
+_DRAIN_SCRIPT = """
+local ids = redis.call('SPOP', KEYS[1], ARGV[1])
+local out = {}
+for _, id in ipairs(ids) do
+    table.insert(out, id)
+    table.insert(out, redis.call('SISMEMBER', KEYS[2], id))
+    table.insert(out, redis.call('HGET', KEYS[3], id) or '')
+end
+return out
+"""
+
+
+def connection_key(user_id):
+    return CONNECTION_KEY.format(user_id=user_id)
+
+
+def heartbeat_key(user_id, connection_id):
+    return HEARTBEAT_KEY.format(user_id=user_id, connection_id=connection_id)
+
+
+def _script_keys(user_id, connection_id):
+    return [
+        connection_key(user_id),
+        heartbeat_key(user_id, connection_id),
+        ONLINE_KEY,
+        LAST_SEEN_KEY,
+        DIRTY_KEY,
+    ]
+
+
+def _script_args(user_id, connection_id):
+    return [HEARTBEAT_TTL_SECONDS, user_id, time.time(), connection_id]
+
+
+async def connection_opened(redis_client, user_id, connection_id):
+    """Register a connection. Returns `(count, is_first_connection)`."""
+    script = redis_client.register_script(_OPEN_SCRIPT)
+    count, is_first = await script(
+        keys=_script_keys(user_id, connection_id),
+        args=_script_args(user_id, connection_id),
+    )
+    return int(count), bool(is_first)
+
+
+async def connection_heartbeat(redis_client, user_id, connection_id):
+    """
+    Refresh the heartbeat of a live connection. Returns `(count, is_first)`
+    like connection_opened(); is_first is only true when the sweeper had
+    already given the connection up and the user came back online.
+    """
+    return await connection_opened(redis_client, user_id, connection_id)
+
+
+async def connection_closed(redis_client, user_id, connection_id):
+    """Drop a connection. Returns `(count, is_last_connection)`."""
+    script = redis_client.register_script(_CLOSE_SCRIPT)
+    count, is_last = await script(
+        keys=_script_keys(user_id, connection_id),
+        args=_script_args(user_id, connection_id),
+    )
+    return int(count), bool(is_last)
+
+
+def sweep_dead_connections(scan_count=200):
+    """
+    Close every connection whose heartbeat key has expired. Connection sets
+    are walked with SCAN/SSCAN and heartbeats checked with one pipelined
+    EXISTS per user, so Redis is never blocked. Returns the ids of users
+    that went offline, for the caller to announce.
+    """
+    client = get_sync_redis()
+    close = client.register_script(_CLOSE_SCRIPT)
+    went_offline = []
+
+    for key in client.scan_iter(match=connection_key('*'), count=scan_count):
+        user_id = int(key.rsplit(':', 1)[1])
+        connection_ids = list(client.sscan_iter(key, count=scan_count))
+        if not connection_ids:
+            continue
+
+        pipe = client.pipeline(transaction=False)
+        for connection_id in connection_ids:
+            pipe.exists(heartbeat_key(user_id, connection_id))
+
+        for connection_id, alive in zip(connection_ids, pipe.execute()):
+            if alive:
+                continue
+            _, is_last = close(
+                keys=_script_keys(user_id, connection_id),
+                args=_script_args(user_id, connection_id),
+            )
+            if is_last:
+                went_offline.append(user_id)
+
+    return went_offline
+
+
+def announce_offline(user_id):
+    """Tell everyone in the user's presence audience that it went offline (sync callers)."""
+    async_to_sync(broadcast_presence)(get_channel_layer(), user_id, False, presence_audience(user_id))
+
+
+def set_offline(user_id):
+    """
+    Force a user offline (e.g. on logout): drop all of its connections in
+    the store and, if it was online, announce it. Returns whether it was.
+    """
+    try:
+        script = get_sync_redis().register_script(_OFFLINE_SCRIPT)
+        was_online = script(
+            keys=[connection_key(user_id), ONLINE_KEY, LAST_SEEN_KEY, DIRTY_KEY],
+            args=[user_id, time.time(), heartbeat_key(user_id, '')],
+        )
+    except redis.RedisError:
+        logger.warning("Presence store unavailable, could not mark user_id=%s offline", user_id, exc_info=True)
+        return False
+    if was_online:
+        announce_offline(user_id)
+    return bool(was_online)
+
+
+def online_states(users):
+    """
+    Map user id -> is_online for `users` with one pipelined round trip.
+    Falls back to the last flushed User.is_online column if Redis is down.
+    """
+    users = list(users)
+    if not users:
+        return {}
+    try:
+        pipe = get_sync_redis().pipeline(transaction=False)
+        for user in users:
+            pipe.sismember(ONLINE_KEY, user.id)
+        return {user.id: bool(flag) for user, flag in zip(users, pipe.execute())}
+    except redis.RedisError:
+        logger.warning("Presence store unavailable, using database presence", exc_info=True)
+        return {user.id: bool(user.is_online) for user in users}
+
+
+def is_online(user):
+    return online_states([user])[user.id]
+
+
+def flush_to_database(batch_size=500):
+    """
+    Write dirty presence entries back to User.is_online / User.last_seen
+    with bulk updates. Returns the number of users written.
+    """
+    User = get_user_model()
+    client = get_sync_redis()
+    drain = client.register_script(_DRAIN_SCRIPT)
+    written = 0
+
+    while True:
+        flat = drain(keys=[DIRTY_KEY, ONLINE_KEY, LAST_SEEN_KEY], args=[batch_size])
+        if not flat:
+            return written
+
+        users = []
+        for user_id, online, last_seen in zip(flat[0::3], flat[1::3], flat[2::3]):
+            users.append(User(
+                id=int(user_id),
+                is_online=bool(int(online)),
+                last_seen=datetime.fromtimestamp(float(last_seen), tz=dt_timezone.utc) if last_seen else None,
+            ))
+
+        try:
+            with transaction.atomic():
+                User.objects.bulk_update(users, ['is_online', 'last_seen'], batch_size=batch_size)
+        except Exception:
+            # Put the batch back so the next flush retries it
+            client.sadd(DIRTY_KEY, *[user.id for user in users])
+            raise
+        written += len(users)
+
+
+def presence_audience(user_id):
+    """
+    Ids of everyone who should see `user_id` come online or go offline:
+    users it follows and users following it, which covers mutual friends
+    and pending requests in both directions. One query on the friendship
+    table, answered from its two indexes.
+    """
+    rows = Friendship.objects.filter(
+        Q(from_user_id=user_id) | Q(to_user_id=user_id)
+    ).values_list('from_user_id', 'to_user_id')
+
+    audience = set()
+    for from_id, to_id in rows:
+        audience.add(to_id if from_id == user_id else from_id)
+    audience.discard(user_id)
+    return audience
+
+
+async def broadcast_presence(channel_layer, user_id, is_online, recipient_ids, concurrency=FANOUT_CONCURRENCY):
+    """
+    Send a status_update to the personal group of every recipient, with at
+    most `concurrency` group_send calls in flight. A failed send is logged
+    and does not stop the others. Returns the number of groups reached.
+    """
+    event = {
+        "type": "status_update_handler",
+        "user_id": user_id,
+        "is_online": is_online,
+    }
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(recipient_id):
+        async with semaphore:
+            # Same group name the consumer joins in connect()
+            await channel_layer.group_send(f"chat_user_{recipient_id}", event)
+
+    recipient_ids = list(recipient_ids)
+    results = await asyncio.gather(*(send(rid) for rid in recipient_ids), return_exceptions=True)
+    failed = [rid for rid, result in zip(recipient_ids, results) if isinstance(result, Exception)]
+    if failed:
+        logger.warning("Status broadcast for user_id=%s failed for %d recipients", user_id, len(failed))
+    return len(recipient_ids) - len(failed)
@@ -0,0 +1,98 @@
+"""
+Process-wide Redis connection pools for presence tracking.
+
+Every worker process lazily creates one bounded pool and hands out clients
+that share it, instead of opening a fresh TCP connection per websocket
+connect/disconnect. asyncio connections are tied to the event loop that
+opened them, so the async pool is kept per running loop (daphne runs a
+single loop per process; tests spin up one per async_to_sync call).
+"""
+import asyncio
+import time
+import weakref
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+
+
+class InstrumentedBlockingConnectionPool(aioredis.BlockingConnectionPool):
+    """BlockingConnectionPool that records how long callers waited for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquisitions = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    async def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        connection = await super().get_connection(*args, **kwargs)
+        waited = time.perf_counter() - start
+        self.acquisitions += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        return connection
+
+    def metrics(self):
+        in_use = len(self._in_use_connections)
+        idle = len(self._available_connections)
+        return {
+            "max_connections": self.max_connections,
+            "in_use": in_use,
+            "idle": idle,
+            "created": in_use + idle,
+            "acquisitions": self.acquisitions,
+            "wait_ms_total": round(self.wait_seconds_total * 1000, 3),
+            "wait_ms_max": round(self.wait_seconds_max * 1000, 3),
+            "wait_ms_avg": round(self.wait_seconds_total * 1000 / self.acquisitions, 3) if self.acquisitions else 0.0,
+        }
+
+
+_async_pools = weakref.WeakKeyDictionary()
+_sync_pool = None
+
+
+def _pool_kwargs():
+    config = settings.REDIS_POOL
+    return {
+        "host": config["host"],
+        "port": config["port"],
+        "max_connections": config["max_connections"],
+        "timeout": config["timeout"],
+        "health_check_interval": config["health_check_interval"],
+        "socket_connect_timeout": config["timeout"],
+        "decode_responses": True,
+    }
+
+
+def get_async_pool():
+    """Return the async pool of the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    pool = _async_pools.get(loop)
+    if pool is None:
+        pool = InstrumentedBlockingConnectionPool(**_pool_kwargs())
+        _async_pools[loop] = pool
+    return pool
+
+
+def get_redis():
+    """Async Redis client backed by the shared pool. Do not close it."""
+    return aioredis.Redis(connection_pool=get_async_pool())
+
+
+def get_sync_redis():
+    """Blocking Redis client for management commands, backed by a process-wide pool."""
+    global _sync_pool
+    if _sync_pool is None:
+        _sync_pool = redis.BlockingConnectionPool(**_pool_kwargs())
+    return redis.Redis(connection_pool=_sync_pool)
+
+
+def pool_metrics():
+    """Metrics of the async pool bound to the running loop (empty if none yet)."""
+    try:
+        pool = _async_pools.get(asyncio.get_running_loop())
+    except RuntimeError:
+        pool = None
+    return pool.metrics() if pool is not None else {}
@@ -0,0 +1,264 @@
+"""
+Full-text search over chat history.
+
+On SQLite the chat_app_message_fts FTS5 table (migrations 0008 and 0009)
+indexes every message, hot or archived, and is kept current by triggers on
+chat_app_message. Besides the text it indexes a `participants` column of
+user and conversation tokens, so the scope to the caller's conversations
+is part of the MATCH and a search reads the caller's own matches, never
+everyone else's. search_messages() takes the caller's newest matches from
+the index in rowid order and ranks them here; FTS5's bm25() is not used
+because its term weights are counted over the whole table on every query.
+Other databases fall back to a substring filter on the hot Message table.
+"""
+import html
+import re
+import unicodedata
+from datetime import timezone
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from .archive import decode_block
+from .models import Message, MessageArchiveBlock
+from .services import apply_read_states, conversation_messages
+
+FTS_TABLE = 'chat_app_message_fts'
+SNIPPET_TOKENS = 12
+# Newest matches ranked per search; later pages continue into older ones
+RANK_WINDOW = 200
+# Longest prefix, in bytes, the index keeps entries for (migration 0009)
+INDEXED_PREFIX = 4
+# BM25 parameters, the same as FTS5's
+K1, B = 1.2, 0.75
+# Token characters of the unicode61 tokenizer: letters and digits
+_WORD = re.compile(r'[^\W_]+')
+# participants() for a chat_app_message row, in SQL
+_PARTICIPANTS_SQL = (
+	"'u' || sender_id || ' u' || recipient_id"
+	" || ' p' || min(sender_id, recipient_id) || 'x' || max(sender_id, recipient_id)"
+)
+
+
+def search_available():
+	return connection.vendor == 'sqlite'
+
+
+def participants(sender_id, recipient_id):
+	"""
+	Tokens of the `participants` column: one per user ("u<id>") and one
+	for the conversation ("p<low id>x<high id>"). The insert trigger of
+	migration 0009 and _PARTICIPANTS_SQL build the same string.
+	"""
+	low, high = sorted((sender_id, recipient_id))
+	return f'u{sender_id} u{recipient_id} p{low}x{high}'
+
+
+def _scope_token(user, other):
+	if other is None:
+		return f'u{user.id}'
+	low, high = sorted((user.id, other.id))
+	return f'p{low}x{high}'
+
+
+def _fold(word):
+	"""Lowercase `word` and strip its diacritics, as remove_diacritics 2 does."""
+	return ''.join(char for char in unicodedata.normalize('NFD', word.lower()) if not unicodedata.combining(char))
+
+
+def _tokens(text):
+	"""(start, end, folded word) of every token of `text`, as the index splits it."""
+	return [(match.start(), match.end(), _fold(match.group())) for match in _WORD.finditer(text)]
+
+
+class _Query:
+	"""The folded words of a search; the last one is a prefix while it is still being typed."""
+
+	def __init__(self, text):
+		self.terms = [_fold(word) for word in _WORD.findall(text)]
+		self.prefix = bool(self.terms) and not text[-1:].isspace()
+
+	def matches(self, word, index):
+		if self.prefix and index == len(self.terms) - 1:
+			return word.startswith(self.terms[index])
+		return word == self.terms[index]
+
+	def expression(self, scope_token):
+		"""
+		FTS5 query for the rows of `scope_token` with every word. A prefix
+		longer than the index keeps is cut to one it does keep, so it is
+		read as one term; _candidates() checks the whole prefix.
+		"""
+		quoted = [f'"{term}"' for term in self.terms]
+		if self.prefix:
+			last = self.terms[-1]
+			while len(last.encode()) > INDEXED_PREFIX:
+				last = last[:-1]
+			quoted[-1] = f'"{last}"*'
+		return f'participants : "{scope_token}" AND content : ({" ".join(quoted)})'
+
+	def hits(self, tokens):
+		"""Per token, whether it matches one of the words."""
+		return [any(self.matches(word, index) for index in range(len(self.terms))) for _, _, word in tokens]
+
+	def found_in(self, tokens):
+		words = [word for _, _, word in tokens]
+		return all(any(self.matches(word, index) for word in words) for index in range(len(self.terms)))
+
+	def score(self, tokens, average_length):
+		"""
+		BM25 of one message. Every candidate contains every word, so the
+		words' rarity is left out: it would weigh them alike anyway and
+		counting it means reading everyone's messages.
+		"""
+		words = [word for _, _, word in tokens]
+		norm = K1 * (1 - B + B * len(words) / average_length)
+		score = 0.0
+		for index in range(len(self.terms)):
+			frequency = sum(1 for word in words if self.matches(word, index))
+			score += frequency * (K1 + 1) / (frequency + norm)
+		return score
+
+
+def _candidates(query, scope_token, wanted):
+	"""Up to `wanted` of the newest rows in scope matching `query`, as (row, tokens)."""
+	expression = query.expression(scope_token)
+	found, before = [], None
+	with connection.cursor() as cursor:
+		while len(found) < wanted:
+			bound = '' if before is None else 'AND rowid < %s'
+			cursor.execute(
+				f"""
+				SELECT rowid, content, sender_id, recipient_id, timestamp
+				FROM {FTS_TABLE}
+				WHERE {FTS_TABLE} MATCH %s {bound}
+				ORDER BY rowid DESC
+				LIMIT %s
+				""",
+				[expression, *([] if before is None else [before]), wanted],
+			)
+			rows = cursor.fetchall()
+			for row in rows:
+				tokens = _tokens(row[1])
+				# Rows matched by a cut prefix may not have the whole one
+				if query.found_in(tokens):
+					found.append((row, tokens))
+			if len(rows) < wanted:
+				break
+			before = rows[-1][0]
+	return found[:wanted]
+
+
+def _snippet(content, tokens, hits):
+	"""
+	HTML-escaped excerpt of up to SNIPPET_TOKENS tokens, from where most
+	of the matches are, with the matching tokens wrapped in <mark>.
+	"""
+	start = max(
+		range(max(len(tokens) - SNIPPET_TOKENS, 0) + 1),
+		key=lambda first: sum(hits[first:first + SNIPPET_TOKENS]),
+	)
+	end = min(start + SNIPPET_TOKENS, len(tokens))
+	pieces = ['…'] if start else []
+	position = tokens[start][0] if start else 0
+	for (first, last, _), hit in zip(tokens[start:end], hits[start:end]):
+		word = html.escape(content[first:last])
+		pieces += [html.escape(content[position:first]), f'<mark>{word}</mark>' if hit else word]
+		position = last
+	pieces.append('…' if end < len(tokens) else html.escape(content[position:]))
+	return ''.join(pieces)
+
+
+def search_messages(*, user, query, other=None, limit=20, offset=0):
+	"""
+	Messages of `user`'s conversations (only the one with `other` if
+	given) matching `query`, best match first, as `(hits, has_next)`.
+	Each hit is a dict with the `message` (sender, recipient and is_read
+	set) and an HTML-escaped `snippet` with the matches wrapped in <mark>.
+	The newest RANK_WINDOW matches (more when paging past them) are ranked.
+	"""
+	parsed = _Query(query)
+	if not parsed.terms:
+		return [], False
+	if not search_available():
+		return _search_substring(user=user, query=query, other=other, limit=limit, offset=offset)
+
+	candidates = _candidates(parsed, _scope_token(user, other), max(RANK_WINDOW, offset + limit + 1))
+	if candidates:
+		average_length = sum(len(tokens) for _, tokens in candidates) / len(candidates)
+		candidates.sort(key=lambda candidate: (-parsed.score(candidate[1], average_length), -candidate[0][0]))
+	page = candidates[offset:offset + limit + 1]
+	has_next = len(page) > limit
+	page = page[:limit]
+	users = get_user_model().objects.only('id', 'username').in_bulk(
+		{row[2] for row, _ in page} | {row[3] for row, _ in page}
+	)
+
+	hits = []
+	for (message_id, content, sender_id, recipient_id, timestamp), tokens in page:
+		sender, recipient = users.get(int(sender_id)), users.get(int(recipient_id))
+		if sender is None or recipient is None:
+			# Left behind by a deleted user; rebuild_index drops these
+			continue
+		message = Message(
+			id=message_id,
+			sender=sender,
+			recipient=recipient,
+			content=content,
+			timestamp=parse_datetime(timestamp).replace(tzinfo=timezone.utc),
+		)
+		hits.append({"message": message, "snippet": _snippet(content, tokens, parsed.hits(tokens))})
+	apply_read_states([hit["message"] for hit in hits])
+	return hits, has_next
+
+
+def _search_substring(*, user, query, other, limit, offset):
+	if other is not None:
+		messages = conversation_messages(user=user, other=other)
+	else:
+		messages = Message.objects.filter(sender=user) | Message.objects.filter(recipient=user)
+	rows = list(
+		messages.filter(content__icontains=query.strip())
+		.select_related('sender', 'recipient')
+		.order_by('-id')[offset:offset + limit + 1]
+	)
+	hits = [{"message": message, "snippet": html.escape(message.content)} for message in apply_read_states(rows[:limit])]
+	return hits, len(rows) > limit
+
+
+def rebuild_index(batch_size=1000):
+	"""Re-create the index from the Message table and the archive. Returns rows indexed."""
+	insert = (
+		f"INSERT INTO {FTS_TABLE} (rowid, content, sender_id, recipient_id, timestamp, participants) "
+		"VALUES (%s, %s, %s, %s, %s, %s)"
+	)
+	total = 0
+	with transaction.atomic(), connection.cursor() as cursor:
+		cursor.execute(f"DELETE FROM {FTS_TABLE}")
+		cursor.execute(
+			f"INSERT INTO {FTS_TABLE} (rowid, content, sender_id, recipient_id, timestamp, participants) "
+			f"SELECT id, content, sender_id, recipient_id, timestamp, {_PARTICIPANTS_SQL} FROM chat_app_message"
+		)
+		total += cursor.rowcount
+		for block in MessageArchiveBlock.objects.iterator(chunk_size=batch_size):
+			rows = [
+				(
+					message.id,
+					message.content,
+					message.sender_id,
+					message.recipient_id,
+					connection.ops.adapt_datetimefield_value(message.timestamp),
+					participants(message.sender_id, message.recipient_id),
+				)
+				for message in decode_block(block)
+			]
+			cursor.executemany(insert, rows)
+			total += len(rows)
+	return total
+
+
+def optimize_index():
+	"""Merge the index b-trees into one; worth running after large rebuilds or archive runs."""
+	with connection.cursor() as cursor:
+		cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
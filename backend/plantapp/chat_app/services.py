@@ -0,0 +1,391 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max, Q
+
+from . import archive, unread_counters
+from .models import Conversation, Message
+
+
+def record_message(*, sender, recipient, content):
+	"""
+	Persist a message. The post_save handler in chat_app.signals updates the
+	Conversation summary inside this same transaction.
+	"""
+	with transaction.atomic():
+		message = Message.objects.create(
+			sender=sender,
+			recipient=recipient,
+			content=content,
+		)
+	# Newer than any read watermark by construction
+	message.is_read = False
+	return message
+
+
+def record_messages(*, messages):
+	"""
+	Persist unsaved Message instances with one bulk INSERT in one
+	transaction (group commit) and fold them into their Conversation rows.
+	bulk_create sends no post_save, so the summaries are updated here.
+	Primary keys and timestamps are set on the instances in place.
+	"""
+	with transaction.atomic():
+		Message.objects.bulk_create(messages)
+		apply_messages_to_conversations(messages)
+	for message in messages:
+		message.is_read = False
+	return messages
+
+
+def _unread_field(conversation_key, reader_id):
+	return 'unread_low' if reader_id == conversation_key[0] else 'unread_high'
+
+
+def _read_field(conversation_key, reader_id):
+	return 'read_low' if reader_id == conversation_key[0] else 'read_high'
+
+
+def apply_message_to_conversation(message):
+	"""Fold a newly created message into its Conversation summary row."""
+	apply_messages_to_conversations([message])
+
+
+def apply_messages_to_conversations(messages):
+	"""
+	Fold newly created messages into their Conversation summary rows, with
+	one UPDATE (or INSERT) per conversation however many messages it got.
+	"""
+	pairs = {}
+	for message in messages:
+		key = Conversation.pair_for(message.sender_id, message.recipient_id)
+		summary = pairs.setdefault(key, {"last": message, "unread_low": 0, "unread_high": 0})
+		if (message.timestamp, message.id) >= (summary["last"].timestamp, summary["last"].id):
+			summary["last"] = message
+		summary[_unread_field(key, message.recipient_id)] += 1
+
+	for key, summary in pairs.items():
+		_apply_summary(key, summary)
+		for reader_id, other_id, field in ((key[0], key[1], 'unread_low'), (key[1], key[0], 'unread_high')):
+			if summary[field]:
+				unread_counters.add_unread(reader_id, other_id, summary[field])
+
+
+def _apply_summary(key, summary):
+	last = summary["last"]
+	updates = {"last_message": last, "last_timestamp": last.timestamp}
+	for field in ('unread_low', 'unread_high'):
+		if summary[field]:
+			updates[field] = F(field) + summary[field]
+
+	if Conversation.objects.filter(user_low_id=key[0], user_high_id=key[1]).update(**updates):
+		return
+
+	try:
+		with transaction.atomic():
+			Conversation.objects.create(
+				user_low_id=key[0],
+				user_high_id=key[1],
+				last_message=last,
+				last_timestamp=last.timestamp,
+				unread_low=summary["unread_low"],
+				unread_high=summary["unread_high"],
+			)
+	except IntegrityError:
+		# Another writer created the row first; fold into it instead.
+		Conversation.objects.filter(user_low_id=key[0], user_high_id=key[1]).update(**updates)
+
+
+def get_conversation(*, user, other):
+	"""The Conversation row of `user` and `other`, or None if they never talked."""
+	key = Conversation.pair_for(user.id, other.id)
+	return Conversation.objects.filter(user_low_id=key[0], user_high_id=key[1]).first()
+
+
+def apply_read_state(messages, conversation):
+	"""Set `is_read` on each message from the conversation's watermarks."""
+	for message in messages:
+		message.is_read = conversation is not None and conversation.has_read(message)
+	return messages
+
+
+def apply_read_states(messages):
+	"""
+	apply_read_state for messages of any number of conversations, with
+	one query for all their Conversation rows.
+	"""
+	pairs = {Conversation.pair_for(message.sender_id, message.recipient_id) for message in messages}
+	conversations = {}
+	if pairs:
+		pair_filter = Q()
+		for low, high in pairs:
+			pair_filter |= Q(user_low_id=low, user_high_id=high)
+		conversations = {
+			(conversation.user_low_id, conversation.user_high_id): conversation
+			for conversation in Conversation.objects.filter(pair_filter)
+		}
+	for message in messages:
+		key = Conversation.pair_for(message.sender_id, message.recipient_id)
+		apply_read_state([message], conversations.get(key))
+	return messages
+
+
+def unread_after(*, reader, other, message_id, timestamp):
+	"""
+	Messages from `other` to `reader` newer than `message_id` (sent at
+	`timestamp`): a range on message_pair_time_idx, never a scan of the
+	whole conversation.
+	"""
+	return Message.objects.filter(
+		sender_id=other.id,
+		recipient_id=reader.id,
+		timestamp__gte=timestamp,
+		id__gt=message_id,
+	)
+
+
+def mark_conversation_read(*, reader, other):
+	"""
+	Move the reader's watermark up to the newest message of the
+	conversation and reset its unread counter. This is one UPDATE of the
+	Conversation row however many messages were unread, and no write at
+	all when nothing is. Both only need an `id` (a User or a
+	user_cache.CachedUser). Returns the number of messages newly read.
+	"""
+	key = Conversation.pair_for(reader.id, other.id)
+	read_field = _read_field(key, reader.id)
+	unread_field = _unread_field(key, reader.id)
+
+	with transaction.atomic():
+		conversation = Conversation.objects.filter(
+			user_low_id=key[0],
+			user_high_id=key[1],
+		).values('id', 'last_message_id', 'last_timestamp', read_field, unread_field).first()
+		if conversation is None or not conversation[unread_field]:
+			return 0
+
+		seen_id = conversation['last_message_id']
+		if seen_id is None:
+			# The last message was deleted; fall back to the newest remaining
+			# one, which may be in the archive if everything else was moved there
+			seen_id = max(
+				conversation_messages(user=reader, other=other).aggregate(newest=Max('id'))['newest'] or 0,
+				archive.newest_archived_id(user=reader, other=other),
+			)
+		seen_id = max(seen_id, conversation[read_field])
+		if Conversation.objects.filter(
+			pk=conversation['id'],
+			last_message_id=conversation['last_message_id'],
+		).update(**{read_field: seen_id, unread_field: 0}):
+			unread_counters.set_unread(reader.id, other.id, 0)
+			return conversation[unread_field]
+
+		# A message arrived after the read above. The UPDATE already holds
+		# the database write lock, so counting what is left is exact.
+		remaining = unread_after(
+			reader=reader,
+			other=other,
+			message_id=seen_id,
+			timestamp=conversation['last_timestamp'],
+		).count()
+		Conversation.objects.filter(pk=conversation['id']).update(**{read_field: seen_id, unread_field: remaining})
+		unread_counters.set_unread(reader.id, other.id, remaining)
+	return conversation[unread_field]
+
+
+def conversation_messages(*, user, other):
+	"""All messages exchanged between `user` and `other`, unordered."""
+	return Message.objects.filter(
+		Q(sender=user, recipient=other)
+		|
+		Q(sender=other, recipient=user)
+	)
+
+
+def message_page(*, user, other, page_size, before_id=None, after_id=None):
+	"""
+	Keyset page of the conversation between `user` and `other` on
+	(timestamp, id). Without a cursor the newest `page_size` messages are
+	returned; `before_id` pages backwards and `after_id` forwards from an
+	existing message. Messages come back oldest first.
+
+	Each direction of the conversation is read as its own ordered range of
+	message_pair_time_idx and the two short lists are merged, so a page
+	never reads more than 2 * (page_size + 1) rows and never counts.
+	Paging back past the oldest hot message continues into the archive
+	tier (chat_app.archive), which holds everything older; cursors may
+	point into either tier.
+
+	Returns `(messages, has_older, has_newer)`, or None when the cursor is
+	not a message of this conversation.
+	"""
+	cursor_id = before_id if before_id is not None else after_id
+	keyset = Q()
+	cursor_key = None
+	cursor_archived = False
+	if cursor_id is not None:
+		cursor = conversation_messages(user=user, other=other).filter(pk=cursor_id).values('timestamp').first()
+		if cursor is not None:
+			timestamp = cursor['timestamp']
+		else:
+			timestamp = archive.archived_timestamp(user=user, other=other, message_id=cursor_id)
+			if timestamp is None:
+				return None
+			cursor_archived = True
+		cursor_key = (timestamp, cursor_id)
+		# Written as a timestamp range minus the cursor's own tie group so
+		# SQLite can bound the index range on timestamp.
+		if after_id is not None:
+			keyset = Q(timestamp__gte=timestamp) & ~Q(timestamp=timestamp, id__lte=after_id)
+		else:
+			keyset = Q(timestamp__lte=timestamp) & ~Q(timestamp=timestamp, id__gte=before_id)
+
+	forward = after_id is not None
+	ordering = ('timestamp', 'id') if forward else ('-timestamp', '-id')
+	directions = {(user.id, other.id), (other.id, user.id)}
+
+	rows = []
+	if not (cursor_archived and not forward):
+		# Everything older than an archived message is archived too
+		for sender_id, recipient_id in directions:
+			rows.extend(
+				Message.objects.filter(keyset, sender_id=sender_id, recipient_id=recipient_id)
+				.select_related('sender', 'recipient')
+				.order_by(*ordering)[:page_size + 1]
+			)
+	rows.sort(key=lambda message: (message.timestamp, message.id), reverse=not forward)
+
+	if forward and cursor_archived:
+		# The archived rows after the cursor come before every hot row
+		rows = archive.archived_page(user=user, other=other, limit=page_size + 1, after=cursor_key) + rows
+	elif not forward and len(rows) <= page_size:
+		# Hot history ran out: continue into the archive
+		rows += archive.archived_page(
+			user=user,
+			other=other,
+			limit=page_size + 1 - len(rows),
+			before=(rows[-1].timestamp, rows[-1].id) if rows else cursor_key,
+		)
+
+	has_more = len(rows) > page_size
+	rows = rows[:page_size]
+	if forward:
+		return rows, True, has_more
+
+	rows.reverse()
+	return rows, has_more, before_id is not None
+
+
+def conversation_history(*, user, other, offset=0, limit=None):
+	"""
+	The conversation oldest first across the archive and hot tiers,
+	optionally sliced; archived messages are only decoded when the slice
+	reaches them.
+	"""
+	archived_total = archive.archived_count(user=user, other=other)
+	messages = []
+	if offset < archived_total:
+		messages = archive.archived_history(user=user, other=other, offset=offset, limit=limit)
+
+	hot = conversation_messages(user=user, other=other).select_related('sender', 'recipient').order_by('timestamp')
+	hot_offset = max(0, offset - archived_total)
+	if limit is None:
+		messages.extend(hot[hot_offset:])
+	elif len(messages) < limit:
+		messages.extend(hot[hot_offset:hot_offset + limit - len(messages)])
+	return messages
+
+
+def conversation_length(*, user, other):
+	"""Number of messages in the conversation, both tiers."""
+	return conversation_messages(user=user, other=other).count() + archive.archived_count(user=user, other=other)
+
+
+def messages_since(*, user, after_id, limit):
+	"""
+	Messages `user` sent or received with an id above `after_id`, oldest
+	first, at most `limit` of them, with `is_read` already set.
+
+	Sent and received messages are two id ranges on message_sender_id_idx
+	and message_recipient_id_idx, each read at most `limit + 1` rows deep
+	and merged, whatever the number of conversations. A cursor older than
+	the hot window also reads the archive tier.
+
+	Returns `(messages, has_more)`.
+	"""
+	rows = {}
+	for field in ('sender_id', 'recipient_id'):
+		for message in (
+			Message.objects.filter(**{field: user.id, 'id__gt': after_id})
+			.select_related('sender', 'recipient')
+			.order_by('id')[:limit + 1]
+		):
+			# Messages to oneself show up in both ranges
+			rows[message.id] = message
+	for message in archive.archived_since(user=user, after_id=after_id, limit=limit + 1):
+		rows[message.id] = message
+
+	messages = [rows[message_id] for message_id in sorted(rows)]
+	has_more = len(messages) > limit
+	messages = messages[:limit]
+	return apply_read_states(messages), has_more
+
+
+def conversations_for(*, user):
+	"""Conversations `user` takes part in, most recently active first."""
+	return (
+		Conversation.objects.filter(Q(user_low=user) | Q(user_high=user))
+		.exclude(user_low_id=F('user_high_id'))
+		.select_related(
+			'user_low',
+			'user_high',
+			'last_message__sender',
+			'last_message__recipient',
+		)
+		.order_by(F('last_timestamp').desc(nulls_last=True), '-id')
+	)
+
+
+def build_inbox(*, user, limit=None, offset=0):
+	"""
+	Return `(entries, has_next)` for the inbox of `user`.
+
+	Each entry is a dict with the conversation partner, the last message and
+	the unread count, read from the Conversation summary table. With `limit`
+	set, one extra row is fetched to compute `has_next` without a COUNT.
+	"""
+	rows = conversations_for(user=user)
+	if limit is not None:
+		rows = rows[offset:offset + limit + 1]
+
+	rows = list(rows)
+	has_next = limit is not None and len(rows) > limit
+	if has_next:
+		rows = rows[:limit]
+
+	for row in rows:
+		if row.last_message is not None:
+			apply_read_state([row.last_message], row)
+
+	entries = [
+		{
+			"user": row.other_user(user),
+			"last_message": row.last_message,
+			"unread_count": row.unread_for(user),
+		}
+		for row in rows
+	]
+	return entries, has_next
+
+
+def unread_counts(*, user):
+	"""
+	`(total, {other_user_id: count})` of unread messages for `user`, from
+	the Redis counters (see chat_app.unread_counters): one HGETALL, with
+	the Conversation rows read only when the counters are not loaded.
+	"""
+	return unread_counters.unread_counts(user.id)
+
+
+def unread_total(*, user):
+	"""Total unread messages for `user`."""
+	total, _ = unread_counts(user=user)
+	return total
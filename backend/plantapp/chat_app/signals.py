@@ -0,0 +1,37 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .middleware import forget_user
+from .models import Message
+from .services import apply_message_to_conversation
+from .user_cache import invalidate_usernames
+
+
+@receiver(post_save, sender=Message)
+def update_conversation_summary(sender, instance, created, **kwargs):
+    """
+    Keep the Conversation summary row in step with every new message.
+    Runs inside the caller's transaction (see services.record_message).
+    """
+    if created:
+        apply_message_to_conversation(instance)
+
+
+@receiver(post_save, sender=get_user_model())
+def forget_registered_username(sender, instance, created, **kwargs):
+    """A new user may have been cached as unknown; renames are handled by UserUpdateSerializer."""
+    if created:
+        invalidate_usernames(instance.username)
+
+
+@receiver(post_delete, sender=get_user_model())
+def forget_deleted_username(sender, instance, **kwargs):
+    invalidate_usernames(instance.username)
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def forget_handshake_user(sender, instance, **kwargs):
+    """Websocket handshakes cache the User per token; drop stale copies."""
+    forget_user(instance.pk)
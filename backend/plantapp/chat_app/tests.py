@@ -1,10 +1,17 @@
 
+import re
+from unittest import skipUnless
+from unittest.mock import patch
+
 from asgiref.sync import async_to_sync
 from channels.db import database_sync_to_async
 from channels.routing import URLRouter
 from channels.testing import WebsocketCommunicator
 from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.db.models import Q
 from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APIClient
 from django.contrib.auth import get_user_model
 from django.urls import reverse
@@ -12,9 +19,16 @@ from django.utils import timezone
 from datetime import timedelta
 from rest_framework_simplejwt.tokens import AccessToken
 
-from chat_app.middleware import JwtAuthMiddlewareStack
-from chat_app.models import Message, UserProfile
+from chat_app import middleware as jwt_middleware
+from chat_app import unread_counters, user_cache
+from chat_app.message_buffer import MessageBuffer
+from chat_app.middleware import AUTH_SUBPROTOCOL, JwtAuthMiddlewareStack
+from chat_app.models import Conversation, Message, MessageArchiveBlock
+from chat_app.presence import broadcast_presence, flush_to_database, is_online, presence_audience
 from chat_app.routing import websocket_urlpatterns
+from chat_app.services import apply_read_states
+from chat_app.typing_indicator import TypingCoalescer
+from chat_app.user_cache import invalidate_usernames, resolve_username
 
 User = get_user_model()
 
@@ -74,6 +88,7 @@ class MessageModelTestCase(TestCase):
 
 	def test_message_mark_as_read(self):
 		from chat_app.models import Message
+		from chat_app.services import mark_conversation_read
 
 		message = Message.objects.create(
 			sender=self.sender,
@@ -82,51 +97,349 @@ class MessageModelTestCase(TestCase):
 		)
 
 		self.assertFalse(message.is_read)
-		message.is_read = True
-		message.save()
+		mark_conversation_read(reader=self.recipient, other=self.sender)
 
-		refreshed_message = Message.objects.get(id=message.id)
+		refreshed_message, = apply_read_states([Message.objects.get(id=message.id)])
 		self.assertTrue(refreshed_message.is_read)
 
+	def test_read_state_is_a_watermark(self):
+		from chat_app.models import Message
+		from chat_app.services import mark_conversation_read
+
+		first = Message.objects.create(sender=self.sender, recipient=self.recipient, content='First')
+		mark_conversation_read(reader=self.recipient, other=self.sender)
+		second = Message.objects.create(sender=self.sender, recipient=self.recipient, content='Second')
+		reply = Message.objects.create(sender=self.recipient, recipient=self.sender, content='Reply')
+
+		loaded = {message.id: message for message in apply_read_states(list(Message.objects.all()))}
+		self.assertTrue(loaded[first.id].is_read)
+		self.assertFalse(loaded[second.id].is_read)
+		# The sender has not read anything yet
+		self.assertFalse(loaded[reply.id].is_read)
+
+	def test_read_state_is_looked_up_once_when_not_applied(self):
+		from chat_app.models import Message
+		from chat_app.services import mark_conversation_read
+
+		message = Message.objects.create(sender=self.sender, recipient=self.recipient, content='Hello')
+		loaded = Message.objects.get(id=message.id)
+		with self.assertNumQueries(1):
+			self.assertFalse(loaded.is_read)
+		with self.assertNumQueries(0):
+			self.assertFalse(loaded.is_read)
+
+		mark_conversation_read(reader=self.recipient, other=self.sender)
+		self.assertTrue(Message.objects.get(id=message.id).is_read)
+		applied = apply_read_states([Message.objects.get(id=message.id)])
+		with self.assertNumQueries(0):
+			self.assertTrue(applied[0].is_read)
+
 
-class UserProfileModelTestCase(TestCase):
+class ConversationSummaryTestCase(TestCase):
 
 	def setUp(self):
+		self.alice = User.objects.create_user(username='alice', email='alice@example.com', password='testpass123')
+		self.bob = User.objects.create_user(username='bob', email='bob@example.com', password='testpass123')
+
+	def _conversation(self):
+		low, high = Conversation.pair_for(self.alice.id, self.bob.id)
+		return Conversation.objects.get(user_low_id=low, user_high_id=high)
+
+	def test_message_creates_single_ordered_conversation(self):
+		Message.objects.create(sender=self.bob, recipient=self.alice, content='Hi')
+		Message.objects.create(sender=self.alice, recipient=self.bob, content='Hello')
+
+		self.assertEqual(Conversation.objects.count(), 1)
+		conversation = self._conversation()
+		self.assertLessEqual(conversation.user_low_id, conversation.user_high_id)
+		self.assertEqual(conversation.last_message.content, 'Hello')
+		self.assertEqual(conversation.unread_for(self.alice), 1)
+		self.assertEqual(conversation.unread_for(self.bob), 1)
+
+	def test_mark_conversation_read_is_one_update_and_skips_when_nothing_unread(self):
+		from chat_app.services import mark_conversation_read
+		Message.objects.create(sender=self.bob, recipient=self.alice, content='One')
+		Message.objects.create(sender=self.bob, recipient=self.alice, content='Two')
+
+		with CaptureQueriesContext(connection) as ctx:
+			self.assertEqual(mark_conversation_read(reader=self.alice, other=self.bob), 2)
+		writes = [query['sql'] for query in ctx.captured_queries if query['sql'].startswith('UPDATE')]
+		self.assertEqual(len(writes), 1)
+		self.assertIn('chat_app_conversation', writes[0])
+
+		with CaptureQueriesContext(connection) as ctx:
+			self.assertEqual(mark_conversation_read(reader=self.alice, other=self.bob), 0)
+		self.assertFalse([query for query in ctx.captured_queries if query['sql'].startswith('UPDATE')])
+
+	def test_mark_conversation_read_resets_reader_counter(self):
+		from chat_app.services import mark_conversation_read
+		Message.objects.create(sender=self.bob, recipient=self.alice, content='One')
+		Message.objects.create(sender=self.bob, recipient=self.alice, content='Two')
+		Message.objects.create(sender=self.alice, recipient=self.bob, content='Three')
+
+		updated = mark_conversation_read(reader=self.alice, other=self.bob)
+
+		self.assertEqual(updated, 2)
+		conversation = self._conversation()
+		self.assertEqual(conversation.unread_for(self.alice), 0)
+		self.assertEqual(conversation.unread_for(self.bob), 1)
+
+	def test_messages_since_merges_sent_and_received_in_constant_queries(self):
+		from chat_app.services import mark_conversation_read, messages_since
+		carol = User.objects.create_user(username='carol', email='carol@example.com', password='testpass123')
+		read = Message.objects.create(sender=self.bob, recipient=self.alice, content='Read')
+		mark_conversation_read(reader=self.alice, other=self.bob)
+		mine = [
+			Message.objects.create(sender=self.alice, recipient=self.bob, content='Sent'),
+			Message.objects.create(sender=carol, recipient=self.alice, content='Received'),
+			Message.objects.create(sender=self.alice, recipient=self.alice, content='Note to self'),
+		]
+		Message.objects.create(sender=carol, recipient=self.bob, content='Not mine')
+
+		# Sent range, received range, archive blocks, read state
+		with self.assertNumQueries(4):
+			messages, has_more = messages_since(user=self.alice, after_id=0, limit=10)
+		self.assertEqual([message.id for message in messages], [read.id] + [message.id for message in mine])
+		self.assertFalse(has_more)
+		self.assertEqual([message.is_read for message in messages], [True, False, False, False])
+
+		messages, has_more = messages_since(user=self.alice, after_id=read.id, limit=2)
+		self.assertEqual([message.id for message in messages], [message.id for message in mine[:2]])
+		self.assertTrue(has_more)
+
+	def test_backfill_rebuilds_summaries(self):
+		from io import StringIO
+		from django.core.management import call_command
+		from chat_app.services import mark_conversation_read
+		Message.objects.create(sender=self.bob, recipient=self.alice, content='One')
+		Message.objects.create(sender=self.alice, recipient=self.bob, content='Two')
+		mark_conversation_read(reader=self.bob, other=self.alice)
+
+		# A rebuild keeps the read watermarks of existing rows
+		call_command('backfill_conversations', stdout=StringIO())
+
+		conversation = self._conversation()
+		self.assertEqual(conversation.last_message.content, 'Two')
+		self.assertEqual(conversation.unread_for(self.alice), 1)
+		self.assertEqual(conversation.unread_for(self.bob), 0)
+
+		# From an empty table nothing is known to be read
+		Conversation.objects.all().delete()
+		call_command('backfill_conversations', stdout=StringIO())
+
+		conversation = self._conversation()
+		self.assertEqual(conversation.unread_for(self.alice), 1)
+		self.assertEqual(conversation.unread_for(self.bob), 1)
+
+	def test_backfill_keeps_archive_only_conversations(self):
+		from io import StringIO
+		from django.core.management import call_command
+		from chat_app.archive import archive_batch
+		from chat_app.services import mark_conversation_read
+		read = Message.objects.create(sender=self.bob, recipient=self.alice, content='One')
+		mark_conversation_read(reader=self.alice, other=self.bob)
+		Message.objects.create(sender=self.bob, recipient=self.alice, content='Two')
+		newest = Message.objects.create(sender=self.bob, recipient=self.alice, content='Three')
+		# Nothing of the conversation is left in the hot table
+		Conversation.objects.update(last_message=None)
+		archive_batch(before=timezone.now() + timedelta(seconds=1), batch_size=10, block_size=10)
+		self.assertFalse(Message.objects.exists())
+
+		call_command('backfill_conversations', stdout=StringIO())
+
+		conversation = self._conversation()
+		self.assertIsNone(conversation.last_message_id)
+		self.assertEqual(conversation.last_timestamp, newest.timestamp)
+		self.assertEqual(conversation.read_watermark_for(self.alice.id), read.id)
+		self.assertEqual(conversation.unread_for(self.alice), 2)
+		self.assertEqual(conversation.unread_for(self.bob), 0)
+
+
+class ReadWatermarkMigrationTestCase(TransactionTestCase):
+	"""Migration 0005 turns Message.is_read into Conversation rows and watermarks."""
 
-		self.user = User.objects.create_user(
-			username='testuser',
-			email='test@example.com',
-			password='testpass123'
-		)
+	def setUp(self):
+		from django.db.migrations.executor import MigrationExecutor
+		self.executor = MigrationExecutor(connection)
+		self.leaf = self.executor.loader.graph.leaf_nodes('chat_app')
+		self.executor.migrate([('chat_app', '0001_initial')])
+
+	def tearDown(self):
+		self.executor.loader.build_graph()
+		self.executor.migrate(self.leaf)
+
+	def _migrate(self, target):
+		self.executor.loader.build_graph()
+		self.executor.migrate([('chat_app', target)])
+		return self.executor.loader.project_state([('chat_app', target)]).apps
+
+	def test_conversations_are_built_from_read_messages(self):
+		apps = self.executor.loader.project_state([('chat_app', '0001_initial')]).apps
+		OldMessage = apps.get_model('chat_app', 'Message')
+		# users is left at its latest migration, so its current model is used
+		alice = User.objects.create_user(username='alice', email='alice@example.com', password='testpass123')
+		bob = User.objects.create_user(username='bob', email='bob@example.com', password='testpass123')
+		carol = User.objects.create_user(username='carol', email='carol@example.com', password='testpass123')
+		first = OldMessage.objects.create(sender_id=bob.id, recipient_id=alice.id, content='One', is_read=True)
+		OldMessage.objects.create(sender_id=bob.id, recipient_id=alice.id, content='Two')
+		reply = OldMessage.objects.create(sender_id=alice.id, recipient_id=bob.id, content='Three', is_read=True)
+		OldMessage.objects.create(sender_id=carol.id, recipient_id=alice.id, content='Unread')
+
+		apps = self._migrate('0005_read_watermarks')
+		NewConversation = apps.get_model('chat_app', 'Conversation')
+
+		self.assertEqual(NewConversation.objects.count(), 2)
+		low, high = sorted((alice.id, bob.id))
+		conversation = NewConversation.objects.get(user_low_id=low, user_high_id=high)
+		self.assertEqual(conversation.last_message_id, reply.id)
+		self.assertEqual(conversation.last_timestamp, reply.timestamp)
+		read_by = {low: conversation.read_low, high: conversation.read_high}
+		unread_for = {low: conversation.unread_low, high: conversation.unread_high}
+		self.assertEqual(read_by[alice.id], first.id)
+		self.assertEqual(unread_for[alice.id], 1)
+		self.assertEqual(read_by[bob.id], reply.id)
+		self.assertEqual(unread_for[bob.id], 0)
+
+		low, high = sorted((alice.id, carol.id))
+		conversation = NewConversation.objects.get(user_low_id=low, user_high_id=high)
+		read_by = {low: conversation.read_low, high: conversation.read_high}
+		unread_for = {low: conversation.unread_low, high: conversation.unread_high}
+		self.assertEqual(read_by[alice.id], 0)
+		self.assertEqual(unread_for[alice.id], 1)
+		self.assertEqual(unread_for[carol.id], 0)
+
+
+class UnreadCountAPIViewTestCase(TestCase):
 
-	def test_user_profile_creation(self):
-		from chat_app.models import UserProfile
+	def setUp(self):
+		self.client = APIClient()
+		self.url = reverse('chat:unread_count')
+		self.user1 = User.objects.create_user(username='user1', email='user1@example.com', password='testpass123')
+		self.user2 = User.objects.create_user(username='user2', email='user2@example.com', password='testpass123')
+		self.user3 = User.objects.create_user(username='user3', email='user3@example.com', password='testpass123')
+		# User ids are reused across tests; drop counters left behind
+		unread_counters.forget_all()
 
-		profile = UserProfile.objects.create(user=self.user)
+	def tearDown(self):
+		unread_counters.forget_all()
 
-		self.assertEqual(profile.user, self.user)
-		self.assertFalse(profile.is_online)
+	def test_unread_count_sums_conversations(self):
+		Message.objects.create(sender=self.user2, recipient=self.user1, content='A')
+		Message.objects.create(sender=self.user3, recipient=self.user1, content='B')
+		Message.objects.create(sender=self.user3, recipient=self.user1, content='C')
+		Message.objects.create(sender=self.user1, recipient=self.user2, content='D')
+		self.client.force_authenticate(user=self.user1)
+
+		response = self.client.get(self.url)
+		self.assertEqual(response.json()["unread_count"], 3)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			self.client.get(reverse('chat:chat', args=['user3']))
+		response = self.client.get(self.url)
+		self.assertEqual(response.json()["unread_count"], 1)
+		self.assertEqual(response.json()["by_sender"], {str(self.user2.id): 1})
+
+	def test_loaded_counters_follow_new_messages_and_reads(self):
+		from chat_app.services import mark_conversation_read
+
+		self.assertEqual(unread_counters.unread_counts(self.user1.id), (0, {}))
+		with self.captureOnCommitCallbacks(execute=True):
+			Message.objects.create(sender=self.user2, recipient=self.user1, content='A')
+			Message.objects.create(sender=self.user2, recipient=self.user1, content='B')
+			Message.objects.create(sender=self.user3, recipient=self.user1, content='C')
+
+		with CaptureQueriesContext(connection) as queries:
+			counts = unread_counters.unread_counts(self.user1.id)
+		self.assertEqual(counts, (3, {self.user2.id: 2, self.user3.id: 1}))
+		self.assertEqual(len(queries), 0)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			mark_conversation_read(reader=self.user1, other=self.user2)
+		self.assertEqual(unread_counters.unread_counts(self.user1.id), (1, {self.user3.id: 1}))
+
+	def test_counters_rebuild_from_conversations_when_missing(self):
+		from chat_app.redis_pool import get_sync_redis
 
-	def test_user_profile_online_status(self):
-		from chat_app.models import UserProfile
+		Message.objects.create(sender=self.user2, recipient=self.user1, content='A')
+		Message.objects.create(sender=self.user3, recipient=self.user1, content='B')
+		# Not loaded yet: nothing to increment, the first read rebuilds
+		self.assertFalse(get_sync_redis().exists(unread_counters.unread_key(self.user1.id)))
+		self.assertEqual(unread_counters.unread_counts(self.user1.id), (2, {self.user2.id: 1, self.user3.id: 1}))
+		self.assertGreater(get_sync_redis().ttl(unread_counters.unread_key(self.user1.id)), 0)
 
-		profile = UserProfile.objects.create(user=self.user)
-		self.assertFalse(profile.is_online)
+		# Redis lost its data
+		unread_counters.forget_all()
+		self.assertEqual(unread_counters.unread_counts(self.user1.id)[0], 2)
 
-		profile.is_online = True
-		profile.save()
+	def test_redis_errors_fall_back_to_database(self):
+		import redis
 
-		refreshed_profile = UserProfile.objects.get(user=self.user)
-		self.assertTrue(refreshed_profile.is_online)
+		Message.objects.create(sender=self.user2, recipient=self.user1, content='A')
+		with patch('chat_app.unread_counters.get_sync_redis', side_effect=redis.ConnectionError):
+			with self.assertLogs('chat_app.unread_counters', level='WARNING'):
+				self.assertEqual(unread_counters.unread_counts(self.user1.id), (1, {self.user2.id: 1}))
 
-	def test_user_profile_str_representation(self):
 
-		from chat_app.models import UserProfile
+@skipUnless(connection.vendor == 'sqlite', "EXPLAIN QUERY PLAN is SQLite specific")
+class MessageQueryPlanTestCase(TestCase):
+	"""
+	Runs EXPLAIN QUERY PLAN on every hot chat query against a seeded dataset
+	and fails if any of them falls back to a full table scan.
+	"""
 
-		profile = UserProfile.objects.create(user=self.user)
-		expected_str = f"UserProfile of {self.user.username}"
-		self.assertEqual(str(profile), expected_str)
+	def setUp(self):
+		self.users = [
+			User.objects.create_user(username=f'plan{i}', email=f'plan{i}@example.com', password='testpass123')
+			for i in range(5)
+		]
+		self.me, self.other = self.users[0], self.users[1]
+		Message.objects.bulk_create(
+			Message(
+				sender=self.users[i % 5],
+				recipient=self.users[(i + 1) % 5],
+				content=f'Message {i}',
+			)
+			for i in range(500)
+		)
+		with connection.cursor() as cursor:
+			cursor.execute('ANALYZE')
+
+	def hot_queries(self):
+		from chat_app.services import conversations_for, unread_after
+		me, other = self.me, self.other
+		return {
+			"conversation history": Message.objects.filter(
+				Q(sender=me, recipient=other) | Q(sender=other, recipient=me)
+			).order_by('timestamp'),
+			"keyset page": Message.objects.filter(
+				Q(timestamp__lte=timezone.now()) & ~Q(timestamp=timezone.now(), id__gte=100),
+				sender=me,
+				recipient=other,
+			).order_by('-timestamp', '-id')[:51],
+			"mark conversation read": Conversation.objects.filter(
+				user_low_id=min(me.id, other.id), user_high_id=max(me.id, other.id)
+			).values('id', 'last_message_id', 'read_low', 'unread_low'),
+			"unread after watermark": unread_after(
+				reader=me, other=other, message_id=250, timestamp=timezone.now()
+			).values('id'),
+			"inbox": conversations_for(user=me),
+			"unread total": Conversation.objects.filter(Q(user_low=me) | Q(user_high=me)).values('id'),
+			"sync received": Message.objects.filter(recipient_id=me.id, id__gt=250).order_by('id')[:101],
+			"sync sent": Message.objects.filter(sender_id=me.id, id__gt=250).order_by('id')[:101],
+			"archive page": MessageArchiveBlock.objects.filter(
+				user_low_id=min(me.id, other.id), user_high_id=max(me.id, other.id)
+			).defer('payload').order_by('-last_id'),
+			"archive sync": MessageArchiveBlock.objects.filter(
+				Q(user_low_id=me.id) | Q(user_high_id=me.id), last_id__gt=250
+			).defer('payload'),
+		}
 
+	def test_hot_queries_use_indexes(self):
+		for name, queryset in self.hot_queries().items():
+			with self.subTest(query=name):
+				plan = queryset.explain()
+				scans = re.findall(r'\bSCAN (\w+)', plan)
+				self.assertEqual(scans, [], f"{name} scans {scans}:\n{plan}")
 
 
 class InboxAPIViewTestCase(TestCase):
@@ -152,6 +465,10 @@ class InboxAPIViewTestCase(TestCase):
 		self.assertTrue(all('user' in item and 'unread_count' in item for item in data))
 
 	def test_inbox_excludes_current_user(self):
+		from chat_app.models import Message
+		Message.objects.create(sender=self.user1, recipient=self.user2, content='Hi')
+		Message.objects.create(sender=self.user3, recipient=self.user1, content='Hey')
+		Message.objects.create(sender=self.user1, recipient=self.user1, content='Note to self')
 		self.client.force_authenticate(user=self.user1)
 		response = self.client.get(self.inbox_url)
 		user_ids = [u['user']['id'] for u in response.json()]
@@ -159,6 +476,62 @@ class InboxAPIViewTestCase(TestCase):
 		self.assertIn(self.user2.id, user_ids)
 		self.assertIn(self.user3.id, user_ids)
 
+	def test_inbox_only_lists_existing_conversations(self):
+		from chat_app.models import Message
+		Message.objects.create(sender=self.user2, recipient=self.user1, content='Hello')
+		self.client.force_authenticate(user=self.user1)
+		response = self.client.get(self.inbox_url)
+		data = response.json()
+		self.assertEqual([item['user']['id'] for item in data], [self.user2.id])
+		self.assertEqual(data[0]['last_message']['content'], 'Hello')
+
+	def test_inbox_unread_count_and_last_message(self):
+		from chat_app.models import Message
+		from chat_app.services import mark_conversation_read
+		Message.objects.create(sender=self.user2, recipient=self.user1, content='Read')
+		mark_conversation_read(reader=self.user1, other=self.user2)
+		Message.objects.create(sender=self.user1, recipient=self.user2, content='Reply')
+		Message.objects.create(sender=self.user2, recipient=self.user1, content='One')
+		Message.objects.create(sender=self.user2, recipient=self.user1, content='Two')
+		self.client.force_authenticate(user=self.user1)
+		data = self.client.get(self.inbox_url).json()
+		self.assertEqual(len(data), 1)
+		self.assertEqual(data[0]['unread_count'], 2)
+		self.assertEqual(data[0]['last_message']['content'], 'Two')
+		self.assertFalse(data[0]['last_message']['is_read'])
+
+	def test_inbox_query_count_is_constant(self):
+		from chat_app.models import Message
+		for i in range(10):
+			other = User.objects.create_user(username=f'other{i}', email=f'other{i}@example.com', password='testpass123')
+			Message.objects.create(sender=other, recipient=self.user1, content='Ping')
+		self.client.force_authenticate(user=self.user1)
+		# auth is forced, so the only query is the inbox itself
+		with self.assertNumQueries(1):
+			response = self.client.get(self.inbox_url)
+		self.assertEqual(len(response.json()), 10)
+
+	def test_inbox_pagination(self):
+		from chat_app.models import Message
+		Message.objects.create(sender=self.user2, recipient=self.user1, content='Older')
+		Message.objects.create(sender=self.user3, recipient=self.user1, content='Newer')
+		self.client.force_authenticate(user=self.user1)
+
+		first = self.client.get(self.inbox_url, {"limit": 1}).json()
+		self.assertEqual(first['conversations'][0]['user']['id'], self.user3.id)
+		self.assertTrue(first['pagination']['has_next'])
+		self.assertFalse(first['pagination']['has_previous'])
+
+		second = self.client.get(self.inbox_url, {"limit": 1, "offset": 1}).json()
+		self.assertEqual(second['conversations'][0]['user']['id'], self.user2.id)
+		self.assertFalse(second['pagination']['has_next'])
+		self.assertTrue(second['pagination']['has_previous'])
+
+	def test_inbox_invalid_pagination(self):
+		self.client.force_authenticate(user=self.user1)
+		response = self.client.get(self.inbox_url, {"limit": "abc"})
+		self.assertEqual(response.status_code, 400)
+
 	def test_inbox_message_sorting(self):
 		from chat_app.models import Message
 		# Create messages with different timestamps
@@ -205,11 +578,11 @@ class ConversationAPIViewTestCase(TestCase):
 
 	def test_conversation_marks_messages_as_read(self):
 		from chat_app.models import Message
-		message = Message.objects.create(sender=self.user2, recipient=self.user1, content='Test message', is_read=False)
+		message = Message.objects.create(sender=self.user2, recipient=self.user1, content='Test message')
 		self.client.force_authenticate(user=self.user1)
-		_ = self.client.get(self.chat_url)
-		message.refresh_from_db()
-		self.assertTrue(message.is_read)
+		response = self.client.get(self.chat_url)
+		self.assertTrue(response.json()['messages'][0]['is_read'])
+		self.assertTrue(apply_read_states([Message.objects.get(id=message.id)])[0].is_read)
 
 	def test_conversation_message_history(self):
 		from chat_app.models import Message
@@ -234,6 +607,287 @@ class ConversationAPIViewTestCase(TestCase):
 		self.assertTrue(Message.objects.filter(sender=self.user1, recipient=self.user2, content='Hello').exists())
 
 
+class ConversationCursorPaginationTestCase(TestCase):
+	"""Reverse-scroll keyset pagination of ConversationAPIView."""
+
+	def setUp(self):
+		self.client = APIClient()
+		self.user1 = User.objects.create_user(username='user1', email='user1@example.com', password='testpass123')
+		self.user2 = User.objects.create_user(username='user2', email='user2@example.com', password='testpass123')
+		self.chat_url = reverse('chat:chat', args=['user2'])
+		self.messages = [
+			Message.objects.create(
+				sender=self.user1 if i % 2 else self.user2,
+				recipient=self.user2 if i % 2 else self.user1,
+				content=f'Message {i}',
+			)
+			for i in range(7)
+		]
+		self.client.force_authenticate(user=self.user1)
+
+	def test_first_page_is_newest_messages(self):
+		data = self.client.get(self.chat_url, {"page_size": 3}).json()
+		self.assertEqual([m['content'] for m in data['messages']], ['Message 4', 'Message 5', 'Message 6'])
+		self.assertTrue(data['cursor']['has_older'])
+		self.assertFalse(data['cursor']['has_newer'])
+		self.assertEqual(data['cursor']['before_id'], self.messages[4].id)
+
+	def test_pages_backwards_until_start(self):
+		seen = []
+		params = {"page_size": 3}
+		while True:
+			data = self.client.get(self.chat_url, params).json()
+			seen = [m['content'] for m in data['messages']] + seen
+			if not data['cursor']['has_older']:
+				break
+			params = {"page_size": 3, "before_id": data['cursor']['before_id']}
+		self.assertEqual(seen, [f'Message {i}' for i in range(7)])
+
+	def test_after_id_returns_newer_messages(self):
+		data = self.client.get(self.chat_url, {"after_id": self.messages[4].id}).json()
+		self.assertEqual([m['content'] for m in data['messages']], ['Message 5', 'Message 6'])
+		self.assertFalse(data['cursor']['has_newer'])
+
+	def test_same_timestamp_ties_are_ordered_by_id(self):
+		Message.objects.filter(pk__in=[m.id for m in self.messages]).update(timestamp=timezone.now())
+		data = self.client.get(self.chat_url, {"page_size": 4}).json()
+		older = self.client.get(self.chat_url, {"page_size": 4, "before_id": data['cursor']['before_id']}).json()
+		contents = [m['content'] for m in older['messages'] + data['messages']]
+		self.assertEqual(contents, [f'Message {i}' for i in range(7)])
+
+	def test_cursor_mode_never_counts(self):
+		with CaptureQueriesContext(connection) as ctx:
+			self.client.get(self.chat_url, {"page_size": 3, "before_id": self.messages[5].id})
+		self.assertFalse(any('COUNT(' in q['sql'] for q in ctx.captured_queries))
+
+	def test_invalid_cursor(self):
+		user3 = User.objects.create_user(username='user3', email='user3@example.com', password='testpass123')
+		foreign = Message.objects.create(sender=user3, recipient=self.user1, content='Elsewhere')
+		response = self.client.get(self.chat_url, {"before_id": foreign.id})
+		self.assertEqual(response.status_code, 400)
+		response = self.client.get(self.chat_url, {"before_id": "abc"})
+		self.assertEqual(response.status_code, 400)
+
+
+class MessageArchiveTestCase(TestCase):
+	"""Old messages move into compressed blocks and stay readable through every path."""
+
+	def setUp(self):
+		self.client = APIClient()
+		self.user1 = User.objects.create_user(username='arch1', email='arch1@example.com', password='testpass123')
+		self.user2 = User.objects.create_user(username='arch2', email='arch2@example.com', password='testpass123')
+		self.messages = [
+			Message.objects.create(
+				sender=self.user1 if i % 2 else self.user2,
+				recipient=self.user2 if i % 2 else self.user1,
+				content=f'Message {i}',
+			)
+			for i in range(12)
+		]
+		old = timezone.now() - timedelta(days=365)
+		for i, message in enumerate(self.messages[:10]):
+			Message.objects.filter(pk=message.pk).update(timestamp=old + timedelta(minutes=i))
+		self.ids = [message.id for message in self.messages]
+
+	def _archive(self, batch_size=4, block_size=3):
+		from chat_app.archive import archive_batch
+		before = timezone.now() - timedelta(days=30)
+		while archive_batch(before=before, batch_size=batch_size, block_size=block_size):
+			pass
+
+	def test_archiving_moves_old_messages_into_full_blocks(self):
+		self._archive()
+
+		self.assertEqual(list(Message.objects.values_list('id', flat=True)), self.ids[10:])
+		self.assertEqual(
+			list(MessageArchiveBlock.objects.order_by('first_id').values_list('message_count', flat=True)),
+			[3, 3, 3, 1],
+		)
+
+	def test_last_message_of_a_conversation_stays_hot(self):
+		Message.objects.update(timestamp=timezone.now() - timedelta(days=365))
+		self._archive()
+
+		self.assertEqual(Conversation.objects.get().last_message_id, self.ids[-1])
+		self.assertEqual(list(Message.objects.values_list('id', flat=True)), [self.ids[-1]])
+
+	def test_cursor_pages_cross_from_hot_into_archive(self):
+		from chat_app.services import message_page
+		self._archive()
+
+		seen = []
+		before_id = None
+		while True:
+			messages, has_older, _ = message_page(user=self.user1, other=self.user2, page_size=5, before_id=before_id)
+			seen = [message.id for message in messages] + seen
+			if not has_older:
+				break
+			before_id = messages[0].id
+		self.assertEqual(seen, self.ids)
+
+		messages, _, has_newer = message_page(user=self.user1, other=self.user2, page_size=4, after_id=self.ids[7])
+		self.assertEqual([message.id for message in messages], self.ids[8:12])
+		self.assertFalse(has_newer)
+		self.assertEqual(messages[0].sender.username, self.messages[8].sender.username)
+
+	def test_offset_pages_sync_and_read_state_include_archive(self):
+		from chat_app.services import mark_conversation_read, messages_since
+		mark_conversation_read(reader=self.user1, other=self.user2)
+		self._archive()
+		self.client.force_authenticate(user=self.user1)
+
+		data = self.client.get(reverse('chat:chat', args=['arch2']), {"limit": 5, "offset": 8}).json()
+		self.assertEqual([m['id'] for m in data['messages']], self.ids[8:12])
+		self.assertEqual(data['pagination']['count'], 12)
+		self.assertTrue(all(m['is_read'] for m in data['messages'] if m['recipient']['id'] == self.user1.id))
+
+		messages, has_more = messages_since(user=self.user2, after_id=self.ids[2], limit=5)
+		self.assertEqual([message.id for message in messages], self.ids[3:8])
+		self.assertTrue(has_more)
+		self.assertEqual(messages[0].recipient.username, 'arch2')
+
+	def test_reading_after_last_message_deleted_covers_archive(self):
+		from chat_app.services import apply_read_state, conversation_history, get_conversation, mark_conversation_read
+		Message.objects.update(timestamp=timezone.now() - timedelta(days=365))
+		self._archive()
+		Message.objects.filter(pk=self.ids[-1]).delete()
+		self.assertIsNone(Conversation.objects.get().last_message_id)
+
+		mark_conversation_read(reader=self.user1, other=self.user2)
+		conversation = get_conversation(user=self.user1, other=self.user2)
+		messages = conversation_history(user=self.user1, other=self.user2)
+		apply_read_state(messages, conversation)
+		self.assertTrue(all(message.is_read for message in messages if message.recipient_id == self.user1.id))
+
+	def test_archive_reads_fetch_payloads_in_one_query(self):
+		from chat_app.archive import archived_history, archived_page, archived_since, archived_timestamp
+		self._archive(block_size=2)
+		self.assertEqual(MessageArchiveBlock.objects.count(), 5)
+
+		# One metadata query, one payload query, whatever the blocks spanned
+		with self.assertNumQueries(2):
+			history = archived_history(user=self.user1, other=self.user2, offset=1, limit=7)
+		self.assertEqual([message.id for message in history], self.ids[1:8])
+
+		before = (archived_timestamp(user=self.user1, other=self.user2, message_id=self.ids[9]), self.ids[9])
+		with self.assertNumQueries(2):
+			page = archived_page(user=self.user1, other=self.user2, limit=5, before=before)
+		self.assertEqual([message.id for message in page], self.ids[8:3:-1])
+
+		# Plus one for the participants
+		with self.assertNumQueries(3):
+			since = archived_since(user=self.user1, after_id=self.ids[0], limit=6)
+		self.assertEqual([message.id for message in since], self.ids[1:7])
+
+
+class MessageSearchTestCase(TestCase):
+	"""FTS5 search over the caller's conversations."""
+
+	def setUp(self):
+		self.client = APIClient()
+		self.alice = User.objects.create_user(username='s_alice', email='s_alice@example.com', password='testpass123')
+		self.bob = User.objects.create_user(username='s_bob', email='s_bob@example.com', password='testpass123')
+		self.carol = User.objects.create_user(username='s_carol', email='s_carol@example.com', password='testpass123')
+		self.url = reverse('chat:search')
+		self.client.force_authenticate(user=self.alice)
+
+	def _search(self, **params):
+		response = self.client.get(self.url, params)
+		self.assertEqual(response.status_code, 200, response.content)
+		return response.json()
+
+	def _ids(self, **params):
+		return [result['message']['id'] for result in self._search(**params)['results']]
+
+	def test_results_are_scoped_ranked_and_highlighted(self):
+		once = Message.objects.create(sender=self.alice, recipient=self.bob, content='Did you water the monstera today?')
+		twice = Message.objects.create(sender=self.bob, recipient=self.alice, content='Monstera monstera, it loves water')
+		Message.objects.create(sender=self.bob, recipient=self.carol, content='Secret monstera plans')
+		Message.objects.create(sender=self.alice, recipient=self.carol, content='Nothing about plants')
+
+		data = self._search(q='monstera')
+		self.assertEqual([result['message']['id'] for result in data['results']], [twice.id, once.id])
+		self.assertIn('<mark>monstera</mark>', data['results'][1]['snippet'])
+		self.assertEqual(data['results'][0]['message']['sender']['username'], 's_bob')
+		self.assertFalse(data['pagination']['has_next'])
+
+		self.assertEqual(self._ids(q='water monst'), [twice.id, once.id])
+		self.assertEqual(self._ids(q='monstera', limit=1), [twice.id])
+		self.assertEqual(self._ids(q='monstera', **{"with": 's_carol'}), [])
+
+	def test_long_prefixes_and_scope_are_matched_in_the_index(self):
+		from chat_app.search import FTS_TABLE
+		watering = Message.objects.create(sender=self.alice, recipient=self.bob, content='Watering the garden')
+		Message.objects.create(sender=self.alice, recipient=self.bob, content='Water garden tools')
+		Message.objects.create(sender=self.bob, recipient=self.carol, content='Watering the garden too')
+
+		self.assertEqual(self._ids(q='garden wateri'), [watering.id])
+		self.assertEqual(self._ids(q='wateri', **{"with": 's_bob'}), [watering.id])
+		# The scope is matched on these tokens, not on sender_id / recipient_id
+		with connection.cursor() as cursor:
+			cursor.execute(
+				f'SELECT participants FROM {FTS_TABLE} WHERE rowid = %s', [watering.id]
+			)
+			self.assertEqual(
+				cursor.fetchone()[0],
+				f'u{self.alice.id} u{self.bob.id} p{min(self.alice.id, self.bob.id)}x{max(self.alice.id, self.bob.id)}',
+			)
+
+	def test_query_syntax_and_markup_are_not_interpreted(self):
+		message = Message.objects.create(sender=self.alice, recipient=self.bob, content='<b>Zażółć</b> gęślą jaźń')
+
+		self.assertEqual(self._ids(q='gesla'), [message.id])
+		self.assertEqual(self._ids(q='"gęślą" OR NEAR('), [])
+		snippet = self._search(q='jazn')['results'][0]['snippet']
+		self.assertEqual(snippet, '&lt;b&gt;Zażółć&lt;/b&gt; gęślą <mark>jaźń</mark>')
+		self.assertEqual(self.client.get(self.url).status_code, 400)
+
+	def test_index_follows_bulk_writes_deletes_and_archiving(self):
+		from chat_app.archive import archive_batch
+		from chat_app.services import record_messages
+		old, kept, deleted = record_messages(messages=[
+			Message(sender=self.alice, recipient=self.bob, content='ancient fern'),
+			Message(sender=self.bob, recipient=self.alice, content='recent fern'),
+			Message(sender=self.bob, recipient=self.alice, content='doomed fern'),
+		])
+		deleted.delete()
+		Message.objects.filter(pk=old.pk).update(timestamp=timezone.now() - timedelta(days=365))
+		archive_batch(before=timezone.now() - timedelta(days=30), batch_size=10, block_size=10)
+
+		self.assertFalse(Message.objects.filter(pk=old.pk).exists())
+		self.assertEqual(sorted(self._ids(q='fern')), [old.id, kept.id])
+
+		self.carol.delete()
+		self.bob.delete()
+		self.assertEqual(self._ids(q='fern'), [])
+
+	def test_rebuild_keeps_archived_messages_searchable(self):
+		from chat_app.archive import archive_batch
+		from chat_app.search import rebuild_index
+		old = Message.objects.create(sender=self.alice, recipient=self.bob, content='archived orchid')
+		Message.objects.create(sender=self.bob, recipient=self.carol, content='other orchid')
+		Message.objects.filter(pk=old.pk).update(timestamp=timezone.now() - timedelta(days=365))
+		Message.objects.create(sender=self.bob, recipient=self.alice, content='hot orchid')
+		archive_batch(before=timezone.now() - timedelta(days=30), batch_size=10, block_size=10)
+		self.assertTrue(MessageArchiveBlock.objects.exists())
+
+		self.assertEqual(rebuild_index(), 3)
+		self.assertIn(old.id, self._ids(q='orchid'))
+		self.assertEqual(self._ids(q='archived', **{"with": 's_bob'}), [old.id])
+		self.assertEqual(self._ids(q='archived', **{"with": 's_carol'}), [])
+
+	def test_rebuild_command_restores_the_index(self):
+		from io import StringIO
+		from django.core.management import call_command
+		message = Message.objects.create(sender=self.alice, recipient=self.bob, content='cactus')
+		with connection.cursor() as cursor:
+			cursor.execute('DELETE FROM chat_app_message_fts')
+		self.assertEqual(self._ids(q='cactus'), [])
+
+		call_command('rebuild_message_search', stdout=StringIO())
+		self.assertEqual(self._ids(q='cactus'), [message.id])
+
+
 class UserListAPIViewTestCase(TestCase):
 	"""Test cases for the User List API view."""
 
@@ -259,12 +913,424 @@ class UserListAPIViewTestCase(TestCase):
 		self.assertIn(self.user3.id, user_ids)
 		self.assertEqual(len(users), 2)
 
+	def test_user_list_keyset_pages(self):
+		self.client.force_authenticate(user=self.user1)
+		response = self.client.get(self.user_list_url, {"page_size": 1, "fields": "id"})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.json()["results"], [{"id": self.user2.id}])
+		self.assertTrue(response.json()["pagination"]["has_next"])
+
+		response = self.client.get(self.user_list_url, {"page_size": 1, "after_id": self.user2.id})
+		self.assertEqual(response.json()["results"], [{"id": self.user3.id, "username": "user3"}])
+		self.assertFalse(response.json()["pagination"]["has_next"])
+
+
+class RedisPoolTestCase(TestCase):
+
+	def test_pool_is_shared_within_an_event_loop(self):
+		from chat_app.redis_pool import get_async_pool
+
+		async def scenario():
+			return get_async_pool(), get_async_pool()
+
+		first, second = async_to_sync(scenario)()
+		self.assertIs(first, second)
+
+	def test_pool_uses_configured_size(self):
+		from chat_app.redis_pool import get_async_pool
+
+		async def scenario():
+			return get_async_pool()
+
+		with self.settings(REDIS_POOL={
+			"host": "localhost",
+			"port": 6379,
+			"max_connections": 3,
+			"timeout": 1.0,
+			"health_check_interval": 10,
+		}):
+			pool = async_to_sync(scenario)()
+		self.assertEqual(pool.max_connections, 3)
+		self.assertEqual(pool.timeout, 1.0)
+		self.assertEqual(pool.connection_kwargs["health_check_interval"], 10)
+
+	def test_pool_metrics_start_empty(self):
+		from chat_app.redis_pool import get_async_pool, pool_metrics
+
+		async def scenario():
+			get_async_pool()
+			return pool_metrics()
+
+		metrics = async_to_sync(scenario)()
+		self.assertEqual(metrics["in_use"], 0)
+		self.assertEqual(metrics["idle"], 0)
+		self.assertEqual(metrics["acquisitions"], 0)
+
+
+class PresenceCounterTestCase(TestCase):
+	"""Atomic connection tracking scripts and heartbeat sweeper (needs Redis, like the consumer tests)."""
+
+	def setUp(self):
+		self.user_id = 987654
+
+	def _run(self, coro_factory):
+		from chat_app.presence import connection_key, heartbeat_key
+		from chat_app.redis_pool import get_redis
+
+		async def cleanup(client):
+			await client.delete(connection_key(self.user_id))
+			async for key in client.scan_iter(match=heartbeat_key(self.user_id, '*')):
+				await client.delete(key)
+
+		async def scenario():
+			client = get_redis()
+			await cleanup(client)
+			try:
+				return await coro_factory(client)
+			finally:
+				await cleanup(client)
+
+		return async_to_sync(scenario)()
+
+	def test_first_and_last_transitions(self):
+		from chat_app.presence import connection_closed, connection_opened
+
+		async def steps(client):
+			return [
+				await connection_opened(client, self.user_id, 'a'),
+				await connection_opened(client, self.user_id, 'b'),
+				await connection_closed(client, self.user_id, 'a'),
+				await connection_closed(client, self.user_id, 'b'),
+			]
+
+		self.assertEqual(self._run(steps), [(1, True), (2, False), (1, False), (0, True)])
+
+	def test_concurrent_connects_have_single_first_transition(self):
+		import asyncio
+		from chat_app.presence import connection_opened
+
+		async def steps(client):
+			return await asyncio.gather(*[connection_opened(client, self.user_id, f'conn{i}') for i in range(10)])
+
+		results = self._run(steps)
+		self.assertEqual(sum(1 for _, is_first in results if is_first), 1)
+		self.assertEqual(sorted(count for count, _ in results), list(range(1, 11)))
+
+	def test_heartbeat_and_double_close_do_not_flip_presence(self):
+		from chat_app.presence import connection_closed, connection_heartbeat, connection_opened
+
+		async def steps(client):
+			return [
+				await connection_opened(client, self.user_id, 'a'),
+				await connection_heartbeat(client, self.user_id, 'a'),
+				await connection_closed(client, self.user_id, 'a'),
+				await connection_closed(client, self.user_id, 'a'),
+			]
+
+		self.assertEqual(self._run(steps), [(1, True), (1, False), (0, True), (0, False)])
+
+	def test_sweeper_closes_connections_with_expired_heartbeat(self):
+		from chat_app.presence import ONLINE_KEY, connection_opened, heartbeat_key, sweep_dead_connections
+
+		async def steps(client):
+			await connection_opened(client, self.user_id, 'alive')
+			await connection_opened(client, self.user_id, 'crashed')
+			# Simulate a worker that died without closing its connection
+			await client.delete(heartbeat_key(self.user_id, 'crashed'))
+			first_sweep = await database_sync_to_async(sweep_dead_connections)()
+			still_online = await client.sismember(ONLINE_KEY, self.user_id)
+
+			await client.delete(heartbeat_key(self.user_id, 'alive'))
+			second_sweep = await database_sync_to_async(sweep_dead_connections)()
+			online_after = await client.sismember(ONLINE_KEY, self.user_id)
+			return first_sweep, still_online, second_sweep, online_after
+
+		first_sweep, still_online, second_sweep, online_after = self._run(steps)
+		self.assertNotIn(self.user_id, first_sweep)
+		self.assertTrue(still_online)
+		self.assertEqual(second_sweep, [self.user_id])
+		self.assertFalse(online_after)
+
+
+class PresenceFanOutTestCase(TestCase):
+
+	def setUp(self):
+		self.user = User.objects.create_user(username='fan_user', email='fan_user@example.com', password='testpass123')
+		self.friend = User.objects.create_user(username='fan_friend', email='fan_friend@example.com', password='testpass123')
+		self.follower = User.objects.create_user(username='fan_follower', email='fan_follower@example.com', password='testpass123')
+		self.followed = User.objects.create_user(username='fan_followed', email='fan_followed@example.com', password='testpass123')
+		self.stranger = User.objects.create_user(username='fan_stranger', email='fan_stranger@example.com', password='testpass123')
+
+		self.user.following.add(self.friend, self.followed)
+		self.friend.following.add(self.user)
+		self.follower.following.add(self.user)
+
+	def test_audience_is_computed_in_one_query(self):
+		with self.assertNumQueries(1):
+			audience = presence_audience(self.user.id)
+
+		self.assertEqual(audience, {self.friend.id, self.follower.id, self.followed.id})
+
+	def test_broadcast_reaches_every_recipient_with_bounded_concurrency(self):
+		from channels.layers import get_channel_layer
+
+		layer = get_channel_layer()
+		recipient_ids = sorted(presence_audience(self.user.id))
+
+		async def scenario():
+			channels = {}
+			for rid in recipient_ids:
+				channels[rid] = await layer.new_channel()
+				await layer.group_add(f"chat_user_{rid}", channels[rid])
+
+			sent = await broadcast_presence(layer, self.user.id, True, recipient_ids, concurrency=2)
+			received = [await layer.receive(channels[rid]) for rid in recipient_ids]
+			for rid, channel in channels.items():
+				await layer.group_discard(f"chat_user_{rid}", channel)
+			return sent, received
+
+		sent, received = async_to_sync(scenario)()
+		self.assertEqual(sent, len(recipient_ids))
+		for event in received:
+			self.assertEqual(event["type"], "status_update_handler")
+			self.assertEqual(event["user_id"], self.user.id)
+			self.assertTrue(event["is_online"])
+
+	def test_set_offline_drops_every_connection_and_announces_it(self):
+		from asgiref.sync import sync_to_async
+		from channels.layers import get_channel_layer
+		from chat_app.presence import (
+			ONLINE_KEY, connection_key, connection_opened, heartbeat_key, set_offline,
+		)
+		from chat_app.redis_pool import get_redis
+
+		layer = get_channel_layer()
+
+		async def scenario():
+			client = get_redis()
+			channel = await layer.new_channel()
+			await layer.group_add(f"chat_user_{self.friend.id}", channel)
+			await connection_opened(client, self.user.id, 'tab1')
+			await connection_opened(client, self.user.id, 'tab2')
+
+			was_online = await sync_to_async(set_offline)(self.user.id)
+			event = await layer.receive(channel)
+			state = (
+				await client.exists(connection_key(self.user.id), heartbeat_key(self.user.id, 'tab1')),
+				await client.sismember(ONLINE_KEY, self.user.id),
+			)
+			# Already offline: nothing more to announce
+			again = await sync_to_async(set_offline)(self.user.id)
+			await layer.group_discard(f"chat_user_{self.friend.id}", channel)
+			return was_online, event, state, again
+
+		was_online, event, state, again = async_to_sync(scenario)()
+		self.assertTrue(was_online)
+		self.assertEqual(event, {"type": "status_update_handler", "user_id": self.user.id, "is_online": False})
+		self.assertEqual(state, (0, False))
+		self.assertFalse(again)
+
+
+class UsernameCacheTestCase(TransactionTestCase):
+
+	def setUp(self):
+		self.user = User.objects.create_user(username='cache_user', email='cache_user@example.com', password='testpass123')
+		user_cache._local.clear()
+		invalidate_usernames('cache_user', 'cache_renamed', 'cache_ghost')
+
+	def _resolve(self, username):
+		return async_to_sync(resolve_username)(username)
+
+	def test_repeated_lookups_skip_the_database(self):
+		with patch.object(user_cache, '_load_from_database', wraps=user_cache._load_from_database) as load:
+			first = self._resolve('cache_user')
+			second = self._resolve('cache_user')
+
+			# Another process only has the Redis copy
+			user_cache._local.clear()
+			third = self._resolve('cache_user')
+
+		self.assertEqual(first, (self.user.id, 'cache_user'))
+		self.assertEqual(first, second)
+		self.assertEqual(first, third)
+		self.assertEqual(load.call_count, 1)
+
+	def test_unknown_username_is_cached_until_registration(self):
+		with patch.object(user_cache, '_load_from_database', wraps=user_cache._load_from_database) as load:
+			self.assertIsNone(self._resolve('cache_ghost'))
+			self.assertIsNone(self._resolve('cache_ghost'))
+			self.assertEqual(load.call_count, 1)
+
+		ghost = User.objects.create_user(username='cache_ghost', email='cache_ghost@example.com', password='testpass123')
+		self.assertEqual(self._resolve('cache_ghost'), (ghost.id, 'cache_ghost'))
+
+	def test_rename_through_update_serializer_invalidates(self):
+		from users.serializers import UserUpdateSerializer
+
+		self.assertIsNotNone(self._resolve('cache_user'))
+		self.assertIsNone(self._resolve('cache_renamed'))
+
+		serializer = UserUpdateSerializer(self.user, data={'username': 'cache_renamed'}, partial=True)
+		self.assertTrue(serializer.is_valid(), serializer.errors)
+		serializer.save()
+
+		self.assertIsNone(self._resolve('cache_user'))
+		self.assertEqual(self._resolve('cache_renamed'), (self.user.id, 'cache_renamed'))
+
+
+class UsernameInvalidationTestCase(TestCase):
+
+	def setUp(self):
+		user_cache._local.clear()
+		user_cache.get_sync_redis().delete(user_cache.username_key('cache_late'))
+
+	def _resolve(self, username):
+		return async_to_sync(resolve_username)(username)
+
+	def test_registration_is_forgotten_on_commit(self):
+		self.assertIsNone(self._resolve('cache_late'))
+
+		with self.captureOnCommitCallbacks() as callbacks:
+			late = User.objects.create_user(username='cache_late', email='cache_late@example.com', password='testpass123')
+			# Not committed yet: the cached miss is still the truth elsewhere
+			self.assertTrue(user_cache.get_sync_redis().exists(user_cache.username_key('cache_late')))
+			self.assertIsNone(self._resolve('cache_late'))
+
+		for callback in callbacks:
+			callback()
+		self.assertFalse(user_cache.get_sync_redis().exists(user_cache.username_key('cache_late')))
+		self.assertEqual(self._resolve('cache_late'), (late.id, 'cache_late'))
+
+
+class MessageBufferTestCase(TransactionTestCase):
+
+	def setUp(self):
+		self.alice = User.objects.create_user(username='buf_alice', email='buf_alice@example.com', password='testpass123')
+		self.bob = User.objects.create_user(username='buf_bob', email='buf_bob@example.com', password='testpass123')
+
+	def test_concurrent_messages_are_written_in_one_batch(self):
+		import asyncio
+		from chat_app import services
+
+		buffer = MessageBuffer(flush_window_ms=50, max_batch=100)
+
+		async def scenario():
+			return await asyncio.gather(*[
+				buffer.submit(sender=self.alice, recipient=self.bob, content=f'batched {i}')
+				for i in range(10)
+			])
+
+		with patch('chat_app.message_buffer.record_messages', wraps=services.record_messages) as record:
+			saved = async_to_sync(scenario)()
+
+		self.assertEqual(record.call_count, 1)
+		self.assertTrue(all(message.id and message.timestamp for message in saved))
+		self.assertEqual(Message.objects.filter(sender=self.alice, recipient=self.bob).count(), 10)
+
+		conversation = Conversation.objects.get()
+		self.assertEqual(conversation.unread_for(self.bob), 10)
+		self.assertEqual(conversation.last_message_id, max(message.id for message in saved))
+
+	def test_max_batch_flushes_before_the_window(self):
+		import asyncio
+
+		buffer = MessageBuffer(flush_window_ms=60000, max_batch=3)
+
+		async def scenario():
+			return await asyncio.wait_for(asyncio.gather(*[
+				buffer.submit(sender=self.alice, recipient=self.bob, content=f'full {i}')
+				for i in range(3)
+			]), timeout=5)
+
+		self.assertEqual(len(async_to_sync(scenario)()), 3)
+
+	def test_bad_message_does_not_fail_the_batch(self):
+		import asyncio
+
+		buffer = MessageBuffer(flush_window_ms=50, max_batch=100)
+		ghost = User(id=999999, username='buf_ghost')
+
+		async def scenario():
+			return await asyncio.gather(
+				buffer.submit(sender=self.alice, recipient=self.bob, content='ok'),
+				buffer.submit(sender=self.alice, recipient=ghost, content='lost'),
+				return_exceptions=True,
+			)
+
+		ok, lost = async_to_sync(scenario)()
+		self.assertEqual(ok.content, 'ok')
+		self.assertIsInstance(lost, Exception)
+		self.assertEqual(Message.objects.count(), 1)
+
+
+class TypingCoalescerTestCase(TestCase):
+
+	def _run(self, steps, min_interval=0.05, stop_timeout=0.2):
+		import asyncio
+
+		async def scenario():
+			sent = []
+
+			async def send(recipient_id, is_typing):
+				sent.append((recipient_id, is_typing))
+
+			coalescer = TypingCoalescer(send, min_interval=min_interval, stop_timeout=stop_timeout)
+			await steps(coalescer, asyncio.sleep, sent)
+			await asyncio.sleep(0)
+			return sent, coalescer
+
+		return async_to_sync(scenario)()
+
+	def test_keystroke_burst_emits_single_start(self):
+		async def steps(coalescer, sleep, sent):
+			for _ in range(50):
+				coalescer.update(7, True)
+			await sleep(0.01)
+
+		sent, _ = self._run(steps)
+		self.assertEqual(sent, [(7, True)])
+
+	def test_explicit_stop_is_spaced_by_min_interval(self):
+		async def steps(coalescer, sleep, sent):
+			coalescer.update(7, True)
+			coalescer.update(7, False)
+			await sleep(0.01)
+			# The stop is held back until min_interval after the start
+			self.assertEqual(sent, [(7, True)])
+			await sleep(0.1)
+
+		sent, _ = self._run(steps)
+		self.assertEqual(sent, [(7, True), (7, False)])
+
+	def test_flapping_inside_interval_is_dropped(self):
+		async def steps(coalescer, sleep, sent):
+			coalescer.update(7, True)
+			coalescer.update(7, False)
+			coalescer.update(7, True)
+			await sleep(0.1)
+
+		sent, _ = self._run(steps)
+		self.assertEqual(sent, [(7, True)])
+
+	def test_stop_timeout_and_close(self):
+		async def steps(coalescer, sleep, sent):
+			coalescer.update(7, True)
+			await sleep(0.3)
+			coalescer.update(8, True)
+			await sleep(0.01)
+			await coalescer.close()
+
+		sent, coalescer = self._run(steps)
+		self.assertEqual(sent, [(7, True), (7, False), (8, True), (8, False)])
+		self.assertEqual(coalescer._pairs, {})
+
 
 class ChatConsumerWebSocketTestCase(TransactionTestCase):
 	def setUp(self):
 		self.user1 = User.objects.create_user(username='ws_user1', email='ws_user1@example.com', password='testpass123')
 		self.user2 = User.objects.create_user(username='ws_user2', email='ws_user2@example.com', password='testpass123')
 		self.application = JwtAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+		unread_counters.forget_all()
 
 	def _token(self, user):
 		return str(AccessToken.for_user(user))
@@ -283,11 +1349,85 @@ class ChatConsumerWebSocketTestCase(TransactionTestCase):
 			connected, _ = await communicator.connect()
 			self.assertTrue(connected)
 
+			self.assertTrue(await database_sync_to_async(is_online)(self.user1))
+
+			await communicator.disconnect()
+
+			self.assertFalse(await database_sync_to_async(is_online)(self.user1))
+
+		async_to_sync(scenario)()
+
+	def test_websocket_ping_refreshes_heartbeat(self):
+		async def scenario():
+			communicator = WebsocketCommunicator(self.application, f"/ws/chat/?token={self._token(self.user1)}")
+			connected, _ = await communicator.connect()
+			self.assertTrue(connected)
+
+			await communicator.send_json_to({"type": "ping"})
+			self.assertEqual(await communicator.receive_json_from(), {"type": "pong"})
+			self.assertTrue(await database_sync_to_async(is_online)(self.user1))
+
+			await communicator.disconnect()
+
+		async_to_sync(scenario)()
+
+	def test_websocket_msgpack_subprotocol(self):
+		import msgpack
+		from chat_app.codecs import MSGPACK_SUBPROTOCOL
+
+		async def scenario():
+			communicator = WebsocketCommunicator(
+				self.application,
+				f"/ws/chat/?token={self._token(self.user1)}",
+				subprotocols=[MSGPACK_SUBPROTOCOL],
+			)
+			connected, subprotocol = await communicator.connect()
+			self.assertTrue(connected)
+			self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+
+			await communicator.send_to(bytes_data=msgpack.packb({"type": "ping"}))
+			self.assertEqual(msgpack.unpackb(await communicator.receive_from()), {"type": "pong"})
+
+			await communicator.send_to(bytes_data=b"\xc1")
+			response = msgpack.unpackb(await communicator.receive_from())
+			self.assertEqual(response["error"], "Invalid msgpack frame")
+
+			await communicator.disconnect()
+
+		async_to_sync(scenario)()
+
+	def test_websocket_token_in_subprotocol(self):
+		async def scenario():
+			communicator = WebsocketCommunicator(
+				self.application,
+				"/ws/chat/",
+				subprotocols=[AUTH_SUBPROTOCOL, self._token(self.user1)],
+			)
+			connected, subprotocol = await communicator.connect()
+			self.assertTrue(connected)
+			# The token itself is never echoed back
+			self.assertEqual(subprotocol, AUTH_SUBPROTOCOL)
+			await communicator.disconnect()
+
+		async_to_sync(scenario)()
+
+	def test_presence_is_flushed_to_database_in_batches(self):
+		async def scenario():
+			communicator = WebsocketCommunicator(self.application, f"/ws/chat/?token={self._token(self.user1)}")
+			connected, _ = await communicator.connect()
+			self.assertTrue(connected)
+
+			# Connecting does not write the users table by itself
+			user1 = await database_sync_to_async(User.objects.get)(pk=self.user1.pk)
+			self.assertFalse(user1.is_online)
+
+			await database_sync_to_async(flush_to_database)()
 			user1 = await database_sync_to_async(User.objects.get)(pk=self.user1.pk)
 			self.assertTrue(user1.is_online)
+			self.assertIsNotNone(user1.last_seen)
 
 			await communicator.disconnect()
-
+			await database_sync_to_async(flush_to_database)()
 			user1 = await database_sync_to_async(User.objects.get)(pk=self.user1.pk)
 			self.assertFalse(user1.is_online)
 
@@ -315,6 +1455,7 @@ class ChatConsumerWebSocketTestCase(TransactionTestCase):
 			self.assertEqual(sender_response["type"], "message_sent")
 			self.assertEqual(recipient_response["type"], "new_message")
 			self.assertEqual(recipient_response["message"]["content"], "Hello via websocket")
+			self.assertEqual(recipient_response["unread_count"], 1)
 
 			exists = await database_sync_to_async(Message.objects.filter(
 				sender=self.user1,
@@ -328,6 +1469,46 @@ class ChatConsumerWebSocketTestCase(TransactionTestCase):
 
 		async_to_sync(scenario)()
 
+	def test_sync_replays_missed_messages_in_chunks(self):
+		user3 = User.objects.create_user(username='ws_user3', email='ws_user3@example.com', password='testpass123')
+		seen = Message.objects.create(sender=self.user2, recipient=self.user1, content='seen')
+		missed = [
+			Message.objects.create(sender=self.user2, recipient=self.user1, content='missed 1'),
+			Message.objects.create(sender=self.user1, recipient=self.user2, content='sent elsewhere'),
+			Message.objects.create(sender=user3, recipient=self.user2, content='not mine'),
+			Message.objects.create(sender=user3, recipient=self.user1, content='missed 2'),
+		]
+		expected = [message.id for message in missed if self.user1.id in (message.sender_id, message.recipient_id)]
+
+		async def scenario():
+			communicator = WebsocketCommunicator(self.application, f"/ws/chat/?token={self._token(self.user1)}")
+			connected, _ = await communicator.connect()
+			self.assertTrue(connected)
+
+			with patch('chat_app.consumers.SYNC_CHUNK_SIZE', 2), patch('chat_app.consumers.SYNC_MAX_MESSAGES', 2):
+				await communicator.send_json_to({"type": "sync", "after_id": seen.id})
+				batch = await communicator.receive_json_from()
+				self.assertEqual(batch["type"], "sync_batch")
+				self.assertEqual([message["id"] for message in batch["messages"]], expected[:2])
+				complete = await communicator.receive_json_from()
+				self.assertEqual(complete, {"type": "sync_complete", "cursor": expected[1], "has_more": True})
+
+				await communicator.send_json_to({"type": "sync", "after_id": complete["cursor"]})
+				batch = await communicator.receive_json_from()
+				self.assertEqual([message["id"] for message in batch["messages"]], expected[2:])
+				self.assertEqual(batch["messages"][0]["sender"]["username"], 'ws_user3')
+				self.assertFalse(batch["messages"][0]["is_read"])
+				complete = await communicator.receive_json_from()
+				self.assertEqual(complete, {"type": "sync_complete", "cursor": expected[2], "has_more": False})
+
+			await communicator.send_json_to({"type": "sync", "after_id": -1})
+			response = await communicator.receive_json_from()
+			self.assertEqual(response["error"], "after_id must be a non-negative integer")
+
+			await communicator.disconnect()
+
+		async_to_sync(scenario)()
+
 	def test_chat_message_rejects_too_long_content(self):
 		async def scenario():
 			communicator = WebsocketCommunicator(self.application, f"/ws/chat/?token={self._token(self.user1)}")
@@ -523,16 +1704,89 @@ class ChatConsumerWebSocketTestCase(TransactionTestCase):
 
 		async_to_sync(scenario)()
 
+	def test_websocket_typing_frames_are_coalesced(self):
+		async def scenario():
+			sender = WebsocketCommunicator(self.application, f"/ws/chat/?token={self._token(self.user1)}")
+			recipient = WebsocketCommunicator(self.application, f"/ws/chat/?token={self._token(self.user2)}")
+
+			await sender.connect()
+			await recipient.connect()
+
+			for _ in range(20):
+				await sender.send_json_to({
+					"type": "typing",
+					"recipient_username": self.user2.username,
+				})
+
+			response = await recipient.receive_json_from()
+			self.assertEqual(response, {"type": "typing", "username": self.user1.username, "is_typing": True})
+			self.assertTrue(await recipient.receive_nothing(timeout=0.3))
+
+			# Closing the connection sends the final "stopped"
+			await sender.disconnect()
+			response = await recipient.receive_json_from()
+			self.assertFalse(response["is_typing"])
+
+			await sender.disconnect()
+			await recipient.disconnect()
+
+		async_to_sync(scenario)()
+
+
+class LoadTestChatCommandTestCase(TransactionTestCase):
+	"""The load_test_chat command runs end to end and cleans up after itself."""
+
+	def test_run_reports_traffic_and_cleanup_restores_the_database(self):
+		import json
+		from io import StringIO
+		from django.core.management import call_command
+
+		# Left over from an earlier run: two of the users and their conversation
+		kept_low = User.objects.create_user(username='lt_0', email='lt_0@example.com', password='testpass123')
+		kept_high = User.objects.create_user(username='lt_1', email='lt_1@example.com', password='testpass123')
+		earlier = Message.objects.create(sender=kept_low, recipient=kept_high, content='before the run')
+		before = Conversation.objects.values(
+			'id', 'last_message', 'last_timestamp', 'unread_low', 'unread_high', 'read_low', 'read_high'
+		).get()
+
+		out = StringIO()
+		call_command(
+			'load_test_chat', clients=3, duration=0.5, rate=30, seed=1, drain=1.0,
+			prefix='lt', json_path='-', stdout=out,
+		)
+		report = json.loads(out.getvalue())
+		self.assertGreater(report['messages']['sent'], 0)
+		self.assertEqual(report['messages']['lost'], 0)
+		self.assertEqual(report['errors'], 0)
+
+		self.assertEqual(set(User.objects.values_list('username', flat=True)), {'lt_0', 'lt_1'})
+		self.assertEqual(list(Message.objects.values_list('id', flat=True)), [earlier.id])
+		self.assertEqual(list(Conversation.objects.values(*before)), [before])
+
+	def test_no_cleanup_keeps_what_the_run_wrote(self):
+		from io import StringIO
+		from django.core.management import call_command
+
+		call_command(
+			'load_test_chat', clients=2, duration=0.3, rate=30, seed=1, drain=0.5,
+			mix={'chat': 1}, prefix='lt', cleanup=False, stdout=StringIO(),
+		)
+		self.assertEqual(User.objects.filter(username__startswith='lt_').count(), 2)
+		self.assertTrue(Message.objects.exists())
+		self.assertEqual(Conversation.objects.count(), 1)
+
 
 class JwtAuthMiddlewareTestCase(TransactionTestCase):
 	def setUp(self):
 		self.user = User.objects.create_user(username='jwt_user', email='jwt_user@example.com', password='testpass123')
+		jwt_middleware._user_cache.clear()
 
-	def _run_middleware(self, scope):
-		captured = {}
+	def _run_middleware(self, scope, captured=None):
+		captured = {} if captured is None else captured
 
 		async def inner(inner_scope, receive, send):
 			captured["user"] = inner_scope.get("user")
+			captured["subprotocols"] = inner_scope.get("subprotocols")
 			await send({"type": "test.complete"})
 
 		middleware = JwtAuthMiddlewareStack(inner)
@@ -567,6 +1821,77 @@ class JwtAuthMiddlewareTestCase(TransactionTestCase):
 		self.assertIsInstance(user, AnonymousUser)
 		self.assertFalse(user.is_authenticated)
 
+	def test_middleware_caches_user_per_token(self):
+		token = AccessToken.for_user(self.user)
+
+		with patch('chat_app.middleware._get_user_by_id', wraps=jwt_middleware._get_user_by_id) as load:
+			for _ in range(3):
+				scope = {"type": "websocket", "query_string": f"token={token}".encode(), "user": None}
+				self.assertEqual(self._run_middleware(scope).id, self.user.id)
+			self.assertEqual(load.call_count, 1)
+
+			# A different token (new jti) is resolved again
+			other = str(AccessToken.for_user(self.user))
+			self._run_middleware({"type": "websocket", "query_string": f"token={other}".encode(), "user": None})
+			self.assertEqual(load.call_count, 2)
+
+			# Saving the user drops its cached copies
+			self.user.first_name = 'Renamed'
+			self.user.save()
+			user = self._run_middleware({"type": "websocket", "query_string": f"token={token}".encode(), "user": None})
+			self.assertEqual(load.call_count, 3)
+			self.assertEqual(user.first_name, 'Renamed')
+
+	def test_cached_user_is_dropped_when_another_worker_changes_it(self):
+		from chat_app.middleware import _bump_version
+		token = AccessToken.for_user(self.user)
+		def scope():
+			return {"type": "websocket", "query_string": f"token={token}".encode(), "user": None}
+
+		self.assertTrue(self._run_middleware(scope()).is_authenticated)
+
+		# Deactivated elsewhere: this worker's local copy is still there,
+		# only the shared version moved
+		User.objects.filter(pk=self.user.pk).update(is_active=False)
+		self.assertTrue(self._run_middleware(scope()).is_authenticated)
+		_bump_version(self.user.pk)
+		self.assertFalse(self._run_middleware(scope()).is_authenticated)
+
+		User.objects.filter(pk=self.user.pk).update(is_active=True)
+		_bump_version(self.user.pk)
+		self.assertTrue(self._run_middleware(scope()).is_authenticated)
+		User.objects.filter(pk=self.user.pk).delete()
+		self.assertIsInstance(self._run_middleware(scope()), AnonymousUser)
+
+	def test_redis_outage_reads_the_user_from_the_database(self):
+		import redis
+		token = AccessToken.for_user(self.user)
+		def scope():
+			return {"type": "websocket", "query_string": f"token={token}".encode(), "user": None}
+
+		self._run_middleware(scope())
+
+		with patch('chat_app.middleware.get_redis') as get_redis, \
+				patch('chat_app.middleware._get_user_by_id', wraps=jwt_middleware._get_user_by_id) as load:
+			get_redis.return_value.get.side_effect = redis.RedisError
+			self.assertEqual(self._run_middleware(scope()).id, self.user.id)
+			self.assertEqual(load.call_count, 1)
+
+	def test_middleware_accepts_token_from_subprotocol(self):
+		token = str(AccessToken.for_user(self.user))
+		scope = {
+			"type": "websocket",
+			"query_string": b"",
+			"subprotocols": ["plantapp.msgpack.v1", AUTH_SUBPROTOCOL, token],
+			"user": None,
+		}
+		captured = {}
+
+		user = self._run_middleware(scope, captured)
+
+		self.assertEqual(user.id, self.user.id)
+		self.assertEqual(captured["subprotocols"], [AUTH_SUBPROTOCOL, "plantapp.msgpack.v1"])
+
 	def test_middleware_preserves_existing_authenticated_scope_user(self):
 		scope = {
 			"type": "websocket",
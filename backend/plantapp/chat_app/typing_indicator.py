@@ -0,0 +1,118 @@
+"""
+Server-side coalescing of typing indicators.
+
+Clients send a typing frame per keystroke. A TypingCoalescer (one per
+websocket connection) keeps the typing state per recipient and only emits
+edge transitions: "started" when the sender begins typing and "stopped"
+when it sends is_typing=false or goes quiet for TYPING_STOP_TIMEOUT_SECONDS.
+Two transitions for the same recipient are at least
+TYPING_MIN_INTERVAL_SECONDS apart; a transition that comes too early is
+deferred and dropped if the state flips back meanwhile.
+
+The frames recipients get are unchanged: {"type": "typing", "username",
+"is_typing"}, just far fewer of them.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+TYPING_MIN_INTERVAL_SECONDS = 1.0
+TYPING_STOP_TIMEOUT_SECONDS = 5.0
+
+
+class _PairState:
+    __slots__ = ("desired", "emitted", "last_emit", "flush_handle", "stop_handle")
+
+    def __init__(self):
+        self.desired = False
+        self.emitted = False
+        self.last_emit = float("-inf")
+        self.flush_handle = None
+        self.stop_handle = None
+
+
+class TypingCoalescer:
+    """
+    `send(recipient_id, is_typing)` is a coroutine function called for each
+    transition that survives coalescing.
+    """
+
+    def __init__(self, send, min_interval=TYPING_MIN_INTERVAL_SECONDS, stop_timeout=TYPING_STOP_TIMEOUT_SECONDS):
+        self._send = send
+        self.min_interval = min_interval
+        self.stop_timeout = stop_timeout
+        self._pairs = {}
+        self._tasks = set()
+
+    def update(self, recipient_id, is_typing):
+        """Record a typing frame towards `recipient_id`."""
+        loop = asyncio.get_running_loop()
+        state = self._pairs.setdefault(recipient_id, _PairState())
+        state.desired = bool(is_typing)
+
+        if state.stop_handle is not None:
+            state.stop_handle.cancel()
+            state.stop_handle = None
+        if state.desired:
+            state.stop_handle = loop.call_later(self.stop_timeout, self.update, recipient_id, False)
+
+        self._schedule(recipient_id, state)
+
+    def _schedule(self, recipient_id, state):
+        if state.desired == state.emitted:
+            # Flipped back before the deferred transition went out
+            if state.flush_handle is not None:
+                state.flush_handle.cancel()
+                state.flush_handle = None
+            self._forget_if_idle(recipient_id, state)
+            return
+
+        wait = state.last_emit + self.min_interval - time.monotonic()
+        if wait <= 0:
+            self._emit(recipient_id, state)
+        elif state.flush_handle is None:
+            state.flush_handle = asyncio.get_running_loop().call_later(wait, self._flush, recipient_id)
+
+    def _flush(self, recipient_id):
+        state = self._pairs.get(recipient_id)
+        if state is None:
+            return
+        state.flush_handle = None
+        self._schedule(recipient_id, state)
+
+    def _emit(self, recipient_id, state):
+        if state.flush_handle is not None:
+            state.flush_handle.cancel()
+            state.flush_handle = None
+        state.emitted = state.desired
+        state.last_emit = time.monotonic()
+        task = asyncio.ensure_future(self._send(recipient_id, state.emitted))
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        self._forget_if_idle(recipient_id, state)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Failed to send typing indicator", exc_info=task.exception())
+
+    def _forget_if_idle(self, recipient_id, state):
+        if not state.desired and not state.emitted and state.flush_handle is None:
+            # Keep last_emit while inside the interval so a quick restart is still spaced out
+            if time.monotonic() - state.last_emit >= self.min_interval:
+                self._pairs.pop(recipient_id, None)
+
+    async def close(self):
+        """Cancel pending timers and tell every recipient still seeing "typing" that it stopped."""
+        pairs, self._pairs = self._pairs, {}
+        sends = []
+        for recipient_id, state in pairs.items():
+            for handle in (state.flush_handle, state.stop_handle):
+                if handle is not None:
+                    handle.cancel()
+            if state.emitted:
+                sends.append(self._send(recipient_id, False))
+        if sends:
+            await asyncio.gather(*sends, return_exceptions=True)
@@ -0,0 +1,156 @@
+"""
+Redis mirror of the unread counters.
+
+The Conversation rows (unread_low / unread_high) stay the source of
+truth; this keeps a copy per user so the unread-count endpoint and the
+websocket events read it in O(1): one hash per user, with a field per
+sender and a "total" field.
+
+Writers only adjust a hash that already exists, after their transaction
+commits. A missing hash (new user, expired, or Redis restarted without
+persistence) is rebuilt from the Conversation table on the next read.
+Hashes expire after COUNTER_TTL_SECONDS, so any drift heals itself.
+Redis errors never fail a request; readers then use the database.
+"""
+import logging
+
+import redis
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Conversation
+from .redis_pool import get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+UNREAD_KEY = "unread:{user_id}"
+TOTAL_FIELD = "total"
+COUNTER_TTL_SECONDS = 3600
+
+# KEYS = unread hash; ARGV = sender id, amount. No-op if the hash is not loaded.
+_INCREMENT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+redis.call('HINCRBY', KEYS[1], 'total', ARGV[2])
+return 1
+"""
+
+# KEYS = unread hash; ARGV = sender id, new count. Keeps "total" in step.
+_SET_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local old = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+local new = tonumber(ARGV[2])
+if new == 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+else
+    redis.call('HSET', KEYS[1], ARGV[1], new)
+end
+redis.call('HINCRBY', KEYS[1], 'total', new - old)
+return 1
+"""
+
+# KEYS = unread hash; ARGV = ttl, total, sender, count, sender, count...
+# Loads a rebuilt hash unless a concurrent reader already did.
+_LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'total', ARGV[2], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+def unread_key(user_id):
+    return UNREAD_KEY.format(user_id=user_id)
+
+
+def _counts_from_database(user_id):
+    """{sender_id: unread} for `user_id`, read from its Conversation rows."""
+    counts = {}
+    rows = Conversation.objects.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id)).values_list(
+        'user_low_id', 'user_high_id', 'unread_low', 'unread_high'
+    )
+    for user_low_id, user_high_id, unread_low, unread_high in rows:
+        if user_low_id == user_id and unread_low:
+            counts[user_high_id] = unread_low
+        elif user_high_id == user_id and unread_high:
+            counts[user_low_id] = unread_high
+    return counts
+
+
+def _run(script, user_id, args):
+    try:
+        client = get_sync_redis()
+        client.register_script(script)(keys=[unread_key(user_id)], args=args)
+    except redis.RedisError:
+        logger.warning("Could not update unread counters of user %s", user_id, exc_info=True)
+
+
+def add_unread(recipient_id, sender_id, amount):
+    """Count `amount` new messages from sender to recipient once the transaction commits."""
+    transaction.on_commit(lambda: _run(_INCREMENT_SCRIPT, recipient_id, [sender_id, amount]))
+
+
+def set_unread(reader_id, sender_id, count):
+    """Set what `reader_id` has unread from `sender_id` once the transaction commits."""
+    transaction.on_commit(lambda: _run(_SET_SCRIPT, reader_id, [sender_id, count]))
+
+
+def load_counts(user_id):
+    """Rebuild the hash of `user_id` from the database; returns `(total, per_sender)`."""
+    counts = _counts_from_database(user_id)
+    total = sum(counts.values())
+    args = [COUNTER_TTL_SECONDS, total]
+    for sender_id, count in counts.items():
+        args.extend([sender_id, count])
+    _run(_LOAD_SCRIPT, user_id, args)
+    return total, counts
+
+
+def _parse(raw):
+    total = int(raw.pop(TOTAL_FIELD, 0))
+    return total, {int(sender_id): int(count) for sender_id, count in raw.items() if int(count)}
+
+
+def unread_counts(user_id):
+    """`(total, {sender_id: count})` for `user_id`: one HGETALL, or a rebuild."""
+    try:
+        raw = get_sync_redis().hgetall(unread_key(user_id))
+    except redis.RedisError:
+        logger.warning("Unread counters unavailable, reading from the database", exc_info=True)
+        counts = _counts_from_database(user_id)
+        return sum(counts.values()), counts
+    if raw:
+        return _parse(raw)
+    return load_counts(user_id)
+
+
+async def unread_total_async(redis_client, user_id, load):
+    """
+    Total unread of `user_id` for the websocket consumer: one HGET, and
+    only when the hash is missing `await load(user_id)` (load_counts
+    wrapped in database_sync_to_async).
+    """
+    try:
+        total = await redis_client.hget(unread_key(user_id), TOTAL_FIELD)
+    except redis.RedisError:
+        logger.warning("Unread counters unavailable", exc_info=True)
+        total = None
+    if total is not None:
+        return int(total)
+    total, _ = await load(user_id)
+    return total
+
+
+def forget_all(scan_count=500):
+    """Drop every unread hash (after the counters were rebuilt in the database)."""
+    client = get_sync_redis()
+    keys = list(client.scan_iter(match=UNREAD_KEY.format(user_id='*'), count=scan_count))
+    for start in range(0, len(keys), scan_count):
+        client.unlink(*keys[start:start + scan_count])
+    return len(keys)
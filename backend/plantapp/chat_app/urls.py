@@ -7,5 +7,6 @@ urlpatterns = [
     path('', views.InboxAPIView.as_view(), name='index'),
     path('users/', views.UserListAPIView.as_view(), name='user_list'),
     path('unread-count/', views.UnreadCountAPIView.as_view(), name='unread_count'),
+    path('search/', views.MessageSearchAPIView.as_view(), name='search'),
     path('chat/<str:username>/', views.ConversationAPIView.as_view(), name='chat'),
 ]
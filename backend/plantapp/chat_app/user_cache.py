@@ -0,0 +1,165 @@
+"""
+Username -> user resolution cache for the websocket hot path.
+
+Typing indicators, read receipts and chat messages address the other user
+by username. resolve_username() answers from a process-local LRU first,
+then from Redis, and only then from the database, so a typing burst does
+not cost a thread-pool hop and a query per frame. Unknown usernames are
+cached too, for a much shorter time.
+
+Renames, registrations and deletions call invalidate_usernames(), which
+clears Redis and the local LRU of the current process on commit. Other processes
+drop their copy after LOCAL_TTL_SECONDS at the latest.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import redis
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from .redis_pool import get_redis, get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+CachedUser = namedtuple("CachedUser", ["id", "username"])
+
+USERNAME_KEY = "usercache:username:{username}"
+LOCAL_MAX_ENTRIES = 10000
+LOCAL_TTL_SECONDS = 30
+REDIS_TTL_SECONDS = 600
+# Unknown usernames may be registered at any moment, keep them briefly
+NEGATIVE_TTL_SECONDS = 5
+# Value stored in Redis for a username that does not exist
+_NEGATIVE = ""
+
+
+class LocalLRU:
+    """Thread-safe LRU of (value, expires_at) entries with per-entry TTL."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return `(found, value)`; expired entries count as not found."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def pop_matching(self, predicate):
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+_local = LocalLRU(LOCAL_MAX_ENTRIES)
+
+
+def username_key(username):
+    return USERNAME_KEY.format(username=username)
+
+
+def _remember(username, user):
+    _local.set(username, user, LOCAL_TTL_SECONDS if user else NEGATIVE_TTL_SECONDS)
+
+
+def _load_from_database(username):
+    row = get_user_model().objects.filter(username=username).values_list('id', 'username').first()
+    return CachedUser(*row) if row else None
+
+
+async def resolve_username(username):
+    """
+    Resolve `username` to a CachedUser(id, username), or None if no such
+    user exists. Falls through to the database when Redis is unavailable.
+    """
+    if not username:
+        return None
+
+    found, user = _local.get(username)
+    if found:
+        return user
+
+    client = get_redis()
+    try:
+        raw = await client.get(username_key(username))
+    except redis.RedisError:
+        logger.warning("Username cache unavailable, reading from the database", exc_info=True)
+        client, raw = None, None
+
+    if raw is not None:
+        user = CachedUser(int(raw), username) if raw != _NEGATIVE else None
+        _remember(username, user)
+        return user
+
+    user = await database_sync_to_async(_load_from_database)(username)
+    _remember(username, user)
+    if client is not None:
+        try:
+            await client.set(
+                username_key(username),
+                user.id if user else _NEGATIVE,
+                ex=REDIS_TTL_SECONDS if user else NEGATIVE_TTL_SECONDS,
+            )
+        except redis.RedisError:
+            logger.warning("Could not store username %r in the cache", username, exc_info=True)
+    return user
+
+
+def invalidate_usernames(*usernames):
+    """
+    Forget cached resolutions of `usernames` (renamed, registered or
+    deleted users) once the change is committed, so no lookup can cache
+    the old row again after it was forgotten.
+    """
+    usernames = [username for username in usernames if username]
+    if usernames:
+        transaction.on_commit(lambda: _forget_usernames(usernames))
+
+
+def _forget_usernames(usernames):
+    for username in usernames:
+        _local.pop(username)
+    try:
+        get_sync_redis().delete(*[username_key(username) for username in usernames])
+    except redis.RedisError:
+        logger.warning("Could not invalidate cached usernames %s", usernames, exc_info=True)
+
+
+def cache_info():
+    """Hit/miss counters and size of this process's local LRU."""
+    return _local.info()
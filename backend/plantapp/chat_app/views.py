@@ -1,16 +1,27 @@
 
 from django.shortcuts import get_object_or_404
 from django.contrib.auth import get_user_model
-from django.db.models import Q
-from datetime import datetime, timezone as dt_timezone
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
 
-from .models import Message
+from users.pagination import is_paginated, user_page
+
 from .serializers import MessageSerializer, SimpleUserSerializer
+from .services import (
+	apply_read_state,
+	build_inbox,
+	conversation_history,
+	conversation_length,
+	get_conversation,
+	mark_conversation_read,
+	message_page,
+	record_message,
+	unread_counts,
+)
+from .search import search_messages
 
 User = get_user_model()
 
@@ -20,39 +31,40 @@ class InboxAPIView(APIView):
 	permission_classes = [IsAuthenticated]
 
 	def get(self, request):
-		users = User.objects.exclude(id=request.user.id)
+		# Optional pagination: limit & offset
+		limit_param = request.query_params.get("limit")
+		offset_param = request.query_params.get("offset", "0")
+		limit = None
+		offset = 0
+		if limit_param is not None:
+			try:
+				limit = max(1, min(int(limit_param), 100))
+				offset = max(0, int(offset_param))
+			except ValueError:
+				return Response({"detail": "Invalid pagination parameters."}, status=status.HTTP_400_BAD_REQUEST)
 
-		payload = []
-		for user in users:
-			last_message = (
-				Message.objects.filter(
-					Q(sender=request.user, recipient=user)
-					|
-					Q(sender=user, recipient=request.user)
-				)
-				.order_by('-timestamp')
-				.first()
-			)
-
-			unread_count = Message.objects.filter(
-				sender=user,
-				recipient=request.user,
-				is_read=False,
-			).count()
-
-			payload.append(
-				{
-					"user": SimpleUserSerializer(user).data,
-					"last_message": MessageSerializer(last_message).data if last_message else None,
-					"unread_count": unread_count,
-					"_sort_ts": last_message.timestamp if last_message else datetime.fromtimestamp(0, tz=dt_timezone.utc),
-				}
-			)
-		payload.sort(key=lambda x: x["_sort_ts"], reverse=True)
-		for item in payload:
-			item.pop("_sort_ts", None)
+		entries, has_next = build_inbox(user=request.user, limit=limit, offset=offset)
 
-		return Response(payload)
+		payload = [
+			{
+				"user": SimpleUserSerializer(entry["user"]).data,
+				"last_message": MessageSerializer(entry["last_message"]).data if entry["last_message"] else None,
+				"unread_count": entry["unread_count"],
+			}
+			for entry in entries
+		]
+		if limit is None:
+			return Response(payload)
+
+		return Response({
+			"conversations": payload,
+			"pagination": {
+				"limit": limit,
+				"offset": offset,
+				"has_next": has_next,
+				"has_previous": offset > 0,
+			},
+		})
 
 
 class ConversationAPIView(APIView):
@@ -62,22 +74,18 @@ class ConversationAPIView(APIView):
 	def get(self, request, username):
 		other_user = get_object_or_404(User, username=username)
 
-		Message.objects.filter(
-			sender=other_user,
-			recipient=request.user,
-			is_read=False,
-		).update(is_read=True)
+		mark_conversation_read(reader=request.user, other=other_user)
+		conversation = get_conversation(user=request.user, other=other_user)
 
-		messages_qs = Message.objects.filter(
-			Q(sender=request.user, recipient=other_user)
-			|
-			Q(sender=other_user, recipient=request.user)
-		).select_related('sender', 'recipient').order_by('timestamp')
+		if {"page_size", "before_id", "after_id"} & request.query_params.keys():
+			return self.get_cursor_page(request, other_user, conversation)
 
 		# Optional pagination: limit & offset
 		limit_param = request.query_params.get("limit")
 		offset_param = request.query_params.get("offset", "0")
 		pagination = None
+		limit = None
+		offset = 0
 		if limit_param is not None:
 			try:
 				limit = max(1, min(int(limit_param), 100))
@@ -85,8 +93,7 @@ class ConversationAPIView(APIView):
 			except ValueError:
 				return Response({"detail": "Invalid pagination parameters."}, status=status.HTTP_400_BAD_REQUEST)
 
-			total = messages_qs.count()
-			messages_qs = messages_qs[offset:offset + limit]
+			total = conversation_length(user=request.user, other=other_user)
 			pagination = {
 				"count": total,
 				"limit": limit,
@@ -95,7 +102,10 @@ class ConversationAPIView(APIView):
 				"has_previous": offset > 0,
 			}
 
-		serializer = MessageSerializer(messages_qs, many=True)
+		# Reads the archive tier as well when the slice reaches back into it
+		messages = conversation_history(user=request.user, other=other_user, offset=offset, limit=limit)
+		apply_read_state(messages, conversation)
+		serializer = MessageSerializer(messages, many=True)
 		payload = {
 			"other_user": SimpleUserSerializer(other_user).data,
 			"messages": serializer.data,
@@ -104,6 +114,48 @@ class ConversationAPIView(APIView):
 			payload["pagination"] = pagination
 		return Response(payload)
 
+	def get_cursor_page(self, request, other_user, conversation):
+		"""
+		Reverse-scroll mode: newest `page_size` messages first, then
+		`before_id` / `after_id` keyset cursors. Cost does not depend on
+		the length of the conversation.
+		"""
+		try:
+			page_size = max(1, min(int(request.query_params.get("page_size", 50)), 100))
+			before_id = request.query_params.get("before_id")
+			after_id = request.query_params.get("after_id")
+			before_id = int(before_id) if before_id is not None else None
+			after_id = int(after_id) if after_id is not None else None
+		except ValueError:
+			return Response({"detail": "Invalid pagination parameters."}, status=status.HTTP_400_BAD_REQUEST)
+
+		if before_id is not None and after_id is not None:
+			return Response({"detail": "Use either before_id or after_id, not both."}, status=status.HTTP_400_BAD_REQUEST)
+
+		page = message_page(
+			user=request.user,
+			other=other_user,
+			page_size=page_size,
+			before_id=before_id,
+			after_id=after_id,
+		)
+		if page is None:
+			return Response({"detail": "Invalid cursor."}, status=status.HTTP_400_BAD_REQUEST)
+
+		messages, has_older, has_newer = page
+		apply_read_state(messages, conversation)
+		return Response({
+			"other_user": SimpleUserSerializer(other_user).data,
+			"messages": MessageSerializer(messages, many=True).data,
+			"cursor": {
+				"page_size": page_size,
+				"before_id": messages[0].id if messages and has_older else None,
+				"after_id": messages[-1].id if messages else after_id,
+				"has_older": has_older,
+				"has_newer": has_newer,
+			},
+		})
+
 	def post(self, request, username):
 		other_user = get_object_or_404(User, username=username)
 
@@ -111,7 +163,7 @@ class ConversationAPIView(APIView):
 		if not content:
 			return Response({"detail": "'content' is required."}, status=status.HTTP_400_BAD_REQUEST)
 
-		message = Message.objects.create(
+		message = record_message(
 			sender=request.user,
 			recipient=other_user,
 			content=content,
@@ -120,12 +172,63 @@ class ConversationAPIView(APIView):
 		return Response(MessageSerializer(message).data, status=status.HTTP_201_CREATED)
 
 
+class MessageSearchAPIView(APIView):
+
+	permission_classes = [IsAuthenticated]
+
+	def get(self, request):
+		"""
+		Full-text search over the caller's conversations.
+		?q=<words> (required), optional ?with=<username>, ?limit= and ?offset=.
+		Results are ranked best match first; `snippet` is HTML-escaped with
+		the matched words wrapped in <mark>.
+		"""
+		query = request.query_params.get("q", "").strip()
+		if not query:
+			return Response({"detail": "'q' is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+		try:
+			limit = max(1, min(int(request.query_params.get("limit", 20)), 100))
+			offset = max(0, int(request.query_params.get("offset", 0)))
+		except ValueError:
+			return Response({"detail": "Invalid pagination parameters."}, status=status.HTTP_400_BAD_REQUEST)
+
+		other_user = None
+		if request.query_params.get("with"):
+			other_user = get_object_or_404(User, username=request.query_params["with"])
+
+		hits, has_next = search_messages(
+			user=request.user,
+			query=query,
+			other=other_user,
+			limit=limit,
+			offset=offset,
+		)
+		return Response({
+			"results": [
+				{
+					"message": MessageSerializer(hit["message"]).data,
+					"snippet": hit["snippet"],
+				}
+				for hit in hits
+			],
+			"pagination": {
+				"limit": limit,
+				"offset": offset,
+				"has_next": has_next,
+				"has_previous": offset > 0,
+			},
+		})
+
+
 class UserListAPIView(APIView):
 
 	permission_classes = [IsAuthenticated]
 
 	def get(self, request):
 		users = User.objects.exclude(id=request.user.id)
+		if is_paginated(request):
+			return user_page(request, users, SimpleUserSerializer)
 		serializer = SimpleUserSerializer(users, many=True)
 		return Response(serializer.data)
 
@@ -135,8 +238,8 @@ class UnreadCountAPIView(APIView):
 	permission_classes = [IsAuthenticated]
 
 	def get(self, request):
-		unread_count = Message.objects.filter(
-			recipient=request.user,
-			is_read=False
-		).count()
-		return Response({"unread_count": unread_count})
+		total, by_sender = unread_counts(user=request.user)
+		return Response({
+			"unread_count": total,
+			"by_sender": {str(sender_id): count for sender_id, count in by_sender.items()},
+		})
@@ -132,6 +132,33 @@ else:
         }
     }
 
+# Shared per-process Redis pool used for presence tracking (chat_app.redis_pool)
+REDIS_POOL = {
+    'host': os.getenv('REDIS_HOST', 'redis'),
+    'port': int(os.getenv('REDIS_PORT', '6379')),
+    'max_connections': int(os.getenv('REDIS_POOL_MAX_CONNECTIONS', '20')),
+    # seconds to wait for a free connection before raising
+    'timeout': float(os.getenv('REDIS_POOL_TIMEOUT', '5')),
+    'health_check_interval': int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30')),
+}
+
+# Group commit of websocket chat messages (chat_app.message_buffer): messages
+# arriving within the flush window are written with one bulk INSERT
+CHAT_MESSAGE_BUFFER = {
+    'enabled': os.getenv('CHAT_MESSAGE_BUFFER_ENABLED', 'true').lower() == 'true',
+    'flush_window_ms': float(os.getenv('CHAT_MESSAGE_BUFFER_WINDOW_MS', '5')),
+    'max_batch': int(os.getenv('CHAT_MESSAGE_BUFFER_MAX_BATCH', '200')),
+}
+
+# Archive tier for chat history (chat_app.archive): messages older than
+# after_days move out of the Message table into compressed per-conversation
+# blocks of block_size messages, batch_size messages per transaction
+CHAT_ARCHIVE = {
+    'after_days': int(os.getenv('CHAT_ARCHIVE_AFTER_DAYS', '180')),
+    'batch_size': int(os.getenv('CHAT_ARCHIVE_BATCH_SIZE', '2000')),
+    'block_size': int(os.getenv('CHAT_ARCHIVE_BLOCK_SIZE', '500')),
+}
+
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
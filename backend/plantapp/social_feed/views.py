@@ -61,7 +61,7 @@ class PinViewSet(viewsets.ViewSet):
         GET /api/pins/feed/
         """
         # Get IDs of mutual friends only (users who accepted your friend request)
-        friends_ids = request.user.get_friends().values_list('id', flat=True)
+        friends_ids = request.user.friend_ids()
         
         # Get pins from mutual friends OR from the current user
         pins = Pin.objects.filter(
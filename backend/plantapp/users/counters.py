@@ -0,0 +1,57 @@
+"""
+Denormalized per-user counters: User.plants_count (plants owned) and
+User.gardens_count (garden memberships).
+
+users.signals adjusts them inside the transaction of every Plant and
+GardenUser create, delete or reassignment, so serializing a user needs no
+COUNT. Writes that send no signals (bulk_create, queryset.update, raw SQL)
+are repaired by reconcile(), run by the reconcile_user_counters command.
+"""
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from gardens.models import GardenUser
+from plants.models import Plant
+
+# Model counted -> (its foreign key to the user, the User counter column)
+COUNTED = {
+    Plant: ('owner', 'plants_count'),
+    GardenUser: ('user', 'gardens_count'),
+}
+
+
+def adjust(user_id, counter, delta, user=None):
+    """
+    Add `delta` to one counter of `user_id` with a single UPDATE. A loaded
+    `user` instance is kept in step, so it serializes the new value.
+    """
+    get_user_model().objects.filter(pk=user_id).update(**{counter: Greatest(F(counter) + delta, 0)})
+    if user is not None:
+        setattr(user, counter, max(getattr(user, counter) + delta, 0))
+
+
+def _actual(model, fk):
+    """Subquery counting the `model` rows of the outer user."""
+    rows = model.objects.filter(**{fk: OuterRef('pk')}).order_by().values(fk).annotate(total=Count('*'))
+    return Coalesce(Subquery(rows.values('total')), 0)
+
+
+def reconcile(batch_size=1000):
+    """
+    Recount both counters and rewrite the users whose stored values
+    drifted, `batch_size` users per UPDATE. The counts are recomputed
+    inside each UPDATE, so writes that commit meanwhile are not lost.
+    Returns the number of users repaired.
+    """
+    User = get_user_model()
+    actual = {counter: _actual(model, fk) for model, (fk, counter) in COUNTED.items()}
+    drifted = list(
+        User.objects.annotate(**{f'actual_{counter}': value for counter, value in actual.items()})
+        .exclude(**{counter: F(f'actual_{counter}') for counter in actual})
+        .order_by('pk')
+        .values_list('pk', flat=True)
+    )
+    for start in range(0, len(drifted), batch_size):
+        User.objects.filter(pk__in=drifted[start:start + batch_size]).update(**actual)
+    return len(drifted)
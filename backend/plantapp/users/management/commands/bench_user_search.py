@@ -0,0 +1,87 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from users.models import User
+from users.search import search_users
+
+FIRST_NAMES = [
+    'anna', 'adam', 'agnieszka', 'bartek', 'celina', 'daniel', 'ewa', 'filip', 'grace', 'hugo',
+    'iga', 'jan', 'julia', 'kamil', 'lena', 'marek', 'maria', 'nina', 'oskar', 'piotr',
+    'ruth', 'sara', 'tomasz', 'ula', 'victor', 'wiktoria', 'xavier', 'yara', 'zoe', 'zofia',
+]
+LAST_NAMES = [
+    'nowak', 'kowalski', 'wisniewski', 'wojcik', 'kaminski', 'lewandowski', 'zielinski', 'smith',
+    'johnson', 'brown', 'garcia', 'martin', 'dubois', 'muller', 'rossi', 'novak', 'silva', 'kim',
+]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark typeahead user search (query count and latency) on a seeded user table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000)
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        # Seeded rows are rolled back at the end, like the other benchmarks
+        with transaction.atomic():
+            target = self.seed(options)
+            self.measure(target, options)
+            transaction.set_rollback(True)
+
+    def seed(self, options):
+        self.stdout.write(self.style.WARNING(f"Seeding {options['users']} users..."))
+        rng = random.Random(options['seed'])
+        batch = []
+        target = None
+        for i in range(options['users']):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            username = f'{first}_{last}{i}'
+            batch.append(User(
+                username=username,
+                email=f'bench_search_{i}@example.com',
+                first_name=first.title(),
+                last_name=last.title(),
+                password='!',
+            ))
+            if i == options['users'] // 2:
+                target = username
+            if len(batch) == options['batch_size']:
+                User.objects.bulk_create(batch)
+                batch = []
+        User.objects.bulk_create(batch)
+        return target
+
+    def measure(self, target, options):
+        queries = {
+            'one letter': 'a',
+            'short prefix': 'zof',
+            'exact username': target,
+            'first and last name': 'maria nowa',
+            'last name only': 'wisniew',
+            'no match': 'qqqq',
+        }
+        self.stdout.write('=' * 60)
+        for label, query in queries.items():
+            with CaptureQueriesContext(connection) as ctx:
+                users, _ = search_users(query=query, limit=options['limit'])
+            timings = []
+            for _ in range(options['iterations']):
+                start = time.perf_counter()
+                search_users(query=query, limit=options['limit'])
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            self.stdout.write(
+                f'{label:<20} {len(users):>3} results  {len(ctx.captured_queries)} queries  '
+                f'median {statistics.median(timings):.2f} ms  p95 {p95:.2f} ms'
+            )
+        self.stdout.write('=' * 60)
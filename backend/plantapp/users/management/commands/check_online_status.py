@@ -1,4 +1,5 @@
 from django.core.management.base import BaseCommand
+from chat_app.presence import online_states
 from users.models import User
 
 
@@ -6,20 +7,22 @@ class Command(BaseCommand):
     help = 'Debug user online status'
 
     def handle(self, *args, **options):
-        all_users = User.objects.all()
+        all_users = list(User.objects.all())
+        # Presence is read from the Redis store, the DB column may lag behind
+        presence = online_states(all_users)
         
         self.stdout.write(self.style.SUCCESS('\n📊 User Online Status Report'))
         self.stdout.write('=' * 60)
         
         for user in all_users:
-            status = '🟢 Online' if user.is_online else '⚪ Offline'
+            status = '🟢 Online' if presence[user.id] else '⚪ Offline'
             self.stdout.write(f'{status} - {user.username} (ID: {user.id})')
         
-        online_count = User.objects.filter(is_online=True).count()
-        offline_count = User.objects.filter(is_online=False).count()
+        online_count = sum(presence.values())
+        offline_count = len(all_users) - online_count
         
         self.stdout.write('=' * 60)
-        self.stdout.write(self.style.SUCCESS(f'Total: {all_users.count()} users'))
+        self.stdout.write(self.style.SUCCESS(f'Total: {len(all_users)} users'))
         self.stdout.write(self.style.SUCCESS(f'Online: {online_count}'))
         self.stdout.write(self.style.WARNING(f'Offline: {offline_count}'))
         
@@ -1,44 +1,53 @@
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
-import redis
 from django.conf import settings
+from chat_app.presence import DIRTY_KEY, ONLINE_KEY, connection_key, heartbeat_key
+from chat_app.redis_pool import get_sync_redis
 from users.models import User
 
 
 class Command(BaseCommand):
-    help = 'Clear stale Redis connection counts and reset user online status'
+    help = 'Close connections with expired heartbeats (or, with --reset, wipe all presence data)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Force every user offline and drop all connection keys')
 
     def handle(self, *args, **options):
-        self.stdout.write(self.style.WARNING('Clearing stale Redis data...'))
-        
-        # Get Redis configuration from channel layer settings
-        channel_layers = settings.CHANNEL_LAYERS
-        default_layer = channel_layers.get('default', {})
-        config = default_layer.get('CONFIG', {})
-        hosts = config.get('hosts', [('redis', 6379)])
-        
-        if hosts:
-            host, port = hosts[0] if isinstance(hosts[0], tuple) else ('redis', 6379)
-        else:
-            host, port = 'redis', 6379
+        host, port = settings.REDIS_POOL['host'], settings.REDIS_POOL['port']
         
-        # Connect to Redis
+        # Connect to Redis through the shared pool
         try:
-            r = redis.Redis(host=host, port=port, decode_responses=True)
+            r = get_sync_redis()
             r.ping()
             self.stdout.write(self.style.SUCCESS(f'✓ Connected to Redis at {host}:{port}'))
         except Exception as e:
             self.stdout.write(self.style.ERROR(f'✗ Failed to connect to Redis: {e}'))
             return
-        
-        # Clear all user connection counts
-        pattern = 'user_connections:*'
-        keys = r.keys(pattern)
-        
-        if keys:
-            deleted = r.delete(*keys)
-            self.stdout.write(self.style.SUCCESS(f'✓ Deleted {deleted} stale connection count keys'))
-        else:
-            self.stdout.write(self.style.WARNING('  No connection count keys found'))
+
+        if not options['reset']:
+            # Only connections that stopped sending heartbeats are closed
+            call_command('sweep_presence', once=True, stdout=self.stdout, stderr=self.stderr)
+            self.stdout.write(self.style.SUCCESS('✓ Swept connections with expired heartbeats'))
+            self.stdout.write('The presence-sweeper service does this continuously.')
+            return
+
+        self.stdout.write(self.style.WARNING('Clearing all presence data...'))
+
+        # Walk the keyspace with SCAN and delete in small batches (never KEYS)
+        deleted = 0
+        for pattern in (connection_key('*'), heartbeat_key('*', '*')):
+            batch = []
+            for key in r.scan_iter(match=pattern, count=500):
+                batch.append(key)
+                if len(batch) >= 500:
+                    deleted += r.unlink(*batch)
+                    batch = []
+            if batch:
+                deleted += r.unlink(*batch)
+        self.stdout.write(self.style.SUCCESS(f'✓ Deleted {deleted} connection and heartbeat keys'))
+        
+        # Clear the presence store (online set and pending flushes)
+        r.delete(ONLINE_KEY, DIRTY_KEY)
         
         # Reset all users to offline in database
         online_users = User.objects.filter(is_online=True)
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat_app.presence import flush_to_database
+
+
+class Command(BaseCommand):
+    help = 'Write online status and last_seen from the Redis presence store to the database in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds between flushes')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--once', action='store_true', help='Flush once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                written = flush_to_database(batch_size=options['batch_size'])
+                if written:
+                    self.stdout.write(f'Flushed presence for {written} users')
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f'✗ Presence flush failed: {e}'))
+                if options['once']:
+                    raise
+
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from users.counters import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Recount plants_count and gardens_count and repair users whose counters drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Users rewritten per UPDATE')
+
+    def handle(self, *args, **options):
+        repaired = reconcile(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'✓ Repaired counters of {repaired} users'))
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat_app.presence import HEARTBEAT_INTERVAL_SECONDS, announce_offline, sweep_dead_connections
+
+
+class Command(BaseCommand):
+    help = 'Close websocket connections whose heartbeat expired and announce users that went offline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=HEARTBEAT_INTERVAL_SECONDS, help='Seconds between sweeps')
+        parser.add_argument('--scan-count', type=int, default=200, help='COUNT hint for each SCAN step')
+        parser.add_argument('--once', action='store_true', help='Sweep once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                went_offline = sweep_dead_connections(scan_count=options['scan_count'])
+                for user_id in went_offline:
+                    announce_offline(user_id)
+                if went_offline:
+                    self.stdout.write(f'Set {len(went_offline)} users offline after missed heartbeats')
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f'✗ Presence sweep failed: {e}'))
+                if options['once']:
+                    raise
+
+            if options['once']:
+                return
+            time.sleep(options['interval'])
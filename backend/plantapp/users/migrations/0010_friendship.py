@@ -0,0 +1,52 @@
+# Generated by Django 6.0.1 on 2026-10-18 11:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def copy_following(apps, schema_editor):
+    """One Friendship row per existing follow, accepted where it is mutual."""
+    User = apps.get_model('users', 'User')
+    Friendship = apps.get_model('users', 'Friendship')
+    Follow = User.following.through
+
+    follows = set(
+        Follow.objects.exclude(from_user_id=models.F('to_user_id')).values_list('from_user_id', 'to_user_id').iterator()
+    )
+    rows = [
+        Friendship(
+            from_user_id=from_id,
+            to_user_id=to_id,
+            state='accepted' if (to_id, from_id) in follows else 'pending',
+        )
+        for from_id, to_id in follows
+    ]
+    Friendship.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_user_last_seen'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Friendship',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('accepted', 'Accepted')], default='pending', max_length=10)),
+                ('from_user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='outgoing_friendships', to=settings.AUTH_USER_MODEL)),
+                ('to_user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='incoming_friendships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['from_user', 'state', 'to_user'], name='friendship_from_state_idx'), models.Index(fields=['to_user', 'state', 'from_user'], name='friendship_to_state_idx')],
+                'constraints': [models.UniqueConstraint(fields=('from_user', 'to_user'), name='friendship_unique_pair')],
+            },
+        ),
+        # Reversing drops the table, and following still holds the data
+        migrations.RunPython(copy_following, migrations.RunPython.noop),
+    ]
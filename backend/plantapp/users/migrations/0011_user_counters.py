@@ -0,0 +1,41 @@
+# Generated by Django 6.0.1 on 2026-10-18 11:40
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_existing(apps, schema_editor):
+    User = apps.get_model('users', 'User')
+    Plant = apps.get_model('plants', 'Plant')
+    GardenUser = apps.get_model('gardens', 'GardenUser')
+
+    plants = Plant.objects.filter(owner=OuterRef('pk')).order_by().values('owner').annotate(total=Count('*'))
+    gardens = GardenUser.objects.filter(user=OuterRef('pk')).order_by().values('user').annotate(total=Count('*'))
+    User.objects.update(
+        plants_count=Coalesce(Subquery(plants.values('total')), 0),
+        gardens_count=Coalesce(Subquery(gardens.values('total')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_friendship'),
+        ('plants', '0006_alter_plant_garden'),
+        ('gardens', '0005_delete_gardeninvitation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='gardens_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='plants_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_existing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:20
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+# Word index of usernames and names for user search (see users.search),
+# with prefix indexes so short typeahead prefixes are direct lookups.
+# Only letters make up words: digits in usernames like "anna1987" would
+# otherwise give every user a token of their own and make each word
+# prefix expand to thousands of terms (the username prefix tier still
+# matches them). Triggers keep it in step with users_user, including
+# bulk writes.
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE users_user_fts USING fts5(
+        username,
+        first_name,
+        last_name,
+        tokenize = 'unicode61 remove_diacritics 2 categories ''L*''',
+        prefix = '1 2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER users_user_fts_insert AFTER INSERT ON users_user BEGIN
+        INSERT INTO users_user_fts (rowid, username, first_name, last_name)
+        VALUES (new.id, new.username, new.first_name, new.last_name);
+    END
+    """,
+    """
+    CREATE TRIGGER users_user_fts_update AFTER UPDATE OF username, first_name, last_name ON users_user BEGIN
+        UPDATE users_user_fts
+        SET username = new.username, first_name = new.first_name, last_name = new.last_name
+        WHERE rowid = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER users_user_fts_delete AFTER DELETE ON users_user BEGIN
+        DELETE FROM users_user_fts WHERE rowid = old.id;
+    END
+    """,
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS users_user_fts_delete",
+    "DROP TRIGGER IF EXISTS users_user_fts_update",
+    "DROP TRIGGER IF EXISTS users_user_fts_insert",
+    "DROP TABLE IF EXISTS users_user_fts",
+]
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for statement in CREATE_SQL:
+            cursor.execute(statement)
+        cursor.execute(
+            "INSERT INTO users_user_fts (rowid, username, first_name, last_name) "
+            "SELECT id, username, first_name, last_name FROM users_user"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for statement in DROP_SQL:
+            cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('users', '0011_user_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(django.db.models.functions.text.Lower('username'), name='user_username_lower_idx'),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:40
+
+import importlib
+
+from django.db import migrations
+
+import users.models
+
+search_index = importlib.import_module('users.migrations.0012_user_search')
+
+
+def lowercase_existing(apps, schema_editor):
+    User = apps.get_model('users', 'User')
+    rows = list(User.objects.only('id', 'username'))
+    for user in rows:
+        user.username_lower = user.username.lower()
+    User.objects.bulk_update(rows, ['username_lower'], batch_size=1000)
+
+
+def recreate_search_index(apps, schema_editor):
+    # SQLite adds the column by rebuilding users_user, which drops the
+    # triggers that keep users_user_fts current
+    search_index.drop_search_index(apps, schema_editor)
+    search_index.create_search_index(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0012_user_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, recreate_search_index),
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_username_lower_idx',
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='username_lower',
+            field=users.models.LowercaseCopyField(db_index=True, default='', editable=False, max_length=100, source='username'),
+        ),
+        migrations.RunPython(lowercase_existing, migrations.RunPython.noop),
+        migrations.RunPython(recreate_search_index, migrations.RunPython.noop),
+    ]
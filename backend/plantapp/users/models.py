@@ -1,10 +1,41 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import (AbstractBaseUser,
  BaseUserManager, PermissionsMixin)
 from django.utils import timezone
 
 # Create your models here.
 
+# Relationship statuses reported by User.relationships_with
+RELATIONSHIP_FRIEND = 'friend'
+RELATIONSHIP_PENDING_INCOMING = 'pending_incoming'
+RELATIONSHIP_PENDING_OUTGOING = 'pending_outgoing'
+RELATIONSHIP_NONE = 'none'
+RELATIONSHIP_SELF = 'self'
+
+
+class LowercaseCopyField(models.CharField):
+    """
+    Lowercased copy of another field of the model, refreshed on save() and
+    bulk_create() with Python's str.lower(). The database's lower() can not
+    stand in for it: SQLite's only folds ASCII.
+    """
+
+    def __init__(self, *args, source, **kwargs):
+        self.source = source
+        kwargs.setdefault('editable', False)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = (getattr(model_instance, self.source) or '').lower()
+        setattr(model_instance, self.attname, value)
+        return value
+
+
 class UserManager(BaseUserManager):
     def create_user(self, email, username, password=None, **extra_fields):
         if not email:
@@ -28,6 +59,10 @@ class User(AbstractBaseUser, PermissionsMixin):
  blank=True)
     username = models.CharField(max_length=50, unique=True,
  null=False, blank=False)
+    # Username prefix ranges for user search (users.search). Saves with
+    # update_fields must list it along with username; lowercasing can
+    # lengthen a few characters, hence the wider column.
+    username_lower = LowercaseCopyField(max_length=100, source='username', db_index=True, default='')
     email = models.EmailField(max_length=200, unique=True,
  null=False, blank=False)
     avatar_photo = models.ImageField(upload_to='avatars/', null=True, blank=True)
@@ -35,7 +70,12 @@ class User(AbstractBaseUser, PermissionsMixin):
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
     is_superuser = models.BooleanField(default=False)
+    # Flushed periodically from the Redis presence store (chat_app.presence)
     is_online = models.BooleanField(default=False)
+    last_seen = models.DateTimeField(null=True, blank=True)
+    # Plants owned and garden memberships, kept by users.signals (see users.counters)
+    plants_count = models.PositiveIntegerField(default=0)
+    gardens_count = models.PositiveIntegerField(default=0)
     objects = UserManager()
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
@@ -44,41 +84,107 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.username
 
     date_joined = models.DateTimeField(default=timezone.now)
-    # Internal field: stores friend connections/requests (mutual = friends, one-way = pending request)
+    # Internal field: stores friend connections/requests (mutual = friends, one-way = pending request).
+    # Mirrored into Friendship (see users.signals), which the friend queries read.
     following = models.ManyToManyField("self", blank=True,symmetrical=False, related_name="followers")
     def get_friends(self):
         """Return all mutual friends (users with mutual friend connections)."""
-        # Get users we have a connection with who also have a connection back to us
-        mutual_friends = self.following.filter(following=self).exclude(pk=self.pk)
-        return mutual_friends
+        return User.objects.filter(
+            incoming_friendships__from_user=self,
+            incoming_friendships__state=Friendship.ACCEPTED,
+        )
+
+    def friend_ids(self):
+        """Ids of all mutual friends, read from the friendship index alone."""
+        return Friendship.objects.filter(from_user=self, state=Friendship.ACCEPTED).values_list('to_user_id', flat=True)
 
     def count_friends(self):
         """Return count of mutual friends."""
-        return self.get_friends().count()
+        return Friendship.objects.filter(from_user=self, state=Friendship.ACCEPTED).count()
 
     def get_pending_requests(self):
         """Return incoming friend requests (users who sent you a friend request)."""
-        # Find users who have sent us a request but we haven't accepted yet
-        return User.objects.filter(following=self).exclude(pk__in=self.following.values_list('pk', flat=True))
+        return User.objects.filter(
+            outgoing_friendships__to_user=self,
+            outgoing_friendships__state=Friendship.PENDING,
+        )
 
     def get_outgoing_requests(self):
         """Return outgoing friend requests (users you've sent requests to but haven't been accepted)."""
-        return self.following.exclude(following=self)
+        return User.objects.filter(
+            incoming_friendships__from_user=self,
+            incoming_friendships__state=Friendship.PENDING,
+        )
 
+    def friendship_state(self, user):
+        """State of the connection from self to `user`: Friendship.PENDING, Friendship.ACCEPTED or None."""
+        return Friendship.objects.filter(from_user=self, to_user=user).values_list('state', flat=True).first()
 
     def is_friend_with(self, user):
         """Check if the given user is a friend (mutual connection)."""
-        # Ensure we're not comparing with self
         if user.pk == self.pk:
             return False
-        # Check for mutual friend connection
-        return self.following.filter(pk=user.pk).exists() and user.following.filter(pk=self.pk).exists()
+        return self.friendship_state(user) == Friendship.ACCEPTED
+
+    def relationships_with(self, user_ids):
+        """
+        Relationship of self to each of `user_ids`, as {id: status} with
+        status one of the RELATIONSHIP_* values. One query on Friendship
+        whatever the number of ids; ids of unknown users come back as none.
+        """
+        user_ids = set(user_ids)
+        statuses = dict.fromkeys(user_ids, RELATIONSHIP_NONE)
+        rows = Friendship.objects.filter(
+            models.Q(from_user=self, to_user_id__in=user_ids) | models.Q(to_user=self, from_user_id__in=user_ids)
+        ).values_list('from_user_id', 'to_user_id', 'state')
+        for from_id, to_id, state in rows:
+            if state == Friendship.ACCEPTED:
+                statuses[to_id if from_id == self.pk else from_id] = RELATIONSHIP_FRIEND
+            elif from_id == self.pk:
+                statuses[to_id] = RELATIONSHIP_PENDING_OUTGOING
+            else:
+                statuses[from_id] = RELATIONSHIP_PENDING_INCOMING
+        if self.pk in statuses:
+            statuses[self.pk] = RELATIONSHIP_SELF
+        return statuses
 
     def unfriend(self, user):
         """Remove mutual friendship by removing both connections."""
-        # Remove both directions of the friendship
-        self.following.remove(user)
-        user.following.remove(self)
-
-
+        with transaction.atomic():
+            self.following.remove(user)
+            user.following.remove(self)
+
+
+class Friendship(models.Model):
+    """
+    One row per `following` connection, from the user who made it, with
+    its state: PENDING while the other side has not connected back,
+    ACCEPTED once both have (then the reverse row exists too). Kept in
+    step with `following` by users.signals, so friend lists, requests
+    and is-friend checks are single index lookups instead of self-joins.
+    """
+    PENDING = 'pending'
+    ACCEPTED = 'accepted'
+    STATE_CHOICES = [
+        (PENDING, 'Pending'),
+        (ACCEPTED, 'Accepted'),
+    ]
+
+    # Both columns lead an index below, so the FKs need none of their own
+    from_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='outgoing_friendships', db_index=False)
+    to_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='incoming_friendships', db_index=False)
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=PENDING)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['from_user', 'to_user'], name='friendship_unique_pair'),
+        ]
+        indexes = [
+            # Friends and outgoing requests of a user
+            models.Index(fields=['from_user', 'state', 'to_user'], name='friendship_from_state_idx'),
+            # Incoming requests of a user
+            models.Index(fields=['to_user', 'state', 'from_user'], name='friendship_to_state_idx'),
+        ]
 
+    def __str__(self):
+        return f"{self.from_user_id} -> {self.to_user_id} ({self.state})"
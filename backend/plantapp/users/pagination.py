@@ -0,0 +1,107 @@
+"""
+Keyset pagination and sparse payloads for user lists.
+
+The friend, request and directory endpoints still return their full list
+unless one of PAGE_PARAMS is given, like the inbox and conversation views
+in chat_app. Pages are ordered by user id and continue from `after_id`,
+so every page is one bounded range on the primary key however many users
+there are. `fields=` keeps a subset of the serializer's fields and reads
+only their columns with values().
+"""
+from types import SimpleNamespace
+
+from rest_framework import status
+from rest_framework.response import Response
+
+from chat_app.presence import online_states
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+PAGE_PARAMS = {"page_size", "after_id", "fields"}
+# Serializer fields that are not columns but can still be projected
+COMPUTED_FIELDS = {"is_online"}
+
+
+def is_paginated(request):
+    return bool(PAGE_PARAMS & request.query_params.keys())
+
+
+def _bad_request(detail):
+    return Response({"detail": detail}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def _projectable(model, serializer_class):
+    columns = {field.name for field in model._meta.concrete_fields}
+    return [name for name in serializer_class.Meta.fields if name in columns or name in COMPUTED_FIELDS]
+
+
+def _project(model, rows, fields):
+    """Shape values() rows like the serializer would, keeping only `fields`."""
+    if "is_online" in fields:
+        presence = online_states(SimpleNamespace(id=row["id"], is_online=row["is_online"]) for row in rows)
+    results = []
+    for row in rows:
+        item = {}
+        for name in fields:
+            if name == "is_online":
+                item[name] = presence[row["id"]]
+            elif hasattr(model._meta.get_field(name), "storage"):
+                # File fields render as their URL, as in the serializer
+                item[name] = model._meta.get_field(name).storage.url(row[name]) if row[name] else None
+            else:
+                item[name] = row[name]
+        results.append(item)
+    return results
+
+
+def user_page(request, queryset, serializer_class):
+    """
+    Response with one page of `queryset` (User rows) after `after_id`:
+    {"results": [...], "pagination": {"page_size", "has_next", "next_after_id"}}.
+    Rows go through `serializer_class`, or with `fields=` are read with
+    values() and reduced to those fields.
+    """
+    try:
+        page_size = max(1, min(int(request.query_params.get("page_size", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE))
+        after_id = request.query_params.get("after_id")
+        after_id = int(after_id) if after_id is not None else None
+    except ValueError:
+        return _bad_request("Invalid pagination parameters.")
+
+    fields = None
+    if "fields" in request.query_params:
+        fields = [name.strip() for name in request.query_params["fields"].split(",") if name.strip()]
+        allowed = _projectable(queryset.model, serializer_class)
+        unknown = [name for name in fields if name not in allowed]
+        if not fields or unknown:
+            return _bad_request(f"fields must be a comma-separated subset of: {', '.join(allowed)}")
+
+    queryset = queryset.order_by("id")
+    if after_id is not None:
+        queryset = queryset.filter(id__gt=after_id)
+
+    if fields is None:
+        rows = list(queryset[:page_size + 1])
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        results = serializer_class(rows, many=True).data
+        last_id = rows[-1].id if rows else None
+    else:
+        columns = {"id", *(name for name in fields if name not in COMPUTED_FIELDS)}
+        if "is_online" in fields:
+            # Fallback for online_states when Redis is down
+            columns.add("is_online")
+        rows = list(queryset.values(*columns)[:page_size + 1])
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        results = _project(queryset.model, rows, fields)
+        last_id = rows[-1]["id"] if rows else None
+
+    return Response({
+        "results": results,
+        "pagination": {
+            "page_size": page_size,
+            "has_next": has_next,
+            "next_after_id": last_id if has_next else None,
+        },
+    })
@@ -0,0 +1,101 @@
+"""
+Typeahead user search.
+
+Matches come in two tiers. First the users whose username starts with the
+query, read in order from the index on User.username_lower (lowercased in
+Python, so non-ASCII usernames compare like ASCII ones), so an exact match
+comes first and the rest follow alphabetically. Then the users with a
+word in their username, first or last name starting with each query
+word, from the users_user_fts FTS5 table (migration 0012) in id order.
+Both tiers stop once the requested page is filled, so a keystroke costs
+two short index reads however many users there are. Other databases
+fall back to icontains for the second tier.
+"""
+import re
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models import Q
+
+FTS_TABLE = 'users_user_fts'
+_TERM = re.compile(r'\w+', re.UNICODE)
+
+
+def search_available():
+    return connection.vendor == 'sqlite'
+
+
+def match_expression(query):
+    """
+    Turn free text into an FTS5 query: every word must match, the last
+    one as a prefix while it is still being typed. Operators and quotes
+    in the input are never interpreted. Returns None for a query without words.
+    """
+    terms = _TERM.findall(query)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    if not query[-1:].isspace():
+        quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def _prefix_range(prefix):
+    """Bounds [low, high) of the strings starting with `prefix`."""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def username_prefix_matches(prefix):
+    """Users whose lowercased username starts with `prefix`, in index order."""
+    low, high = _prefix_range(prefix)
+    return (
+        get_user_model().objects
+        .filter(username_lower__gte=low, username_lower__lt=high)
+        .order_by('username_lower')
+    )
+
+
+def _word_matches(query, exclude, limit):
+    """Users matching every word of `query`, other than the `exclude` ids, by id."""
+    User = get_user_model()
+    # Reading one more row per excluded user leaves `limit` after dropping them
+    wanted = limit + len(exclude)
+    if not search_available():
+        words = query.split()
+        condition = Q()
+        for word in words:
+            condition &= Q(username__icontains=word) | Q(first_name__icontains=word) | Q(last_name__icontains=word)
+        users = list(User.objects.filter(condition).order_by('id')[:wanted])
+        return [user for user in users if user.pk not in exclude][:limit]
+
+    expression = match_expression(query)
+    if expression is None:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rowid LIMIT %s",
+            [expression, wanted],
+        )
+        ids = [row[0] for row in cursor.fetchall() if row[0] not in exclude][:limit]
+    users = User.objects.in_bulk(ids)
+    return [users[user_id] for user_id in ids if user_id in users]
+
+
+def search_users(*, query, limit=20, offset=0):
+    """
+    Users matching `query`, best match first, as `(users, has_next)`:
+    username prefix matches (exact first), then word prefix matches on
+    username, first and last name. Each tier reads at most offset + limit
+    + 1 rows.
+    """
+    prefix = query.strip().lower()
+    if not prefix:
+        return [], False
+
+    wanted = offset + limit + 1
+    users = list(username_prefix_matches(prefix)[:wanted])
+    if len(users) < wanted:
+        users += _word_matches(query, {user.pk for user in users}, wanted - len(users))
+
+    page = users[offset:offset + limit + 1]
+    return page[:limit], len(page) > limit
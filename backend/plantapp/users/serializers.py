@@ -1,11 +1,33 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
 
+from chat_app.presence import online_states
+from chat_app.user_cache import invalidate_usernames
+
 User = get_user_model()
 
-class UserSerializer(serializers.ModelSerializer):
-    plants_count = serializers.SerializerMethodField()
-    gardens_count = serializers.SerializerMethodField()
+
+class PresenceListSerializer(serializers.ListSerializer):
+    """Looks up presence for the whole page in one Redis round trip."""
+
+    def to_representation(self, data):
+        users = list(data.all() if hasattr(data, 'all') else data)
+        self.context['presence'] = online_states(users)
+        return super().to_representation(users)
+
+
+class PresenceMixin:
+    """is_online is read from the Redis presence store, not the DB column."""
+
+    def get_is_online(self, obj):
+        presence = self.context.get('presence')
+        if presence is not None and obj.id in presence:
+            return presence[obj.id]
+        return online_states([obj])[obj.id]
+
+
+class UserSerializer(PresenceMixin, serializers.ModelSerializer):
+    is_online = serializers.SerializerMethodField()
     
     class Meta:
         model = User
@@ -23,12 +45,7 @@ class UserSerializer(serializers.ModelSerializer):
             "gardens_count",
         )
         read_only_fields = fields
-    
-    def get_plants_count(self, obj):
-        return obj.plants.count()
-    
-    def get_gardens_count(self, obj):
-        return obj.memberships.count()
+        list_serializer_class = PresenceListSerializer
 
 
 class UserUpdateSerializer(serializers.ModelSerializer):
@@ -92,19 +109,21 @@ class UserUpdateSerializer(serializers.ModelSerializer):
             if new_password:
                 instance.set_password(new_password)
 
+        old_username = instance.username
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
 
         instance.save()
+        if instance.username != old_username:
+            # Drop cached username -> user resolutions used by the chat consumer
+            invalidate_usernames(old_username, instance.username)
         return instance
 
-class PublicUserSerializer(serializers.ModelSerializer):
+class PublicUserSerializer(PresenceMixin, serializers.ModelSerializer):
     is_online = serializers.SerializerMethodField()
     
     class Meta:
         model = User
         fields = ("id", "username", "first_name", "last_name", "avatar_photo", "is_online")
-    
-    def get_is_online(self, obj):
-        return bool(obj.is_online)
+        list_serializer_class = PresenceListSerializer
 
@@ -0,0 +1,118 @@
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .counters import COUNTED, adjust
+from .models import Friendship, User
+
+Follow = User.following.through
+
+
+def _pairs(pairs):
+    """Q matching any of the (from_user, to_user) id pairs."""
+    condition = Q(pk__in=[])
+    for from_id, to_id in pairs:
+        condition |= Q(from_user_id=from_id, to_user_id=to_id)
+    return condition
+
+
+def _connections(instance, reverse, pk_set):
+    """(follower id, followed id) of the connections an m2m_changed call is about, without self-follows."""
+    if reverse:
+        edges = [(pk, instance.pk) for pk in pk_set]
+    else:
+        edges = [(instance.pk, pk) for pk in pk_set]
+    return [(from_id, to_id) for from_id, to_id in edges if from_id != to_id]
+
+
+def _connected(edges):
+    follows = set(Follow.objects.filter(_pairs([(to_id, from_id) for from_id, to_id in edges])).values_list(
+        'from_user_id', 'to_user_id'
+    ))
+    Friendship.objects.bulk_create(
+        [
+            Friendship(
+                from_user_id=from_id,
+                to_user_id=to_id,
+                state=Friendship.ACCEPTED if (to_id, from_id) in follows else Friendship.PENDING,
+            )
+            for from_id, to_id in edges
+        ],
+        ignore_conflicts=True,
+    )
+    accepted = [(to_id, from_id) for from_id, to_id in edges if (to_id, from_id) in follows]
+    if accepted:
+        Friendship.objects.filter(_pairs(accepted)).update(state=Friendship.ACCEPTED)
+
+
+def _disconnected(edges):
+    Friendship.objects.filter(_pairs(edges)).delete()
+    Friendship.objects.filter(_pairs([(to_id, from_id) for from_id, to_id in edges])).update(
+        state=Friendship.PENDING
+    )
+
+
+@receiver(m2m_changed, sender=Follow)
+def sync_friendships(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Mirror `following` changes into Friendship. Django runs add, remove
+    and clear together with their signals in one transaction, so the two
+    never disagree.
+    """
+    if action == 'pre_clear':
+        # pk_set is not given for clear; read what is about to go
+        if reverse:
+            pk_set = set(Follow.objects.filter(to_user_id=instance.pk).values_list('from_user_id', flat=True))
+        else:
+            pk_set = set(Follow.objects.filter(from_user_id=instance.pk).values_list('to_user_id', flat=True))
+        action = 'post_remove'
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+
+    edges = _connections(instance, reverse, pk_set)
+    if not edges:
+        return
+    if action == 'post_add':
+        _connected(edges)
+    else:
+        _disconnected(edges)
+
+
+
+def _counted_user(instance):
+    """(user id, loaded user or None) that a Plant or GardenUser counts for."""
+    fk, _ = COUNTED[type(instance)]
+    field = type(instance)._meta.get_field(fk)
+    # Read __dict__ so deferred loads never trigger a query
+    user_id = instance.__dict__.get(field.attname)
+    return user_id, getattr(instance, fk) if field.is_cached(instance) else None
+
+
+def remember_counted_user(sender, instance, **kwargs):
+    """Note the user a row counts for, to spot reassignments on save."""
+    instance._counted_user_id = _counted_user(instance)[0]
+
+
+def count_saved(sender, instance, created, **kwargs):
+    """Count a new row, or move it between users when it was reassigned."""
+    _, counter = COUNTED[sender]
+    user_id, user = _counted_user(instance)
+    if created:
+        adjust(user_id, counter, 1, user)
+    elif instance._counted_user_id != user_id:
+        if instance._counted_user_id is not None:
+            adjust(instance._counted_user_id, counter, -1)
+        adjust(user_id, counter, 1, user)
+    instance._counted_user_id = user_id
+
+
+def count_deleted(sender, instance, **kwargs):
+    _, counter = COUNTED[sender]
+    user_id, user = _counted_user(instance)
+    adjust(user_id, counter, -1, user)
+
+
+for counted_model in COUNTED:
+    post_init.connect(remember_counted_user, sender=counted_model)
+    post_save.connect(count_saved, sender=counted_model)
+    post_delete.connect(count_deleted, sender=counted_model)
@@ -4,6 +4,8 @@ from rest_framework.test import APITestCase
 from rest_framework import status
 from django.contrib.auth import get_user_model
 
+from .models import Friendship
+
 # Create your tests here.
 
 User = get_user_model()
@@ -59,6 +61,71 @@ class UserModelTests(TestCase):
         )
         self.assertEqual(str(user), user.username)
 
+class UserCounterTests(TestCase):
+    def setUp(self):
+        from gardens.models import Garden
+
+        self.alice = User.objects.create_user(email="alice@a.com", username="alice", password="password123")
+        self.bob = User.objects.create_user(email="bob@b.com", username="bob", password="password123")
+        self.garden = Garden.objects.get(gardenuser__user=self.alice)
+
+    def _counts(self, user):
+        user = User.objects.get(pk=user.pk)
+        return user.plants_count, user.gardens_count
+
+    def test_new_user_counts_default_garden(self):
+        self.assertEqual(self.alice.gardens_count, 1)
+        self.assertEqual(self._counts(self.alice), (0, 1))
+
+    def test_plant_create_move_and_delete(self):
+        from plants.models import Plant
+
+        plant = Plant.objects.create(owner=self.alice, garden=self.garden, nickname="fern")
+        self.assertEqual(self._counts(self.alice), (1, 1))
+
+        plant = Plant.objects.get(pk=plant.pk)
+        plant.owner = self.bob
+        plant.save()
+        self.assertEqual(self._counts(self.alice), (0, 1))
+        self.assertEqual(self._counts(self.bob), (1, 1))
+
+        plant.delete()
+        self.assertEqual(self._counts(self.bob), (0, 1))
+
+    def test_garden_delete_uncounts_members_and_plants(self):
+        from gardens.models import GardenUser
+        from plants.models import Plant
+
+        GardenUser.objects.create(organization=self.garden, user=self.bob)
+        Plant.objects.create(owner=self.bob, garden=self.garden, nickname="cactus")
+        self.assertEqual(self._counts(self.bob), (1, 2))
+
+        self.garden.delete()
+        self.assertEqual(self._counts(self.alice), (0, 0))
+        self.assertEqual(self._counts(self.bob), (0, 1))
+
+    def test_serializing_a_user_runs_no_queries(self):
+        from .serializers import UserSerializer
+
+        user = User.objects.get(pk=self.alice.pk)
+        with self.assertNumQueries(0):
+            data = UserSerializer(user).data
+        self.assertEqual((data["plants_count"], data["gardens_count"]), (0, 1))
+
+    def test_reconcile_repairs_drift(self):
+        from django.core.management import call_command
+        from io import StringIO
+        from plants.models import Plant
+
+        # bulk_create sends no signals
+        Plant.objects.bulk_create([Plant(owner=self.alice, garden=self.garden, nickname="moss")])
+        User.objects.filter(pk=self.bob.pk).update(gardens_count=5)
+
+        call_command("reconcile_user_counters", stdout=StringIO())
+        self.assertEqual(self._counts(self.alice), (1, 1))
+        self.assertEqual(self._counts(self.bob), (0, 1))
+
+
 class MeViewTests(APITestCase):
 
     def setUp(self):
@@ -157,6 +224,62 @@ class MeViewTests(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
+class FriendshipTableTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(email="alice@a.com", username="alice", password="password123")
+        self.bob = User.objects.create_user(email="bob@b.com", username="bob", password="password123")
+        self.charlie = User.objects.create_user(email="charlie@c.com", username="charlie", password="password123")
+
+    def _rows(self):
+        return set(Friendship.objects.values_list("from_user_id", "to_user_id", "state"))
+
+    def test_rows_follow_requests_accepts_and_removals(self):
+        self.alice.following.add(self.bob)
+        self.assertEqual(self._rows(), {(self.alice.id, self.bob.id, Friendship.PENDING)})
+
+        self.bob.following.add(self.alice)
+        self.assertEqual(self._rows(), {
+            (self.alice.id, self.bob.id, Friendship.ACCEPTED),
+            (self.bob.id, self.alice.id, Friendship.ACCEPTED),
+        })
+
+        self.alice.unfriend(self.bob)
+        self.assertEqual(self._rows(), set())
+
+    def test_reverse_and_clear_keep_rows_in_step(self):
+        self.bob.followers.add(self.alice, self.charlie)
+        self.bob.following.add(self.alice)
+        self.assertEqual(self._rows(), {
+            (self.alice.id, self.bob.id, Friendship.ACCEPTED),
+            (self.bob.id, self.alice.id, Friendship.ACCEPTED),
+            (self.charlie.id, self.bob.id, Friendship.PENDING),
+        })
+
+        self.alice.following.clear()
+        self.assertEqual(self._rows(), {
+            (self.bob.id, self.alice.id, Friendship.PENDING),
+            (self.charlie.id, self.bob.id, Friendship.PENDING),
+        })
+
+    def test_self_follow_is_not_a_friendship(self):
+        self.alice.following.add(self.alice)
+        self.assertEqual(self._rows(), set())
+
+    def test_friend_queries_are_single_lookups(self):
+        self.alice.following.add(self.bob, self.charlie)
+        self.bob.following.add(self.alice)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(list(self.alice.get_friends()), [self.bob])
+        with self.assertNumQueries(1):
+            self.assertTrue(self.alice.is_friend_with(self.bob))
+        with self.assertNumQueries(1):
+            self.assertEqual(list(self.alice.get_outgoing_requests()), [self.charlie])
+        self.assertEqual(list(self.charlie.get_pending_requests()), [self.alice])
+        self.assertEqual(list(self.alice.friend_ids()), [self.bob.id])
+        self.assertEqual(self.alice.count_friends(), 1)
+
+
 class FriendRequestAPITests(APITestCase):
     def setUp(self):
         self.alice = User.objects.create_user(
@@ -470,6 +593,204 @@ class IsFriendAPITests(APITestCase):
         self.assertEqual(response.status_code, 404)
 
 
+class RelationshipStatusAPITests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(email="alice@a.com", username="alice", password="password123")
+        self.bob = User.objects.create_user(email="bob@b.com", username="bob", password="password123")
+        self.charlie = User.objects.create_user(email="charlie@c.com", username="charlie", password="password123")
+        self.diana = User.objects.create_user(email="diana@d.com", username="diana", password="password123")
+        self.eve = User.objects.create_user(email="eve@e.com", username="eve", password="password123")
+        self.url = reverse("relationships")
+
+    def test_statuses_for_many_users_in_constant_queries(self):
+        self.alice.following.add(self.bob, self.charlie)
+        self.bob.following.add(self.alice)
+        self.diana.following.add(self.alice)
+        self.client.force_authenticate(user=self.alice)
+
+        ids = [self.alice.id, self.bob.id, self.charlie.id, self.diana.id, self.eve.id, 999999]
+        # The Friendship lookup is the only query, however many ids
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, {"ids": ",".join(str(user_id) for user_id in ids)})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["relationships"], {
+            str(self.alice.id): "self",
+            str(self.bob.id): "friend",
+            str(self.charlie.id): "pending_outgoing",
+            str(self.diana.id): "pending_incoming",
+            str(self.eve.id): "none",
+            "999999": "none",
+        })
+
+    def test_rejects_missing_invalid_and_too_many_ids(self):
+        self.client.force_authenticate(user=self.alice)
+
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.url, {"ids": "1,x"}).status_code, status.HTTP_400_BAD_REQUEST)
+        too_many = ",".join(str(user_id) for user_id in range(1, 302))
+        self.assertEqual(self.client.get(self.url, {"ids": too_many}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_requires_authentication(self):
+        response = self.client.get(self.url, {"ids": str(self.bob.id)})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class FriendListPaginationTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(email="alice@a.com", username="alice", password="password123")
+        self.friends = [
+            User.objects.create_user(email=f"friend{i}@f.com", username=f"friend{i}", password="password123")
+            for i in range(5)
+        ]
+        for friend in self.friends:
+            self.alice.following.add(friend)
+            friend.following.add(self.alice)
+        self.client.force_authenticate(user=self.alice)
+
+    def test_pages_follow_user_id_until_exhausted(self):
+        seen = []
+        params = {"page_size": 2}
+        while True:
+            response = self.client.get("/api/friends/", params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data["results"]), 2)
+            seen.extend(user["id"] for user in response.data["results"])
+            pagination = response.data["pagination"]
+            if not pagination["has_next"]:
+                self.assertIsNone(pagination["next_after_id"])
+                break
+            params["after_id"] = pagination["next_after_id"]
+
+        self.assertEqual(seen, sorted(friend.id for friend in self.friends))
+
+    def test_fields_reads_only_requested_columns(self):
+        with self.assertNumQueries(1) as queries:
+            response = self.client.get("/api/friends/", {"fields": "id,username", "page_size": 3})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["results"],
+            [{"id": friend.id, "username": friend.username} for friend in self.friends[:3]],
+        )
+        self.assertNotIn("first_name", queries.captured_queries[0]["sql"])
+
+    def test_fields_can_include_presence(self):
+        response = self.client.get(
+            f"/users/{self.alice.id}/friends/", {"fields": "username,is_online,avatar_photo"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        first = response.data["results"][0]
+        self.assertEqual(list(first), ["username", "is_online", "avatar_photo"])
+        self.assertEqual(first["username"], "friend0")
+        self.assertIsInstance(first["is_online"], bool)
+        self.assertIsNone(first["avatar_photo"])
+
+    def test_request_lists_paginate_too(self):
+        stranger = User.objects.create_user(email="s@s.com", username="stranger", password="password123")
+        stranger.following.add(self.alice)
+
+        response = self.client.get("/api/friend-requests/", {"page_size": 10})
+        self.assertEqual([user["id"] for user in response.data["results"]], [stranger.id])
+        response = self.client.get("/api/friend-requests/outgoing/", {"page_size": 10})
+        self.assertEqual(response.data["results"], [])
+
+    def test_rejects_unknown_fields_and_bad_cursors(self):
+        response = self.client.get("/api/friends/", {"fields": "id,email"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get("/api/friends/", {"after_id": "abc"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_without_pagination_params_returns_full_list(self):
+        response = self.client.get("/api/friends/")
+        self.assertEqual(len(response.data), len(self.friends))
+
+
+class UserSearchTests(APITestCase):
+    def setUp(self):
+        def create(username, first_name="", last_name=""):
+            return User.objects.create_user(
+                email=f"{username}@example.com", username=username, password="password123",
+                first_name=first_name, last_name=last_name,
+            )
+
+        self.annabel = create("annabel")
+        self.ann = create("ann")
+        self.anna = create("Anna")
+        self.zed = create("zed", first_name="Annie", last_name="Nowak")
+        self.maria = create("plant42lover", first_name="Maria", last_name="Zoë")
+        self.url = reverse("user-search")
+        self.client.force_authenticate(user=self.ann)
+
+    def _search(self, query, **params):
+        response = self.client.get(self.url, {"search": query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        if not params:
+            return [user["username"] for user in response.data], None
+        return [user["username"] for user in response.data["results"]], response.data["pagination"]
+
+    def test_exact_then_username_prefix_then_name_matches(self):
+        usernames, _ = self._search("ann")
+        self.assertEqual(usernames, ["ann", "Anna", "annabel", "zed"])
+
+    def test_name_words_in_any_order_and_diacritics(self):
+        self.assertEqual(self._search("nowak ann")[0], ["zed"])
+        self.assertEqual(self._search("zoe")[0], ["plant42lover"])
+        # Digits split words, so the tail of a username is a word of its own
+        self.assertEqual(self._search("lover")[0], ["plant42lover"])
+        self.assertEqual(self._search("plant4")[0], ["plant42lover"])
+
+    def test_non_ascii_usernames_are_username_prefix_matches(self):
+        from .search import username_prefix_matches
+
+        lukasz = User.objects.create_user(email="lukasz@example.com", username="Łukasz", password="pass12345")
+        self.assertEqual(list(username_prefix_matches("łuk")), [lukasz])
+        self.assertEqual(self._search("ŁUKASZ")[0], ["Łukasz"])
+
+        lukasz.username = "Ługi"
+        lukasz.save(update_fields=["username", "username_lower"])
+        self.assertEqual(list(username_prefix_matches("ług")), [lukasz])
+
+    def test_pages_run_across_both_tiers(self):
+        first, pagination = self._search("ann", page_size=2)
+        self.assertEqual(first, ["ann", "Anna"])
+        self.assertEqual(pagination, {"page_size": 2, "has_next": True, "next_offset": 2})
+        second, pagination = self._search("ann", page_size=2, offset=pagination["next_offset"])
+        self.assertEqual(second, ["annabel", "zed"])
+        self.assertEqual(pagination, {"page_size": 2, "has_next": False, "next_offset": None})
+
+    def test_index_follows_renames_and_deletes(self):
+        self.zed.first_name = "Kasia"
+        self.zed.save()
+        self.assertEqual(self._search("kas")[0], ["zed"])
+        self.assertNotIn("zed", self._search("ann")[0])
+
+        self.zed.delete()
+        self.assertEqual(self._search("kas")[0], [])
+
+    def test_blank_query_and_operators_return_nothing(self):
+        self.assertEqual(self._search("   ")[0], [])
+        self.assertEqual(self._search('"*')[0], [])
+
+    def test_invalid_pagination_is_rejected(self):
+        response = self.client.get(self.url, {"search": "ann", "page_size": "x"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_username_prefix_reads_the_lower_index(self):
+        from django.db import connection
+
+        from .search import username_prefix_matches
+
+        if connection.vendor != "sqlite":
+            self.skipTest("EXPLAIN QUERY PLAN is SQLite specific")
+        sql, params = username_prefix_matches("ann")[:21].query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            plan = " ".join(str(row) for row in cursor.fetchall())
+        self.assertIn("username_lower", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+
 class UserFriendsListAPIViewTests(APITestCase):
     """Tests for GET /api/friends/ endpoint"""
 
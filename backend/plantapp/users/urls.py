@@ -5,7 +5,7 @@ from .views import (
     FriendRequestsListAPIView, RejectFriendRequestAPIView,
     SendFriendRequestAPIView, AcceptFriendRequestAPIView,
     CancelFriendRequestAPIView, OutgoingFriendRequestsListAPIView,
-    UserProfileView, UserSearchAPIView
+    UserProfileView, UserSearchAPIView, RelationshipStatusAPIView
 )
 
 
@@ -22,5 +22,6 @@ urlpatterns = [
     path('users/<int:user_id>/accept/', AcceptFriendRequestAPIView.as_view(), name='accept-friend-request'),
     path('users/<int:user_id>/reject/', RejectFriendRequestAPIView.as_view(), name='reject-friend-request'),
     path('users/<int:user_id>/cancel-request/', CancelFriendRequestAPIView.as_view(), name='cancel-friend-request'),
+    path('api/relationships/', RelationshipStatusAPIView.as_view(), name='relationships'),
     path('users/search/', UserSearchAPIView.as_view(), name='user-search'),
 ]
\ No newline at end of file
@@ -2,13 +2,20 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from django.shortcuts import get_object_or_404
-from rest_framework import status, generics, filters
+from rest_framework import status
+from .models import Friendship
+from .pagination import is_paginated, user_page
+from .search import search_users
 from .serializers import UserSerializer, UserUpdateSerializer, PublicUserSerializer
 from django.contrib.auth import get_user_model
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 
 
 User = get_user_model()
+MAX_RELATIONSHIP_IDS = 300
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+SEARCH_PAGE_PARAMS = {"page_size", "offset"}
 
 
 # GET /api/auth/me/ - get user data
@@ -71,6 +78,8 @@ class ListFriendsAPIView(APIView):
     def get(self, request, user_id):
         user = get_object_or_404(User, pk=user_id)
         friends = user.get_friends()
+        if is_paginated(request):
+            return user_page(request, friends, PublicUserSerializer)
 
         serializer = PublicUserSerializer(friends, many=True)
         return Response(serializer.data)
@@ -104,12 +113,49 @@ class IsFriendAPIView(APIView):
         return Response({"is_friend": is_friend})
 
 
+class RelationshipStatusAPIView(APIView):
+    """
+    Relationship of the current user to many users at once, for rendering
+    friend buttons on search results and member lists in one request.
+    GET /api/relationships/?ids=1,2,3
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        raw_ids = [value for value in request.query_params.get("ids", "").split(",") if value.strip()]
+        if not raw_ids:
+            return Response(
+                {"detail": "ids query parameter required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(raw_ids) > MAX_RELATIONSHIP_IDS:
+            return Response(
+                {"detail": f"At most {MAX_RELATIONSHIP_IDS} ids per request"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            user_ids = [int(value) for value in raw_ids]
+        except ValueError:
+            return Response(
+                {"detail": "ids must be a comma-separated list of integers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        statuses = request.user.relationships_with(user_ids)
+        return Response({
+            "relationships": {str(user_id): relationship for user_id, relationship in statuses.items()}
+        })
+
+
 class UserFriendsListAPIView(APIView):
     """Get all of current user's friends (mutual connections)."""
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
         friends = request.user.get_friends()
+        if is_paginated(request):
+            return user_page(request, friends, PublicUserSerializer)
         serializer = PublicUserSerializer(friends, many=True)
         return Response(serializer.data)
 
@@ -121,6 +167,8 @@ class FriendRequestsListAPIView(APIView):
     def get(self, request):
         user = request.user
         pending = user.get_pending_requests()
+        if is_paginated(request):
+            return user_page(request, pending, PublicUserSerializer)
         serializer = PublicUserSerializer(pending, many=True)
         return Response(serializer.data)
 
@@ -140,7 +188,7 @@ class RejectFriendRequestAPIView(APIView):
             )
 
         # Check if target sent us a friend request
-        if not target.following.filter(pk=user.pk).exists():
+        if target.friendship_state(user) is None:
             return Response(
                 {"detail": f"{target.username} is not following you."},
                 status=status.HTTP_400_BAD_REQUEST,
@@ -169,7 +217,7 @@ class SendFriendRequestAPIView(APIView):
             )
 
         # Check if friend request already sent
-        if user.following.filter(pk=target.pk).exists():
+        if user.friendship_state(target) is not None:
             return Response(
                 {"detail": f"Friend request already sent to {target.username}."},
                 status=status.HTTP_400_BAD_REQUEST,
@@ -198,14 +246,15 @@ class AcceptFriendRequestAPIView(APIView):
             )
 
         # Check if target sent us a friend request
-        if not target.following.filter(pk=user.pk).exists():
+        state = target.friendship_state(user)
+        if state is None:
             return Response(
                 {"detail": f"{target.username} has not sent you a friend request."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
         # Check if already friends
-        if user.following.filter(pk=target.pk).exists():
+        if state == Friendship.ACCEPTED:
             return Response(
                 {"detail": f"You are already friends with {target.username}."},
                 status=status.HTTP_400_BAD_REQUEST,
@@ -235,14 +284,15 @@ class CancelFriendRequestAPIView(APIView):
             )
 
         # Check if we sent a friend request
-        if not user.following.filter(pk=target.pk).exists():
+        state = user.friendship_state(target)
+        if state is None:
             return Response(
                 {"detail": f"No friend request sent to {target.username}."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
         # Don't allow canceling if they're already friends
-        if target.following.filter(pk=user.pk).exists():
+        if state == Friendship.ACCEPTED:
             return Response(
                 {"detail": f"You are already friends with {target.username}. Use unfriend instead."},
                 status=status.HTTP_400_BAD_REQUEST,
@@ -275,15 +325,43 @@ class OutgoingFriendRequestsListAPIView(APIView):
     def get(self, request):
         user = request.user
         outgoing = user.get_outgoing_requests()
+        if is_paginated(request):
+            return user_page(request, outgoing, PublicUserSerializer)
         serializer = PublicUserSerializer(outgoing, many=True)
         return Response(serializer.data)
 
 
-class UserSearchAPIView(generics.ListAPIView):
+class UserSearchAPIView(APIView):
+    """
+    Typeahead user search: GET /users/search/?search=<text>
+    Usernames starting with the text come first (an exact match on top),
+    then users with a name or username word starting with it; see users.search.
+    Returns the best SEARCH_PAGE_SIZE matches as a plain list, or with
+    `page_size` and `offset` one page in the users.pagination envelope,
+    continued from `next_offset`.
+    """
     permission_classes = [IsAuthenticated]
 
-    queryset = User.objects.all()
-    serializer_class = PublicUserSerializer
-    filter_backends = [filters.SearchFilter]
+    def get(self, request):
+        paginated = bool(SEARCH_PAGE_PARAMS & request.query_params.keys())
+        try:
+            page_size = max(1, min(int(request.query_params.get("page_size", SEARCH_PAGE_SIZE)), MAX_SEARCH_PAGE_SIZE))
+            offset = max(0, int(request.query_params.get("offset", "0")))
+        except ValueError:
+            return Response(
+                {"detail": "Invalid pagination parameters."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-    search_fields = ['username', 'first_name', 'last_name']
+        users, has_next = search_users(query=request.query_params.get("search", ""), limit=page_size, offset=offset)
+        results = PublicUserSerializer(users, many=True).data
+        if not paginated:
+            return Response(results)
+        return Response({
+            "results": results,
+            "pagination": {
+                "page_size": page_size,
+                "has_next": has_next,
+                "next_offset": offset + page_size if has_next else None,
+            },
+        })
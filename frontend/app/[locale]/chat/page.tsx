@@ -32,6 +32,12 @@ type ConversationResponse = {
   messages: Message[];
 };
 
+// keep in sync with HEARTBEAT_INTERVAL_SECONDS in chat_app/presence.py
+const HEARTBEAT_INTERVAL_MS = 20000;
+// keep in sync with AUTH_SUBPROTOCOL in chat_app/middleware.py
+const WS_AUTH_SUBPROTOCOL = 'plantapp.auth';
+const RECONNECT_DELAY_MS = 3000;
+
 type StatusUpdatePayload = {
   type: 'status_update';
   user_id: number;
@@ -43,6 +49,8 @@ export default function ChatPage() {
   const locale = useLocale();
   const websocketRef = useRef<WebSocket | null>(null);
   const selectedFriendRef = useRef<User | null>(null);
+  // Newest message id received over the socket, the cursor for websocket sync
+  const lastMessageIdRef = useRef(0);
 
   const [currentUserId, setCurrentUserId] = useState<number | null>(null);
   const [friends, setFriends] = useState<User[]>([]);
@@ -75,14 +83,39 @@ export default function ChatPage() {
     selectedFriendRef.current = selectedFriend;
   }, [selectedFriend]);
 
-  const buildWebSocketUrl = (token: string) => {
+  const trackMessageIds = (incoming: Message[]) => {
+    for (const message of incoming) {
+      lastMessageIdRef.current = Math.max(lastMessageIdRef.current, message.id);
+    }
+  };
+
+  // Appends messages of the open conversation, skipping ones already shown
+  const appendMessages = (incoming: Message[]) => {
+    trackMessageIds(incoming);
+    const activeFriend = selectedFriendRef.current;
+    if (!activeFriend) return;
+
+    const relevant = incoming.filter(
+      message =>
+        message.sender?.id === activeFriend.id ||
+        message.recipient?.id === activeFriend.id
+    );
+    if (relevant.length === 0) return;
+
+    setMessages(prevMessages => {
+      const known = new Set(prevMessages.map(message => message.id));
+      return [
+        ...prevMessages,
+        ...relevant.filter(message => !known.has(message.id)),
+      ];
+    });
+  };
+
+  const buildWebSocketUrl = () => {
     const wsBase = (
       process.env.NEXT_PUBLIC_WS_URL ?? 'ws://localhost:8000'
     ).replace(/\/$/, '');
-    const basePath = wsBase.endsWith('/ws')
-      ? `${wsBase}/chat/`
-      : `${wsBase}/ws/chat/`;
-    return `${basePath}?token=${encodeURIComponent(token)}`;
+    return wsBase.endsWith('/ws') ? `${wsBase}/chat/` : `${wsBase}/ws/chat/`;
   };
 
   useEffect(() => {
@@ -135,6 +168,8 @@ export default function ChatPage() {
 
   useEffect(() => {
     let cancelled = false;
+    let heartbeat: ReturnType<typeof setInterval> | null = null;
+    let reconnect: ReturnType<typeof setTimeout> | null = null;
 
     const connectSocket = async () => {
       if (currentUserId === null) return;
@@ -143,19 +178,39 @@ export default function ChatPage() {
         const accessToken = await getValidAccessToken();
         if (cancelled || !accessToken) return;
 
-        const socketUrl = buildWebSocketUrl(accessToken);
-        const socket = new WebSocket(socketUrl);
+        // The token travels as a subprotocol so it never shows up in URLs/logs
+        const socket = new WebSocket(buildWebSocketUrl(), [
+          WS_AUTH_SUBPROTOCOL,
+          accessToken,
+        ]);
         websocketRef.current = socket;
 
         socket.onopen = () => {
           if (!cancelled) {
             setIsSocketReady(true);
           }
+          // Catch up on anything missed while disconnected
+          if (lastMessageIdRef.current > 0) {
+            socket.send(
+              JSON.stringify({ type: 'sync', after_id: lastMessageIdRef.current })
+            );
+          }
+          // Keep the connection alive in the presence store
+          heartbeat = setInterval(() => {
+            if (socket.readyState === WebSocket.OPEN) {
+              socket.send(JSON.stringify({ type: 'ping' }));
+            }
+          }, HEARTBEAT_INTERVAL_MS);
         };
 
         socket.onclose = () => {
+          if (heartbeat) {
+            clearInterval(heartbeat);
+            heartbeat = null;
+          }
           if (!cancelled) {
             setIsSocketReady(false);
+            reconnect = setTimeout(connectSocket, RECONNECT_DELAY_MS);
           }
         };
 
@@ -171,6 +226,9 @@ export default function ChatPage() {
             const payload = JSON.parse(event.data) as {
               type?: string;
               message?: Message;
+              messages?: Message[];
+              cursor?: number;
+              has_more?: boolean;
               error?: string;
             };
 
@@ -181,21 +239,26 @@ export default function ChatPage() {
             }
 
             if (payload.type === 'message_sent' && payload.message) {
-              setMessages(prevMessages => [
-                ...prevMessages,
-                payload.message as Message,
-              ]);
+              appendMessages([payload.message]);
               setIsSending(false);
               return;
             }
 
             if (payload.type === 'new_message' && payload.message) {
-              const incomingMessage = payload.message as Message;
-              const senderUsername = incomingMessage.sender?.username;
-              const activeFriend = selectedFriendRef.current;
+              appendMessages([payload.message]);
+              return;
+            }
+
+            if (payload.type === 'sync_batch' && payload.messages) {
+              appendMessages(payload.messages);
+              return;
+            }
 
-              if (activeFriend && senderUsername === activeFriend.username) {
-                setMessages(prevMessages => [...prevMessages, incomingMessage]);
+            if (payload.type === 'sync_complete') {
+              if (payload.has_more && typeof payload.cursor === 'number') {
+                socket.send(
+                  JSON.stringify({ type: 'sync', after_id: payload.cursor })
+                );
               }
               return;
             }
@@ -242,6 +305,14 @@ export default function ChatPage() {
     return () => {
       cancelled = true;
       setIsSocketReady(false);
+      if (reconnect) {
+        clearTimeout(reconnect);
+        reconnect = null;
+      }
+      if (heartbeat) {
+        clearInterval(heartbeat);
+        heartbeat = null;
+      }
       if (websocketRef.current) {
         websocketRef.current.close();
         websocketRef.current = null;